@@ -0,0 +1,281 @@
+# Stages plot with matplotlib; never open windows while benchmarking
+import matplotlib
+matplotlib.use('Agg')
+
+import process
+from scripts import generate_synthetic_forest
+
+import utils.pipeline
+import utils.run_report
+from utils.pipeline import Stage
+
+import laspy
+import numpy as np
+import rasterio
+from fastlog import log
+from scipy.spatial import cKDTree
+
+import argparse
+import csv
+import json
+import os
+import time
+from pathlib import Path
+
+
+log_level_options = [log.WARNING, log.INFO, log.DEBUG]
+
+# An estimated stem further than this from a true stem counts as a false detection
+MATCH_DISTANCE = 1.0
+# A fuel volume cell under a removed crown counts as detected if its height dropped by more than this
+DETECTION_THRESHOLD = 1.0
+# Points per chunk when rewriting a cloud
+POINTS_PER_CHUNK = 5_000_000
+
+
+def synthesize(input_path, truth_path, points, seed):
+    generate_synthetic_forest.generate_synthetic_forest(input_path, truth_path, points, seed, after=True)
+
+def align_after(after_laz_path, truth_path, aligned_laz_path):
+    # Undo the known shift through the header offsets, standing in for a perfect registration
+    shift = np.array(json.loads(truth_path.read_text())['after_shift'])
+
+    with laspy.open(after_laz_path) as reader:
+        header = reader.header
+        header.offsets = header.offsets - shift
+        with laspy.open(aligned_laz_path, mode='w', header=header) as writer:
+            for points in reader.chunk_iterator(POINTS_PER_CHUNK):
+                writer.write_points(points)
+
+
+def build_synthesis_pipeline(dataset_path, points, seed):
+    # Generated data is reused between benchmark runs with the same size and seed
+    pipeline = utils.pipeline.Pipeline(dataset_path / 'synthetic_manifest.json')
+    pipeline.add(Stage('synthesize', synthesize,
+                       outputs=[dataset_path / 'input', dataset_path / 'truth'],
+                       params={'points': points, 'seed': seed},
+                       code=[Path(generate_synthetic_forest.__file__)]))
+    return pipeline
+
+def build_benchmark_pipeline(dataset_path):
+    '''
+    The Python stages of process.py, fed with ground-truth segmentation and rasters so they
+    can run (and be scored) without PDAL, R or GDAL.
+    '''
+    input_path = dataset_path / 'input'
+    truth_path = dataset_path / 'truth'
+    benchmark_path = dataset_path / 'benchmark'
+
+    cloud_memory = process.estimate_cloud_memory(input_path / 'before/before.laz')
+
+    # Every stage is timed on every run, so nothing is reused from a previous one
+    manifest_path = benchmark_path / 'manifest.json'
+    manifest_path.unlink(missing_ok=True)
+    pipeline = utils.pipeline.Pipeline(manifest_path)
+
+    pipeline.add(Stage('dbh', process.generate_diameter_at_base_height,
+                       inputs=[truth_path / 'segmented.laz', truth_path / 'chm.tif', truth_path / 'dem.tif'],
+                       outputs=[benchmark_path / 'dbh.csv'],
+                       cpus=os.cpu_count() or 1, memory=cloud_memory, cpus_param='workers'))
+
+    pipeline.add(Stage('trunk_density', process.generate_trunk_density_file,
+                       inputs=[benchmark_path / 'dbh.csv', truth_path / 'dem.tif'],
+                       outputs=[benchmark_path / 'trunk_density.tif']))
+
+    pipeline.add(Stage('align_after', align_after,
+                       inputs=[input_path / 'after/after.laz', truth_path / 'truth.json'],
+                       outputs=[benchmark_path / 'after_aligned.laz']))
+
+    pipeline.add(Stage('fuel_volume', process.generate_fuelvolume.compute_fuel_volume,
+                       inputs=[input_path / 'before/before.laz', benchmark_path / 'after_aligned.laz'],
+                       outputs=[benchmark_path / 'fuel_volume.tif'],
+                       params={'resolution': 1.0},
+                       memory=process.generate_fuelvolume.estimate_grid_memory([input_path / 'before/before.laz', input_path / 'after/after.laz'], 1.0)))
+
+    pipeline.add(Stage('fuel_strata', process.generate_fuelvolume.compute_fuel_strata,
+                       inputs=[input_path / 'before/before.laz', benchmark_path / 'after_aligned.laz', truth_path / 'dem.tif'],
+                       outputs=[benchmark_path / 'fuel_strata.tif'],
+                       params={'resolution': 1.0},
+                       memory=process.generate_fuelvolume.FUEL_STRATA_MEMORY))
+
+    return pipeline
+
+def build_full_pipeline(dataset, dataset_path):
+    # The real process.py graph (without LANDFIRE), from the raw synthetic clouds
+    output_path = dataset_path / 'output'
+    (output_path / 'manifest.json').unlink(missing_ok=True)
+
+    return process.build_pipeline(dataset, dataset_path / 'input/before/before.laz', output_path,
+                                  after_laz_path=dataset_path / 'input/after/after.laz', flammap=False)
+
+
+# --- ACCURACY ---
+
+def dbh_accuracy(dbh_path, truth):
+    with dbh_path.open() as file:
+        estimates = [(float(row['X']), float(row['Y']), float(row['DBH'])) for row in csv.DictReader(file)]
+
+    trees = truth['trees']
+    result = {'true_trees': len(trees), 'estimates': len(estimates)}
+    if not estimates:
+        return {**result, 'matched': 0, 'detection_rate': 0.0}
+
+    estimates = np.array(estimates)
+    true_xy = np.array([(tree['x'], tree['y']) for tree in trees])
+    true_dbh = np.array([tree['dbh'] for tree in trees])
+
+    # Greedy one-to-one matching, closest pairs first
+    distance, nearest = cKDTree(true_xy).query(estimates[:, :2], distance_upper_bound=MATCH_DISTANCE)
+    matched_trees = set()
+    pairs = []
+    for i in np.argsort(distance):
+        if np.isinf(distance[i]) or nearest[i] in matched_trees:
+            continue
+        matched_trees.add(nearest[i])
+        pairs.append((i, nearest[i]))
+
+    result.update({
+        'matched': len(pairs),
+        'detection_rate': len(pairs) / len(trees),
+        'false_estimates': len(estimates) - len(pairs),
+    })
+    if pairs:
+        estimate_index, tree_index = map(np.array, zip(*pairs))
+        error = estimates[estimate_index, 2] - true_dbh[tree_index]
+        result.update({
+            'dbh_bias_m': float(error.mean()),
+            'dbh_mae_m': float(np.abs(error).mean()),
+            'dbh_rmse_m': float(np.sqrt((error**2).mean())),
+            'dbh_mean_relative_error': float((np.abs(error) / true_dbh[tree_index]).mean()),
+            'position_rmse_m': float(np.sqrt((distance[estimate_index]**2).mean())),
+        })
+    return result
+
+def crown_masks(transform, shape, trees):
+    # Cells whose centre lies under the crown of a removed tree, and of a kept tree
+    removed = np.zeros(shape, dtype=bool)
+    kept = np.zeros(shape, dtype=bool)
+    resolution = transform.a
+
+    for tree in trees:
+        radius = tree['crown_radius']
+        row_min, col_min = rasterio.transform.rowcol(transform, tree['x'] - radius, tree['y'] + radius)
+        row_max, col_max = rasterio.transform.rowcol(transform, tree['x'] + radius, tree['y'] - radius)
+        row_min, col_min = max(row_min, 0), max(col_min, 0)
+        row_max, col_max = min(row_max + 1, shape[0]), min(col_max + 1, shape[1])
+        if row_min >= row_max or col_min >= col_max:
+            continue
+
+        cols, rows = np.meshgrid(np.arange(col_min, col_max), np.arange(row_min, row_max))
+        x = transform.c + (cols + 0.5) * resolution
+        y = transform.f - (rows + 0.5) * resolution
+        inside = np.hypot(x - tree['x'], y - tree['y']) < radius
+
+        mask = removed if tree['removed'] else kept
+        mask[row_min:row_max, col_min:col_max] |= inside
+
+    return removed, kept
+
+def fuel_volume_accuracy(fuel_volume_path, truth):
+    with rasterio.open(fuel_volume_path) as raster:
+        change = raster.read(1, masked=True)
+        removed, kept = crown_masks(raster.transform, change.shape, truth['trees'])
+
+    # Cells under both a removed and a kept crown are ambiguous, so they're left out
+    valid = ~np.ma.getmaskarray(change)
+    removed_change = change.data[removed & ~kept & valid]
+    untouched_change = change.data[~removed & ~kept & valid]
+
+    return {
+        'removed_crown_cells': int(removed_change.size),
+        'untouched_cells': int(untouched_change.size),
+        'mean_change_removed_m': float(removed_change.mean()) if removed_change.size else None,
+        'mean_change_untouched_m': float(untouched_change.mean()) if untouched_change.size else None,
+        'detection_rate': float((removed_change > DETECTION_THRESHOLD).mean()) if removed_change.size else None,
+        'false_positive_rate': float((untouched_change > DETECTION_THRESHOLD).mean()) if untouched_change.size else None,
+    }
+
+# --- REPORTING ---
+
+def log_stage_table(label, metrics):
+    log.info(f'{label}:')
+    with log.indent():
+        for name, stage in metrics.items():
+            points = stage['input_counts'].get('points', 0)
+            points_per_s = stage['throughput_per_s'].get('points', 0)
+            peak = max(stage['process_peak_rss_bytes'], stage['child_peak_rss_bytes'])
+            log.info(f'{name:<16} {stage["wall_s"]:8.2f}s  {points:>12,} points  {points_per_s:>12,.0f} points/s  {peak / 1024**2:>8,.0f} MiB peak')
+
+def log_accuracy(accuracy):
+    for name, result in accuracy.items():
+        log.info(f'{name} accuracy:')
+        with log.indent():
+            for key, value in result.items():
+                log.info(f'{key}: {value:.4g}' if isinstance(value, float) else f'{key}: {value}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline on a synthetic forest with known ground truth')
+
+    parser.add_argument('-v', action='count')
+    parser.add_argument('--verbosity', type=int, default=1)
+    parser.add_argument('--points', type=int, default=1_000_000, help='Points in the synthetic before cloud (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--full', action='store_true', help='Also run every process.py stage from the raw clouds (needs PDAL, R and GDAL)')
+    parser.add_argument('--cpus', type=int, default=1, help='Stage budget; the default of 1 runs stages one at a time so their peaks are their own')
+    parser.add_argument('--memory', type=float, default=None, help='GB of memory shared by concurrently running stages')
+
+    args = parser.parse_args()
+    started = time.time()
+
+    # Process verbosity args
+    verbosity = args.v if args.v else args.verbosity
+    verbosity = min(verbosity, len(log_level_options)-1)
+    log.setLevel(log_level_options[verbosity])
+
+    dataset = f'synthetic_{args.points}_{args.seed}'
+    dataset_path = Path('data') / dataset
+    memory = args.memory * 1024**3 if args.memory else None
+
+    statuses, _, _ = process.run_pipeline('synthetic data', build_synthesis_pipeline(dataset_path, args.points, args.seed))
+    if statuses['synthesize'] not in ('done', 'up to date'):
+        parser.error(f'Could not generate synthetic data in {dataset_path}')
+
+    truth = json.loads((dataset_path / 'truth/truth.json').read_text())
+
+    results = {'benchmark': process.run_pipeline('benchmark stages', build_benchmark_pipeline(dataset_path), args.cpus, memory)}
+    if args.full:
+        results['full'] = process.run_pipeline('full pipeline', build_full_pipeline(dataset, dataset_path), args.cpus, memory)
+
+    accuracy = {}
+    benchmark_path = dataset_path / 'benchmark'
+    output_path = dataset_path / 'output'
+    checks = {
+        'dbh (true segmentation)': (dbh_accuracy, benchmark_path / 'dbh.csv'),
+        'fuel_volume (true alignment)': (fuel_volume_accuracy, benchmark_path / 'fuel_volume.tif'),
+        # Band 1 is the removed volume per cell, so the same check applies in cubic metres
+        'fuel_strata (true alignment)': (fuel_volume_accuracy, benchmark_path / 'fuel_strata.tif'),
+        'dbh (full pipeline)': (dbh_accuracy, output_path / f'{dataset}_dbh.csv'),
+        'fuel_volume (full pipeline)': (fuel_volume_accuracy, output_path / f'{dataset}_fuel_volume.tif'),
+    }
+    for name, (check, path) in checks.items():
+        if 'full' in name and not args.full:
+            continue
+        if path.exists():
+            accuracy[name] = check(path, truth)
+        else:
+            log.warning(f'❌ No output to score for {name} at {path}')
+
+    process.log_summary(results)
+    for label, (_, _, metrics) in results.items():
+        log_stage_table(label, metrics)
+    log_accuracy(accuracy)
+
+    utils.run_report.write_run_report(
+        benchmark_path / 'benchmark_report.json',
+        {label: {'statuses': statuses, 'wall_s': elapsed, 'stages': metrics} for label, (statuses, elapsed, metrics) in results.items()},
+        started,
+        dataset=dataset,
+        arguments=vars(args),
+        accuracy=accuracy,
+    )
@@ -3,23 +3,61 @@ from scripts import download_landfire
 from scripts import generate_dbh
 from scripts import generate_fuelvolume
 from scripts import generate_trunk_density
+from scripts import landfire_cache
+from scripts import merge_flammap_layers
 from scripts import register_laz
+from scripts import tile_laz
 from scripts.merge_flammap_layers import generate_merged_data
 
+import utils.cog
 import utils.geotiff_utils
+import utils.gridding
+import utils.pipeline
+import utils.run_report
+from utils.pipeline import Stage
 
 from fastlog import log
+import laspy
+import rasterio.crs
+import rasterio.warp
 
 import argparse
-import subprocess
+import concurrent.futures
+import multiprocessing
+import os
+import time
 from pathlib import Path
 
-import shutil
 import json
 
 
 log_level_options = [log.WARNING, log.INFO, log.DEBUG]
 
+# Cores the R DEM/CHM step asks for; scripts/generate_dem.R is told how many it was granted
+DEM_CORES = 16
+# Rough in-memory size of a decompressed cloud relative to its LAZ file, used to budget stages
+LAZ_MEMORY_FACTOR = 20
+
+# Per-tile products that are stitched back together after tiled processing
+MOSAIC_PRODUCTS = ['dem.tif', 'chm.tif', 'slope.tif', 'aspect.tif', 'dbh.csv', 'trunk_density.tif', 'height_statistics.tif']
+# ...and those only made where there is an after-fire cloud
+AFTER_MOSAIC_PRODUCTS = ['fuel_volume.tif', 'fuel_strata.tif']
+# Downsampled clouds and features registration keeps between runs, so every after-fire
+# flight registered against the same before cloud reuses its preprocessing (see utils/feature_cache.py)
+REGISTRATION_CACHE = Path('data') / 'registration_cache'
+# LANDFIRE products kept between runs and datasets, and clipped to each DEM (see scripts/landfire_cache.py)
+LANDFIRE_CACHE = Path('data') / 'landfire_cache'
+# Meters added around the LAS header bounds of a cloud to get the area LANDFIRE data is fetched
+# for, so it covers the DEM and leaves resampling some margin (a few 30 m LANDFIRE pixels)
+LANDFIRE_BUFFER = 100
+# --registration choices and the register_laz arguments each stands for: feature matching, or
+# ground surface correlation with or without ICP on top
+REGISTRATION_OPTIONS = {
+    'features': {'method': 'features', 'icp': True},
+    'dem': {'method': 'dem', 'icp': False},
+    'dem+icp': {'method': 'dem', 'icp': True},
+}
+
 
 def filter_outliers(las_path, filtered_path):
     pipeline_json = [
@@ -43,11 +81,11 @@ def filter_outliers(las_path, filtered_path):
             "compression": "laszip"
         }
     ]
-    result = subprocess.run(
+    result = utils.run_report.run_command(
         ["pdal", "pipeline", "--stdin"],
         input=json.dumps(pipeline_json).encode("utf-8"),
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
+        capture_output=True,
+        check=False
     )
 
     if result.returncode == 0:
@@ -56,216 +94,500 @@ def filter_outliers(las_path, filtered_path):
     else:
         print("❌ PDAL pipeline failed")
         print(result.stderr.decode("utf-8"))
+        raise RuntimeError(f'PDAL pipeline failed for {las_path}')
+
+def split_inputs(las_path, *paths, tile_size, tile_buffer):
+    # Accepts the before las, optionally the after las, and the tile folder to write into
+    *after_las_path, tile_path = paths
+    after_las_path = after_las_path[0] if after_las_path else None
+    tile_laz.split_inputs(las_path, tile_path, tile_size, tile_buffer, after_las_path=after_las_path)
+
+def mosaic_tile_outputs(tile_index_path, *paths, tile_names):
+    # Stitch one product from every listed tile, trimming each tile back to its core
+    *tile_paths, mosaic_path = paths
+    core_bounds = {tile['name']: tile['core_bounds'] for tile in json.loads(tile_index_path.read_text())['tiles']}
+    tile_outputs = [(path, core_bounds[name]) for path, name in zip(tile_paths, tile_names)]
+
+    if mosaic_path.suffix == '.csv':
+        tile_laz.merge_tile_csvs(tile_outputs, mosaic_path)
+    else:
+        tile_laz.mosaic_rasters(tile_outputs, mosaic_path)
 
-def split_inputs():
-    # TODO: accept a pcd or las and split it into multiple tiled subcomponents
-    pass
 
-    
+def generate_dem_and_chm(filtered_las_path, dem_path, chm_path, cores=1):
+    utils.run_report.run_command(['./scripts/generate_dem.R', filtered_las_path, dem_path, chm_path, str(cores)])
+
 def generate_slope(dem_path, slope_path):
-    # Use gdal command to generate slope. call blocks until command finishes.
-    return subprocess.call(['gdaldem', 'slope', dem_path, slope_path])
+    # Use gdal command to generate slope. run blocks until command finishes.
+    utils.run_report.run_command(['gdaldem', 'slope', *utils.cog.gdal_arguments('float32'), dem_path, slope_path])
 
 def generate_aspect(dem_path, aspect_path):
-    # Use gdal command to generate aspect. call blocks until command finishes.
-    return subprocess.call(['gdaldem', 'aspect', dem_path, aspect_path])
+    # Use gdal command to generate aspect. run blocks until command finishes.
+    utils.run_report.run_command(['gdaldem', 'aspect', *utils.cog.gdal_arguments('float32'), dem_path, aspect_path])
 
 def generate_segmented_las(las_path, chm_path, las_segmented_path):
-    return subprocess.call(['./scripts/segment_las.R', las_path, chm_path, las_segmented_path])
+    utils.run_report.run_command(['./scripts/segment_las.R', las_path, chm_path, las_segmented_path])
 
-def generate_diameter_at_base_height(las_segmented_path, chm_path,  dem_path, dbh_path):
-    return generate_dbh.generate_dbh(las_segmented_path, chm_path,  dem_path, dbh_path)
+def generate_diameter_at_base_height(las_segmented_path, chm_path,  dem_path, dbh_path, workers=1):
+    return generate_dbh.generate_dbh(las_segmented_path, chm_path,  dem_path, dbh_path, workers=workers)
 
-def generate_trunk_density_file(dbh_path, td_path):
+def generate_trunk_density_file(dbh_path, dem_path, td_path):
     return generate_trunk_density.generate_trunk_density(dbh_path, dem_path, td_path)
 
-def generate_flammap_data(landfire_path, dem_path, flammap_path):
-    # Get lat-long bounds with rasterio
-    dem_bounds = utils.geotiff_utils.get_lat_long_bounds(dem_path, flammap_crs)
-    dem_str = ' '.join(map(str, dem_bounds))
-    
-    # Check that flammap data exists
-    if not landfire_path.exists():
-        log.warning(f'Using LANDFIRE to download data for these bounds: {dem_str}')
-        try:
-            download_landfire.download_flammap_data(flammap_crs, dem_str, output_path)
-            shutil.unpack_archive(landfire_path, extract_dir=flammap_path)
-        except Exception as e:
-            log.warning(f'❌ Failed to download LANDFIRE data: {e}')
-            return None
-
+def header_aoi(laz_path, crs=4326, buffer=LANDFIRE_BUFFER):
+    # Bounds of a cloud from its LAS header, grown by buffer meters and transformed to crs. The
+    # header covers every point, outliers included, so a stray return far off the flight grows
+    # the AOI with it. That only costs a larger download: the merge warps LANDFIRE onto the
+    # DEM's grid, and the cache clips later AOIs inside the larger product locally
+    with laspy.open(laz_path) as lasf:
+        las_crs = lasf.header.parse_crs()
+    if las_crs is None:
+        log.warning(f'No CRS in {laz_path}, assuming EPSG:32610 for its LANDFIRE bounds')
+    las_crs = las_crs.to_wkt() if las_crs is not None else 'EPSG:32610'
+
+    xmin, xmax, ymin, ymax = utils.gridding.header_bounds([laz_path])
+    return rasterio.warp.transform_bounds(las_crs, rasterio.crs.CRS.from_epsg(crs),
+                                          xmin - buffer, ymin - buffer, xmax + buffer, ymax + buffer)
+
+def generate_flammap_data(*paths, flammap_crs=4326, buffer=LANDFIRE_BUFFER):
+    # paths are the input clouds followed by the landfire_data folder for each. Bounds come from
+    # the LAS headers rather than the DEMs, so the download can start straight away, and every
+    # AOI the cache can't serve is fetched in one batch of concurrent LFPS jobs
+    laz_paths, flammap_paths = paths[:len(paths) // 2], paths[len(paths) // 2:]
+    requests = []
+    for laz_path, flammap_path in zip(laz_paths, flammap_paths):
+        bounds = header_aoi(laz_path, flammap_crs, buffer)
+        log.info(f'Fetching LANDFIRE data for these bounds: {" ".join(map(str, bounds))}')
+        flammap_path.mkdir(parents=True, exist_ok=True)
+        requests.append((flammap_crs, bounds, flammap_path / 'landfire.tif'))
+
+    landfire_cache.fetch_landfire_all(requests, LANDFIRE_CACHE)
+
+def generate_merged_file(flammap_path, dem_path, chm_path, aspect_path, slope_path, merged_path, num_threads=1):
     # Find flammap tif data
     try:
         tif_path = next(flammap_path.glob('*.tif'))
-        return tif_path
     except StopIteration:
-        log.warning('⚠️ No .tif file found in flammap path.')
-        return None
+        raise FileNotFoundError(f'⚠️ No .tif file found in {flammap_path}')
+
+    generate_merged_data(tif_path, dem_path, chm_path, aspect_path, slope_path, merged_path, num_threads=num_threads)
+
+def register_after_laz(filtered_las_path, filtered_after_laz_path, adjusted_laz_path, method='features', icp=True):
+    register_laz.register_laz(filtered_las_path, filtered_after_laz_path, adjusted_path=adjusted_laz_path, method=method, icp=icp,
+                              cache_directory=REGISTRATION_CACHE)
+
+
+def estimate_cloud_memory(laz_path):
+    # The file may not exist yet (e.g. a filtered cloud); budget nothing rather than guess
+    if laz_path is None or not laz_path.exists():
+        return 0
+    return laz_path.stat().st_size * LAZ_MEMORY_FACTOR
+
+def add_landfire_stage(pipeline, laz_paths, output_paths):
+    # Mostly waiting on the LANDFIRE server, so it takes no cpu from the budget. It only needs
+    # the input clouds, so it runs alongside filtering and DEM generation from the very start
+    pipeline.add(Stage('landfire', generate_flammap_data,
+                       inputs=laz_paths, outputs=[output_path / 'landfire_data' for output_path in output_paths],
+                       params={'flammap_crs': 4326, 'buffer': LANDFIRE_BUFFER},
+                       code=[Path(download_landfire.__file__), Path(landfire_cache.__file__)],
+                       cpus=0))
+
+def add_merge_stage(pipeline, dataset, output_path):
+    dem_path =              output_path / (dataset + '_dem.tif')
+    slope_path =            output_path / (dataset + '_slope.tif')
+    aspect_path =           output_path / (dataset + '_aspect.tif')
+    chm_path =              output_path / (dataset + '_chm.tif')
+    flammap_path =          output_path / 'landfire_data'
+    merged_path =           output_path / (dataset + '_merged.tif')
+
+    # Warps a block at a time with a GDAL thread per granted core, so it needs cores rather than memory
+    pipeline.add(Stage('merge', generate_merged_file,
+                       inputs=[flammap_path, dem_path, chm_path, aspect_path, slope_path], outputs=[merged_path],
+                       code=[Path(__file__).parent / 'scripts' / 'merge_flammap_layers.py'],
+                       cpus=merge_flammap_layers.NUM_THREADS,
+                       memory=2 * merge_flammap_layers.WARP_MEMORY_LIMIT * 1024**2, cpus_param='num_threads'))
+
+def build_pipeline(dataset, laz_path, output_path, filtered_after_laz_path=None, after_laz_path=None, flammap=True, registration='features', dbh_workers=None):
+    filtered_las_path =     output_path / (dataset + '_filtered.laz')
+
+    dem_path =              output_path / (dataset + '_dem.tif')
+    slope_path =            output_path / (dataset + '_slope.tif')
+    aspect_path =           output_path / (dataset + '_aspect.tif')
+    chm_path =              output_path / (dataset + '_chm.tif')
+    las_segmented_path =    output_path / (dataset + '_segmented.laz')
+    dbh_path =              output_path / (dataset + '_dbh.csv')
+    trunk_density_path =    output_path / (dataset + '_trunk_density.tif')
+    fuel_volume_path =      output_path / (dataset + '_fuel_volume.tif')
+    fuel_strata_path =      output_path / (dataset + '_fuel_strata.tif')
+    height_statistics_path = output_path / (dataset + '_height_statistics.tif')
+
+    scripts_path = Path(__file__).parent / 'scripts'
+
+    # Stages that load the whole cloud are budgeted from the size of the input
+    cloud_memory = estimate_cloud_memory(laz_path)
+
+    pipeline = utils.pipeline.Pipeline(output_path / 'manifest.json')
+
+    pipeline.add(Stage('filter', filter_outliers,
+                       inputs=[laz_path], outputs=[filtered_las_path],
+                       memory=cloud_memory))
+
+    pipeline.add(Stage('dem_chm', generate_dem_and_chm,
+                       inputs=[filtered_las_path], outputs=[dem_path, chm_path],
+                       code=[scripts_path / 'generate_dem.R'],
+                       cpus=DEM_CORES, memory=cloud_memory, cpus_param='cores'))
+
+    # QA raster of per-cell point height statistics; streamed a band of rows at a time, with
+    # bands sized to its memory budget, so that is all it asks for
+    pipeline.add(Stage('height_statistics', generate_fuelvolume.compute_height_statistics,
+                       inputs=[filtered_las_path], outputs=[height_statistics_path],
+                       params={'resolution': 1.0, 'memory': generate_fuelvolume.HEIGHT_STATISTICS_MEMORY},
+                       code=[Path(generate_fuelvolume.__file__)],
+                       memory=generate_fuelvolume.HEIGHT_STATISTICS_MEMORY))
+
+    pipeline.add(Stage('slope', generate_slope,
+                       inputs=[dem_path], outputs=[slope_path]))
+
+    pipeline.add(Stage('aspect', generate_aspect,
+                       inputs=[dem_path], outputs=[aspect_path]))
+
+    pipeline.add(Stage('segmentation', generate_segmented_las,
+                       inputs=[filtered_las_path, chm_path], outputs=[las_segmented_path],
+                       code=[scripts_path / 'segment_las.R'],
+                       memory=cloud_memory))
+
+    # Spreads trees over as many processes as it is granted cores (at most dbh_workers); its
+    # results don't depend on how many
+    pipeline.add(Stage('dbh', generate_diameter_at_base_height,
+                       inputs=[las_segmented_path, chm_path, dem_path], outputs=[dbh_path],
+                       code=[Path(generate_dbh.__file__)],
+                       cpus=dbh_workers or os.cpu_count() or 1, memory=cloud_memory, cpus_param='workers'))
+
+    pipeline.add(Stage('trunk_density', generate_trunk_density_file,
+                       inputs=[dbh_path, dem_path], outputs=[trunk_density_path],
+                       code=[Path(generate_trunk_density.__file__)]))
+
+    if flammap:
+        add_landfire_stage(pipeline, [laz_path], [output_path])
+        add_merge_stage(pipeline, dataset, output_path)
+
+    if after_laz_path is not None:
+        # An after cloud private to this pipeline (e.g. one tile of it) is filtered here rather than up front
+        filtered_after_laz_path = output_path / 'after_filtered.laz'
+
+        pipeline.add(Stage('filter_after', filter_outliers,
+                           inputs=[after_laz_path], outputs=[filtered_after_laz_path],
+                           memory=estimate_cloud_memory(after_laz_path)))
+
+    if filtered_after_laz_path is not None:
+        adjusted_laz_path = output_path / 'after-adjusted.laz'
+        pair_memory = cloud_memory + estimate_cloud_memory(after_laz_path or filtered_after_laz_path)
+
+        # Open3D registration is multithreaded, so it asks for every core it is allowed; DEM
+        # registration streams both clouds on one core into grids over their union
+        registration_params = REGISTRATION_OPTIONS[registration]
+        uses_open3d = registration_params['method'] == 'features' or registration_params['icp']
+        dem_memory = register_laz.estimate_dem_memory([laz_path, after_laz_path or filtered_after_laz_path]) if registration_params['method'] == 'dem' else 0
+        pipeline.add(Stage('registration', register_after_laz,
+                           inputs=[filtered_las_path, filtered_after_laz_path], outputs=[adjusted_laz_path],
+                           params=registration_params,
+                           code=[Path(register_laz.__file__)],
+                           cpus=(os.cpu_count() or 1) if uses_open3d else 1,
+                           memory=max(pair_memory if uses_open3d else 0, dem_memory)))
+
+        pipeline.add(Stage('fuel_volume', generate_fuelvolume.compute_fuel_volume,
+                           inputs=[filtered_las_path, adjusted_laz_path], outputs=[fuel_volume_path],
+                           params={'resolution': 1.0},
+                           code=[Path(generate_fuelvolume.__file__)],
+                           # Streamed, so it needs memory for the grid rather than the clouds
+                           memory=generate_fuelvolume.estimate_grid_memory([laz_path, after_laz_path or filtered_after_laz_path], 1.0)))
+
+        # Sizes its tiles to its memory budget, so that is all it asks for
+        pipeline.add(Stage('fuel_strata', generate_fuelvolume.compute_fuel_strata,
+                           inputs=[filtered_las_path, adjusted_laz_path, dem_path], outputs=[fuel_strata_path],
+                           params={'resolution': 1.0, 'memory': generate_fuelvolume.FUEL_STRATA_MEMORY},
+                           code=[Path(generate_fuelvolume.__file__)],
+                           memory=generate_fuelvolume.FUEL_STRATA_MEMORY))
+
+    return pipeline
+
+def build_after_pipeline(after_laz_path, output_path):
+    # The after-fire cloud is shared by every input file, so it is filtered once up front
+    filtered_after_laz_path = after_laz_path.with_name('after_filtered.laz')
+
+    pipeline = utils.pipeline.Pipeline(output_path / 'after_manifest.json')
+    pipeline.add(Stage('filter_after', filter_outliers,
+                       inputs=[after_laz_path], outputs=[filtered_after_laz_path],
+                       memory=estimate_cloud_memory(after_laz_path)))
+
+    return pipeline, filtered_after_laz_path
+
+def build_tiling_pipeline(laz_path, after_laz_path, output_path, tile_size, tile_buffer):
+    inputs = [laz_path] if after_laz_path is None else [laz_path, after_laz_path]
+
+    pipeline = utils.pipeline.Pipeline(output_path / 'tiling_manifest.json')
+    pipeline.add(Stage('tile', split_inputs,
+                       inputs=inputs, outputs=[output_path / 'tiles'],
+                       params={'tile_size': tile_size, 'tile_buffer': tile_buffer},
+                       code=[Path(tile_laz.__file__)]))
+
+    return pipeline
+
+def build_mosaic_pipeline(dataset, output_path, tile_index):
+    tile_index_path = output_path / 'tiles' / tile_laz.TILE_INDEX_NAME
+
+    pipeline = utils.pipeline.Pipeline(output_path / 'mosaic_manifest.json')
+
+    products = list(MOSAIC_PRODUCTS)
+    if any(tile['after'] for tile in tile_index['tiles']):
+        products.extend(AFTER_MOSAIC_PRODUCTS)
+
+    for product in products:
+        # Only tiles with after-fire points produce fuel volume and strata
+        tiles = [tile for tile in tile_index['tiles'] if product not in AFTER_MOSAIC_PRODUCTS or tile['after']]
+        tile_paths = [tile_output_path(output_path, tile) / f'{dataset}_{tile["name"]}_{product}' for tile in tiles]
+
+        # Built once the tiles are done, so a tile that failed (e.g. too few points to segment) is
+        # left out of the mosaic rather than dropping it; with no tiles at all it is skipped as missing
+        produced = [(tile, path) for tile, path in zip(tiles, tile_paths) if path.exists()]
+        if produced and len(produced) < len(tiles):
+            missing = [tile['name'] for tile, path in zip(tiles, tile_paths) if not path.exists()]
+            log.warning(f'Mosaic of {product} leaves out {len(missing)} of {len(tiles)} tiles without it: {", ".join(missing)}')
+            tiles, tile_paths = [tile for tile, _ in produced], [path for _, path in produced]
+
+        pipeline.add(Stage(f'mosaic_{Path(product).stem}', mosaic_tile_outputs,
+                           inputs=[tile_index_path, *tile_paths], outputs=[output_path / f'{dataset}_{product}'],
+                           params={'tile_names': [tile['name'] for tile in tiles]},
+                           code=[Path(tile_laz.__file__)]))
+
+    # LANDFIRE itself was fetched by build_landfire_pipeline while the tiles were processed
+    add_merge_stage(pipeline, dataset, output_path)
+
+    return pipeline
+
+def build_landfire_pipeline(laz_paths, output_paths, manifest_path):
+    # In batch runs LANDFIRE is fetched for every input at once, in the background (see __main__)
+    pipeline = utils.pipeline.Pipeline(manifest_path)
+    add_landfire_stage(pipeline, laz_paths, output_paths)
+    return pipeline
+
+def build_merge_pipeline(dataset, output_path):
+    # The merge of an untiled input whose LANDFIRE data came from build_landfire_pipeline
+    pipeline = utils.pipeline.Pipeline(output_path / 'merge_manifest.json')
+    add_merge_stage(pipeline, dataset, output_path)
+    return pipeline
+
+
+def tile_output_path(output_path, tile):
+    return output_path / 'tile_output' / tile['name']
+
+def output_namespace(dataset, file, input_path, output_path, input_count):
+    # A lone input keeps the flat layout; otherwise each file gets its own folder and prefix so outputs don't clobber
+    if input_count == 1:
+        return dataset, output_path
+
+    name = '_'.join(file.relative_to(input_path).with_suffix('').parts).replace(' ', '_')
+    return f'{dataset}_{name}', output_path / name
+
+def process_file(name, file, output_path, filtered_after_laz_path=None, after_laz_path=None, flammap=True, registration='features', dbh_workers=None, cpus=None, memory=None):
+    log.info(f'Processing input file {file}')
+    tic = time.time()
+
+    with log.indent():
+        output_path.mkdir(parents=True, exist_ok=True)
+
+        pipeline = build_pipeline(name, file, output_path, filtered_after_laz_path, after_laz_path, flammap, registration, dbh_workers)
+        statuses = pipeline.run(cpus, memory)
+
+    return statuses, time.time() - tic, pipeline.metrics
 
+def run_pipeline(label, pipeline, cpus=None, memory=None):
+    log.info(f'Running {label}')
+    tic = time.time()
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
+    with log.indent():
+        statuses = pipeline.run(cpus, memory)
 
-    parser.add_argument('dataset', help='Name of the dataset (e.g., mydataset)')
-    dataset = parser.parse_args().dataset
-    dataset = dataset.replace(' ', '_')
-    input_path = Path('data') / dataset / 'input/before'
-    output_path = Path('data') / dataset / 'output'
+    return statuses, time.time() - tic, pipeline.metrics
 
-    if not input_path.exists():
-        parser.error(f"Input folder does not exist: {input_path}")
-        quit()
+def init_worker(log_level):
+    log.setLevel(log_level)
+
+def run_jobs(jobs, workers, log_level, cpus, memory):
+    # jobs maps a label to the keyword arguments of process_file
+    results = {}
+
+    # Every worker schedules its own stages, so each gets an equal share of the budget
+    workers = min(workers, max(1, len(jobs)))
+    budget = {'cpus': max(1, cpus // workers), 'memory': memory / workers}
 
-    do_after = True
-    after_path = input_path.parent / 'after'
-    print(f"Checking for 'after' folder at {after_path}")
-    if not after_path.exists():
-        parser.error(f"'after' folder does not exist: {after_path}. Proceeding without it.")
-        do_after = False
+    if workers == 1:
+        for label, kwargs in jobs.items():
+            results[label] = process_file(**kwargs, **budget)
+        return results
+
+    log.info(f'Processing {len(jobs)} inputs with {workers} workers')
+    # Spawned rather than forked: the LANDFIRE prefetch thread (and its HTTP connections) are alive by now
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=init_worker, initargs=(log_level,)) as executor:
+        futures = {executor.submit(process_file, **kwargs, **budget): label for label, kwargs in jobs.items()}
+        for future in concurrent.futures.as_completed(futures):
+            label = futures[future]
+            try:
+                results[label] = future.result()
+            except Exception as e:
+                log.error(f'❌ Processing {label} crashed: {e}')
+                results[label] = (None, 0.0, {})
+
+    return results
+
+def log_summary(results):
+    log.info(f'Summary of {len(results)} inputs:')
+    with log.indent():
+        for label, (statuses, elapsed, _) in results.items():
+            if statuses is None:
+                log.error(f'❌ {label}: crashed after {elapsed:.1f}s')
+                continue
+
+            unfinished = [name for name, status in statuses.items() if status in ('failed', 'skipped')]
+            ran = sum(status == 'done' for status in statuses.values())
+            reused = sum(status == 'up to date' for status in statuses.values())
 
+            if unfinished:
+                log.warning(f'❌ {label}: {ran} ran, {reused} up to date, unfinished: {", ".join(unfinished)} ({elapsed:.1f}s)')
+            else:
+                log.success(f'✅ {label}: {ran} ran, {reused} up to date ({elapsed:.1f}s)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('dataset', help='Name of the dataset (e.g., mydataset)')
     parser.add_argument('-v', action='count')
     parser.add_argument('--verbosity', type=int, default=1)
-    
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='Number of input files (or tiles) to process in parallel')
+    parser.add_argument('--tile-size', type=float, default=None, help='Split each input into square tiles of this many meters')
+    parser.add_argument('--tile-buffer', type=float, default=20.0, help='Overlap in meters added around each tile and trimmed when mosaicking')
+    parser.add_argument('--cpus', type=int, default=os.cpu_count() or 1, help='Cores shared by all concurrently running stages (default: %(default)s)')
+    parser.add_argument('--memory', type=float, default=None, help='GB of memory shared by all concurrently running stages (default: 80%% of RAM)')
+    parser.add_argument('--registration', choices=list(REGISTRATION_OPTIONS), default='features',
+                        help='How the after-fire cloud is aligned: FPFH/RANSAC features, ground surface correlation, or that refined by ICP (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Processes the DBH step of each input (or tile) spreads trees over (default: every core that job is given)')
+
     args = parser.parse_args()
+    started = time.time()
 
     # Process verbosity args
     verbosity = args.v if args.v else args.verbosity
     verbosity = min(verbosity, len(log_level_options)-1)
     log.setLevel(log_level_options[verbosity])
 
-    tmp_folder_path = Path('data/tmp')
-
-    flammap_crs = 4326
-
-    # TODO: check dependencies
-    # TODO: make threadpool for each input file
-
-    for file in input_path.glob('**/*.laz'):
-        log.info(f'Processing input file {file}')
-        with log.indent():
-
-            laz_path = file
-
-            step = 10
-
-            output_path.mkdir(parents=True, exist_ok=True)
-
-            filtered_las_path = output_path / (dataset + '_filtered.laz')
-
-            dem_path =              output_path / (dataset + '_dem.tif')
-            slope_path =            output_path / (dataset + '_slope.tif')
-            aspect_path =           output_path / (dataset + '_aspect.tif')
-            chm_path =              output_path / (dataset + '_chm.tif')
-            las_segmented_path =    output_path / (dataset + '_segmented.laz')
-            dbh_path =              output_path / (dataset + '_dbh.csv')
-            trunk_density_path =    output_path / (dataset + '_trunk_density.tif')
-            landfire_path =         output_path / 'landfire_data.zip'
-            flammap_path =          output_path / 'landfire_data'
-            merged_path =           output_path / (dataset + '_merged.tif')
-            fuel_volume_path =      output_path / (dataset + '_fuel_volume.tif')
-
-
-            if filtered_las_path.exists():
-                log.info(f'Skipping - Generate las file: already exists at {filtered_las_path}')
-            else:
-                log.info(f'Generating filtered las file at {filtered_las_path}. This will take some time...')
-                filter_outliers(laz_path, filtered_las_path)
-
-
-            if dem_path.exists() and chm_path.exists():
-                log.info(f'Skipping - Generate dem and chm file: both already exists at {dem_path} and {chm_path}')
-            else:
-                log.info(f'Generating dem and chm file at {dem_path} and {chm_path}.')
-                subprocess.call(['./scripts/generate_dem.R', filtered_las_path, dem_path, chm_path, las_segmented_path])
-
+    dataset = args.dataset.replace(' ', '_')
+    input_path = Path('data') / dataset / 'input/before'
+    output_path = Path('data') / dataset / 'output'
 
-            if slope_path.exists():
-                log.info(f'Skipping - Generate slope file: already exists at {slope_path}')
-            else:
-                log.info(f'Generating slope file at {slope_path}')
-                generate_slope(dem_path, slope_path)
+    if not input_path.exists():
+        parser.error(f"Input folder does not exist: {input_path}")
 
+    if args.jobs < 1:
+        parser.error(f"--jobs must be at least 1, got {args.jobs}")
 
-            if aspect_path.exists():
-                log.info(f'Skipping - Generate aspect file: already exists at {aspect_path}')
-            else:
-                log.info(f'Generating aspect file at {aspect_path}')
-                generate_aspect(dem_path, aspect_path)
+    if args.cpus < 1:
+        parser.error(f"--cpus must be at least 1, got {args.cpus}")
 
+    if args.workers is not None and args.workers < 1:
+        parser.error(f"--workers must be at least 1, got {args.workers}")
 
-            if las_segmented_path.exists():
-                log.info(f'Skipping - Generate segmented las file: already exists at {las_segmented_path}')
-            else:
-                log.info(f'Generating segmented las file at {las_segmented_path}')
-                generate_segmented_las(filtered_las_path, chm_path, las_segmented_path)
+    memory = args.memory * 1024**3 if args.memory else utils.pipeline.default_memory_budget()
 
+    if args.tile_size is not None and args.tile_buffer >= args.tile_size / 2:
+        parser.error(f"--tile-buffer must be less than half of --tile-size")
 
-            if dbh_path.exists():
-                log.info(f'Skipping - Generate dbh file: already exists at {dbh_path}')
-            else:
-                log.info(f'Generating dbh file at {dbh_path}')
-                generate_diameter_at_base_height(las_segmented_path, chm_path,  dem_path, dbh_path)
+    input_files = sorted(input_path.glob('**/*.laz'))
+    if not input_files:
+        parser.error(f"No .laz files found in {input_path}")
 
+    output_path.mkdir(parents=True, exist_ok=True)
 
-            if trunk_density_path.exists():
-                log.info(f'Skipping - Generate density file: already exists at {trunk_density_path}')
-            else:
-                log.info(f'Generating trunk density file at {trunk_density_path}')
-                generate_trunk_density_file(dbh_path, trunk_density_path)
-            
-
-            if landfire_path.exists():
-                log.info(f'Skipping download - Generate landfire file: already exists at {landfire_path}')
-                if not flammap_path.exists():
-                    log.info(f'Unpacking existing LANDFIRE data to {flammap_path}')
-                    shutil.unpack_archive(landfire_path, extract_dir=flammap_path)
-                try:
-                    flammap_path = next(flammap_path.glob('*.tif'))
-                except StopIteration:
-                    log.warning('⚠️ No .tif file found in flammap path.')
-            else:
-                log.info(f'Generating landfire file at {landfire_path}')
-                flammap_path = generate_flammap_data(landfire_path, dem_path, flammap_path)
+    # TODO: check dependencies
 
+    after_laz_path = input_path.parent / 'after' / 'after.laz'
+    log.info(f"Checking for 'after' file at {after_laz_path}")
+    if not after_laz_path.exists():
+        log.warning(f"❌ After file does not exist: {after_laz_path}. Skipping fuel volume step.")
+        after_laz_path = None
+
+    namespaces = [(file, *output_namespace(dataset, file, input_path, output_path, len(input_files))) for file in input_files]
+    results = {}
+    jobs = {}
+
+    # With more than one AOI (several inputs, or tiles sharing an input's) LANDFIRE is taken out of
+    # the jobs and fetched for every input in one batch, so their LFPS jobs run concurrently. It only
+    # needs the inputs' headers, so it is fetched in the background from the start
+    batch_landfire = args.tile_size is not None or len(namespaces) > 1
+    if batch_landfire:
+        for file, name, file_output_path in namespaces:
+            file_output_path.mkdir(parents=True, exist_ok=True)
+        landfire_pipeline = build_landfire_pipeline([file for file, _, _ in namespaces], [path for _, _, path in namespaces],
+                                                    output_path / 'landfire_manifest.json')
+        prefetcher = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        landfire_fetch = prefetcher.submit(run_pipeline, 'LANDFIRE', landfire_pipeline, args.cpus, memory)
+
+    if args.tile_size is None:
+        filtered_after_laz_path = None
+        if after_laz_path is not None:
+            after_pipeline, filtered_after_laz_path = build_after_pipeline(after_laz_path, output_path)
+            if after_pipeline.run(args.cpus, memory)['filter_after'] in ('failed', 'skipped'):
+                filtered_after_laz_path = None
+
+        for file, name, file_output_path in namespaces:
+            jobs[str(file)] = {'name': name, 'file': file, 'output_path': file_output_path, 'filtered_after_laz_path': filtered_after_laz_path,
+                               'flammap': not batch_landfire, 'registration': args.registration, 'dbh_workers': args.workers}
 
-            if merged_path.exists():
-                # If we already have a merged file, we can skip this step
-                # But we still need to check if the flammap_path exists, because if not, LANDFIRE failed to download
-                log.info(f'Skipping - Generate merged file: already exists at {merged_path}')
-            elif flammap_path is not None:
-                log.info(f'Generating merged file at {merged_path}')
-                generate_merged_data(flammap_path, dem_path, chm_path, aspect_path, slope_path, merged_path)
-            else:
-                log.warning(f'❌ Failed to generate merged file at {merged_path} because flammap data was not downloaded successfully. Please check the LANDFIRE download step.')
-
-
-            if do_after:
-                after_laz_path = after_path / 'after.laz'
-                if not after_laz_path.exists():
-                    log.warning(f'❌ After file does not exist: {after_laz_path}. Skipping fuel volume step.')
-                else:
-                    filtered_after_laz_path = after_path / 'after_filtered.laz'
-                    if filtered_after_laz_path.exists():
-                        log.info(f'Skipping - Generate filtered after.laz file: already exists at {filtered_after_laz_path}')
-                    else:
-                        log.info(f'Generating filtered after.laz file at {filtered_after_laz_path}')
-                        filter_outliers(after_laz_path, filtered_after_laz_path)
-                    log.info(f'Registering {filtered_las_path} with {filtered_after_laz_path}')
-                    adjusted_laz_path = after_path / 'after-adjusted.laz'
-                    if adjusted_laz_path.exists():
-                        log.info(f'Skipping - Adjusted point cloud already exists at {adjusted_laz_path}')
-                    else:
-                        register_laz.register_laz(filtered_las_path, filtered_after_laz_path)
-                        log.info(f'✅ Successfully registered and saved adjusted point cloud to: {adjusted_laz_path}')
-
-                    if adjusted_laz_path.exists():
-                        if fuel_volume_path.exists():
-                            log.info(f'Skipping - Generate fuel volume file: already exists at {fuel_volume_path}')
-                        else:
-                            log.info(f'Generating fuel volume file at {fuel_volume_path}')
-                            generate_fuelvolume.compute_fuel_volume(filtered_las_path, adjusted_laz_path, fuel_volume_path, resolution=1.0)
-                            log.info(f'✅ Successfully generated fuel volume data and saved to: {fuel_volume_path}')
-                    else:
-                        log.error(f'❌ Failed to save adjusted point cloud to: {adjusted_laz_path}. Please check the registration step.')
-
-            quit()
+    else:
+        # Each tile runs the full pipeline minus LANDFIRE, which is merged once per input into the mosaic
+        tile_indices = {}
+        for file, name, file_output_path in namespaces:
+
+            tiling_pipeline = build_tiling_pipeline(file, after_laz_path, file_output_path, args.tile_size, args.tile_buffer)
+            results[f'{file} tiling'] = run_pipeline(f'tiling of {file}', tiling_pipeline, args.cpus, memory)
+            if results[f'{file} tiling'][0]['tile'] in ('failed', 'skipped'):
+                continue
+
+            tile_dir = file_output_path / 'tiles'
+            tile_indices[file] = tile_laz.load_tile_index(tile_dir)
+
+            for tile in tile_indices[file]['tiles']:
+                jobs[f'{file} {tile["name"]}'] = {
+                    'name': f'{name}_{tile["name"]}',
+                    'file': tile_dir / tile['name'] / tile['before'],
+                    'output_path': tile_output_path(file_output_path, tile),
+                    'after_laz_path': tile_dir / tile['name'] / tile['after'] if tile['after'] else None,
+                    'flammap': False,
+                    'registration': args.registration,
+                    'dbh_workers': args.workers,
+                }
+
+    results.update(run_jobs(jobs, args.jobs, log_level_options[verbosity], args.cpus, memory))
+
+    if batch_landfire:
+        results['LANDFIRE'] = landfire_fetch.result()
+        prefetcher.shutdown()
+
+        for file, name, file_output_path in namespaces:
+            if args.tile_size is None:
+                results[f'{file} merge'] = run_pipeline(f'merge of {file}', build_merge_pipeline(name, file_output_path), args.cpus, memory)
+            elif file in tile_indices:
+                mosaic_pipeline = build_mosaic_pipeline(name, file_output_path, tile_indices[file])
+                results[f'{file} mosaic'] = run_pipeline(f'mosaic of {file}', mosaic_pipeline, args.cpus, memory)
+
+    log_summary(results)
+
+    utils.run_report.write_run_report(
+        output_path / 'run_report.json',
+        {label: {'statuses': statuses, 'wall_s': elapsed, 'stages': metrics} for label, (statuses, elapsed, metrics) in results.items()},
+        started,
+        dataset=dataset,
+        arguments=vars(args),
+    )
@@ -1,10 +1,37 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+import base64
+import hashlib
+import os
+import random
 import time
 import requests
+import requests.adapters
 import json
 import sys
+import zipfile
+from pathlib import Path
+
+# LANDFIRE Product Service job API; LANDFIRE_API_URL points it elsewhere, e.g. at a local stand-in server
+LFPS_URL = os.environ.get("LANDFIRE_API_URL", "https://lfps.usgs.gov/api/job/")
+# Seconds between job status polls
+POLL_INTERVAL = 5
+# Seconds to wait for the server on any one request, and for a job to finish
+REQUEST_TIMEOUT = 60
+JOB_TIMEOUT = 60 * 60
+# Failed requests are retried this many times, after exponentially growing delays (s) with full jitter
+RETRIES = 6
+BACKOFF_BASE = 2
+BACKOFF_MAX = 120
+# Jobs in flight at once, which is also the size of the shared connection pool
+MAX_CONCURRENT_JOBS = 4
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Elevation, slope degrees, aspect, fuel models, canopy cover, canopy height, canopy base
+# height and canopy bulk density
+DEFAULT_LAYERS = "ELEV2020;SLPD2020;ASP2020;220F40_22;220CC_22;220CH_22;220CBH_22;220CBD_22"
 
 def parse_args():
     p = argparse.ArgumentParser(
@@ -28,90 +55,206 @@ def parse_args():
     )
     p.add_argument(
         "--layers", "-l",
-        default="ELEV2020;SLPD2020;ASP2020;220F40_22;220CC_22;220CH_22;220CBH_22;220CBD_22",
-            # elevation
-            # slope degrees
-            # aspect
-            # fuel models
-            # canopy cover
-            # canopy height
-            # canopy base height
-            # canopy bulk density
+        default=DEFAULT_LAYERS,
         help="Semicolon-separated LANDFIRE layer codes (default: %(default)s)"
     )
     return p.parse_args()
 
-def download_flammap_data(crs, aoi, output_dir=".", layers="ELEV2020;SLPD2020;ASP2020;220F40_22;220CC_22;220CH_22;220CBH_22;220CBD_22"):
-
-    BASE   = "https://lfps.usgs.gov/api/job/"
-    SUBMIT = BASE + "submit"
-    JOBURL = BASE + "status"
-
-    ## TODO did they change the API format? When LANDFIRE server back up, check this:
-
-    submit_params = {
-        "f":                  "JSON",              # response format
-        "Email":            "example@example.com",
-        "Area_of_Interest":             aoi,
-        "Output_Projection":       str(crs),
-        "Layer_List":       layers
-    }
-
-    # submit_params = {
-    #     "resample_res":     "30",
-    #     "email":            "example@example.com",
-    #     "bbox":             aoi,
-    #     "output_crs":       str(crs),
-    #     "Layer_List":       layers
-    # }
-
-    # 1) Submit the job
-    resp = requests.get(SUBMIT, params=submit_params)
-    print("→ URL   :", resp.url)
-    print("→ Code  :", resp.status_code)
-    print("→ Type  :", resp.headers.get("Content-Type"))
-    resp.raise_for_status()
+class LandfireError(RuntimeError):
+    pass
 
-    data = resp.json()
-    if "error" in data:
-        print("Submit failed:", json.dumps(data["error"], indent=2), file=sys.stderr)
-        sys.exit(1)
 
-    job_id = data["jobId"]
-    print(f"Job submitted: {job_id}")
-
-    # 2) Poll until complete
-    status = data["status"]
-    while status not in ("Succeeded", "Failed"):
-        time.sleep(5)
-        jr = requests.get(JOBURL, params={"JobId": job_id, "f": "JSON"})
-        jr.raise_for_status()
-        js = jr.json()
-        status = js.get("status", "")
-        print("  status:", status)
-
-    if status != "Succeeded":
-        print(f"Job {job_id} failed:", json.dumps(js, indent=2), file=sys.stderr)
-        sys.exit(1)
+class RetryableError(LandfireError):
+    # Worth trying again: timeouts, dropped connections, 429/5xx and maintenance pages
+    pass
+
+
+# One connection pool for every client in the process, so batch runs reuse connections
+session = requests.Session()
+session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=MAX_CONCURRENT_JOBS))
+session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=MAX_CONCURRENT_JOBS))
 
-    # 3) Get the output ZIP link
-    zip_url = js.get("outputFile")
-    if not zip_url:
-        print("❌ No outputFile found in response:", json.dumps(js, indent=2), file=sys.stderr)
-        sys.exit(1)
 
-    print("Download URL:", zip_url)
+def backoff_delay(attempt):
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
 
-    # 4) Download the ZIP
-    out_fname = f"{output_dir}/landfire_data.zip"
-    with requests.get(zip_url, stream=True) as zz:
-        zz.raise_for_status()
-        with open(out_fname, "wb") as f:
-            for chunk in zz.iter_content(1024 * 1024):
+def check_response(resp):
+    if resp.status_code == 429 or resp.status_code >= 500:
+        raise RetryableError(f"{resp.status_code} from {resp.url}")
+    resp.raise_for_status()
+
+def stream_to(url, path, timeout):
+    '''
+    Download url to path, resuming from however much of it is already there with an HTTP
+    Range request. Returns the full size of the file, from Content-Range or Content-Length
+    (None if the server sends neither), and its Content-MD5 if the whole file was sent and
+    came with one.
+    '''
+    offset = path.stat().st_size if path.exists() else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+    with session.get(url, stream=True, timeout=timeout, headers=headers) as resp:
+        if resp.status_code == 416:
+            # Nothing left to fetch
+            return offset, None
+        check_response(resp)
+
+        if resp.status_code == 206:
+            total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+            md5 = None
+            mode = "ab"
+        else:
+            # The server ignored the range, so start over
+            total = resp.headers.get("Content-Length")
+            md5 = resp.headers.get("Content-MD5")
+            mode = "wb"
+
+        with path.open(mode) as f:
+            for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
                 f.write(chunk)
 
-    print(f"✅ Saved to {out_fname}")
+        return (int(total) if total and total != "*" else None), md5
+
+def verify_download(path, size, md5):
+    # Size and Content-MD5 when the server gave them, and every member's CRC in the ZIP regardless
+    if size is not None and path.stat().st_size != size:
+        raise RetryableError(f"Downloaded {path.stat().st_size} of {size} bytes")
+    if md5 is not None:
+        digest = hashlib.md5()
+        with path.open("rb") as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        if base64.b64encode(digest.digest()).decode() != md5:
+            path.unlink()
+            raise RetryableError(f"Checksum mismatch for {path}")
+    try:
+        with zipfile.ZipFile(path) as archive:
+            bad = archive.testzip()
+    except zipfile.BadZipFile:
+        path.unlink()
+        raise RetryableError(f"{path} is not a ZIP file")
+    if bad is not None:
+        path.unlink()
+        raise RetryableError(f"Corrupt member {bad} in {path}")
+
+
+class LandfireClient:
+    '''
+    asyncio client for LFPS jobs. Each request runs on a worker thread over the shared
+    session; anything retryable is retried with exponential backoff and jitter, and anything
+    that still fails raises LandfireError rather than exiting. Up to max_concurrent_jobs jobs
+    run at once, e.g. with fetch_all for many AOIs or layer lists.
+    '''
+    def __init__(self, base_url=LFPS_URL, poll_interval=POLL_INTERVAL, timeout=REQUEST_TIMEOUT,
+                 job_timeout=JOB_TIMEOUT, retries=RETRIES, max_concurrent_jobs=MAX_CONCURRENT_JOBS):
+        self.base_url = base_url
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.job_timeout = job_timeout
+        self.retries = retries
+        self.jobs = asyncio.Semaphore(max_concurrent_jobs)
+
+    async def retrying(self, function, *args):
+        for attempt in range(self.retries + 1):
+            try:
+                return await asyncio.to_thread(function, *args)
+            except (RetryableError, requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                if attempt == self.retries:
+                    raise LandfireError(f"Giving up after {self.retries + 1} attempts: {e}") from e
+                delay = backoff_delay(attempt)
+                print(f"  {e}; retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+            except requests.HTTPError as e:
+                raise LandfireError(str(e)) from e
+
+    def get_json(self, endpoint, params):
+        resp = session.get(self.base_url + endpoint, params=params, timeout=self.timeout)
+        check_response(resp)
+        try:
+            data = resp.json()
+        except ValueError:
+            # LANDFIRE serves HTML pages during maintenance
+            raise RetryableError(f"Non-JSON response from {resp.url}: {resp.text[:200]!r}")
+        if "error" in data:
+            raise LandfireError(f"LANDFIRE error from {resp.url}: {json.dumps(data['error'])}")
+        return data
+
+    async def submit(self, crs, aoi, layers):
+        ## TODO did they change the API format? When LANDFIRE server back up, check this:
+        submit_params = {
+            "f":                  "JSON",              # response format
+            "Email":            "example@example.com",
+            "Area_of_Interest":             aoi,
+            "Output_Projection":       str(crs),
+            "Layer_List":       layers
+        }
+
+        # submit_params = {
+        #     "resample_res":     "30",
+        #     "email":            "example@example.com",
+        #     "bbox":             aoi,
+        #     "output_crs":       str(crs),
+        #     "Layer_List":       layers
+        # }
+
+        data = await self.retrying(self.get_json, "submit", submit_params)
+        print(f"Job submitted: {data['jobId']}")
+        return data
+
+    async def wait(self, job):
+        # Poll until the job finishes, returning its final status
+        started = time.monotonic()
+        status = job
+        while status.get("status") not in ("Succeeded", "Failed", "Cancelled", "Canceled", "TimedOut"):
+            if time.monotonic() - started > self.job_timeout:
+                raise LandfireError(f"Job {job['jobId']} still {status.get('status')} after {self.job_timeout}s")
+            await asyncio.sleep(self.poll_interval * random.uniform(0.8, 1.2))
+            status = await self.retrying(self.get_json, "status", {"JobId": job["jobId"], "f": "JSON"})
+            print(f"  {job['jobId']} status:", status.get("status"))
+
+        if status["status"] != "Succeeded":
+            raise LandfireError(f"Job {job['jobId']} {status['status']}: {json.dumps(status)}")
+        if not status.get("outputFile"):
+            raise LandfireError(f"No outputFile in response: {json.dumps(status)}")
+        return status
+
+    async def download(self, url, path):
+        '''
+        Download url to path by way of path.partial, which a retry (or a later run) resumes
+        from, and only move it into place once it is verified.
+        '''
+        partial = path.with_name(path.name + ".partial")
+
+        def attempt():
+            size, md5 = stream_to(url, partial, self.timeout)
+            verify_download(partial, size, md5)
+
+        await self.retrying(attempt)
+        os.replace(partial, path)
+
+    async def fetch(self, crs, aoi, output_dir=".", layers=DEFAULT_LAYERS):
+        # Run one job and download its ZIP to output_dir/landfire_data.zip, returning the path
+        async with self.jobs:
+            status = await self.wait(await self.submit(crs, aoi, layers))
+            print("Download URL:", status["outputFile"])
+            path = Path(output_dir) / "landfire_data.zip"
+            await self.download(status["outputFile"], path)
+            print(f"✅ Saved to {path}")
+            return path
+
+    async def fetch_all(self, jobs, return_exceptions=False):
+        # jobs is a list of (crs, aoi, output_dir, layers); returns their ZIP paths in order, or
+        # with return_exceptions, the exception in place of each job that failed
+        return await asyncio.gather(*(self.fetch(*job) for job in jobs), return_exceptions=return_exceptions)
+
+def download_flammap_data(crs, aoi, output_dir=".", layers=DEFAULT_LAYERS, base_url=LFPS_URL, poll_interval=POLL_INTERVAL):
+    # Blocking wrapper for a single job; raises LandfireError on failure
+    return asyncio.run(LandfireClient(base_url, poll_interval).fetch(crs, aoi, output_dir, layers))
 
 if __name__ == "__main__":
     args = parse_args()
-    download_flammap_data(args.projection, args.aoi, args.output, args.layers)
+    try:
+        download_flammap_data(args.projection, args.aoi, args.output, args.layers)
+    except LandfireError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
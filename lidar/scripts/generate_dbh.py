@@ -1,16 +1,23 @@
 import utils.argument_actions
+import utils.circle_fit
+import utils.geotiff_utils
+import utils.kmeans
 import utils.plotting
+import utils.run_report
 
-import rasterio
 import laspy
 import matplotlib.pyplot as plt
 import numpy as np
 from fastlog import log
-from scipy.cluster.vq import kmeans2
 
 import argparse
+import concurrent.futures
 import csv
-import warnings
+import multiprocessing
+import os
+import resource
+import time
+from multiprocessing.shared_memory import SharedMemory
 from pathlib import Path
 
 
@@ -26,66 +33,82 @@ FEASIBLE_TREE_MAX = 3
 MAX_TRUNKS = 4
 # How many points we require to compute an estimate
 MIN_POINTS_FOR_ESTIMATE = 50
-# Maximum standard deviation in meters (this should probably be smaller)
+# Maximum standard deviation of points from the fitted trunk circle in meters (this should probably be smaller)
 MAX_ESTIMATE_STANDARD_DEVIATION = 1.0
 # How much weight to give number of points in the scoring function
 POINTS_WEIGHT = 0.01
 # How much weight to give standard deviation in the scoring function
 DEVIATION_WEIGHT = -100
 
+# Clustering is seeded per tree from this and the tree's id, so results don't depend on how trees are split between workers
+RANDOM_SEED = 0
+# Trees are handed to workers in batches of roughly this many breast-height points
+POINTS_PER_TASK = 100_000
+# Trees are clustered together in padded batches of at most this many (padded) points
+POINTS_PER_BATCH = 50_000
+# How trunk circles are fitted, see utils.circle_fit
+CIRCLE_FIT_METHOD = 'taubin'
+CIRCLE_FIT_ROBUST_ITERATIONS = 3
+
 # Flag to show plots of each tree
 VISUALIZE_FLAG = False
 
 log_level_options = [log.WARNING, log.INFO, log.DEBUG]
 
 
-def generate_dbh(las_file, chm_file, dem_file, csv_file):
+def generate_dbh(las_file, chm_file, dem_file, csv_file, workers=1):
     log.info(f'Loading .las file from {las_file}')
     with laspy.open(las_file) as las_file_stream:
         las = las_file_stream.read()
 
-    # Get all unique Tree ID's
-    tree_ids = np.unique( las.points["treeID"] )
+    # Sort once so every tree is a contiguous slice, rather than masking the whole cloud per tree
+    log.info('Grouping points by tree...')
+    tree_ids, points, starts = group_trees(las)
+    band, offsets = breast_height_band(points, starts)
+
+    # Discard large LAS object from memory (the full tree points are only needed for plots)
+    las = None
+    if not VISUALIZE_FLAG:
+        points = None
 
     dbh_list = []
     error_list = []
 
-    # For each tree...
+    # Plots are shown one tree at a time, so only the serial path can draw them
     log.info('Computing DBH...')
-    for tree_id in tree_ids:
-        
-        log.debug(f'Analyzing tree {int(tree_id)}')
+    batches = tree_batches(offsets)
+    if workers > 1 and not VISUALIZE_FLAG:
+        estimates = estimate_batches_in_parallel(band, offsets, tree_ids, batches, workers)
+    else:
+        estimates = estimate_batches(band, offsets, tree_ids, batches)
 
-        with log.indent():
-            tree = las.points[ las.points["treeID"] == tree_id ]
-
-            # Normalize by ground level
-            normalize_tree(tree)
-
-            # Do estimate
-            dbh_estimates, error = estimate_dbh_for_tree(tree)
-
-            # Function may return None if it does no work
-            if dbh_estimates is None:
-                error_list.append(error)
-                continue
-                
-            # Else, store result
-            dbh_list.extend( dbh_estimates )
-
-            # Optionally plot each resultant estimate
-            if VISUALIZE_FLAG:
-                fig = plt.figure()
-                ax = fig.add_subplot(projection='3d')
-
-                utils.plotting.plot_tree(ax, tree)
-                for dbh in dbh_estimates:
-                    utils.plotting.plot_circle(ax, *dbh)
-                    utils.plotting.plot_circle(ax, *dbh[0:2], 3)
-                plt.show()
-
-    # Discard large LAS object from memory
-    las = None
+    # Batches hold similarly sized trees, so put the results back in tree order
+    results = [None] * len(tree_ids)
+    for i, result in estimates:
+        results[i] = result
+
+    # For each tree, in tree order regardless of which worker did it...
+    for i, (dbh_estimates, error) in enumerate(results):
+
+        # Function may return None if it does no work
+        if dbh_estimates is None:
+            error_list.append(error)
+            continue
+
+        # Else, store result
+        dbh_list.extend( dbh_estimates )
+
+        # Optionally plot each resultant estimate
+        if VISUALIZE_FLAG:
+            fig = plt.figure()
+            ax = fig.add_subplot(projection='3d')
+
+            end = starts[i+1] if i+1 < len(starts) else len(points)
+            utils.plotting.plot_np(ax, points[starts[i]:end])
+            for dbh in dbh_estimates:
+                utils.plotting.plot_circle(ax, *dbh)
+                utils.plotting.plot_circle(ax, *dbh[0:2], 3)
+            plt.show()
 
     # log the total number of estimates generated
     log.success(f'Generated {len(dbh_list)} diameter estimates from a total of {len(tree_ids)} segmented trees')
@@ -111,43 +134,183 @@ def generate_dbh(las_file, chm_file, dem_file, csv_file):
             # placeholder height
             writer.writerow([*dbh, height])
 
-def normalize_tree(tree):
-    tree['z'] = tree['z'] - min(tree['z'])
+def group_trees(las):
+    '''
+    Sort the points by treeID so each tree is one contiguous run. Returns the tree ids, an
+    (N, 3) array of points in that order with heights normalized to each tree's lowest
+    point, and the index where each tree's run starts.
+    '''
+    tree_id = np.asarray(las.points["treeID"])
+    order = np.argsort(tree_id, kind='stable')
+    tree_ids, starts = np.unique(tree_id[order], return_index=True)
+
+    points = np.stack([las.x[order], las.y[order], las.z[order]], axis=1)
+    normalize_trees(points, starts)
+
+    return tree_ids, points, starts
+
+def normalize_trees(points, starts):
+    # Normalize every tree by its own ground level in one pass
+    counts = np.diff(np.append(starts, len(points)))
+    points[:,2] -= np.repeat(np.minimum.reduceat(points[:,2], starts), counts)
+
+def breast_height_band(points, starts):
+    '''
+    Keep only the "chest high" points of every tree. Returns them along with offsets such
+    that tree i's slice is band[offsets[i]:offsets[i+1]].
+    '''
+    slice_top = BREAST_HEIGHT + SEARCH_REGION_HEIGHT/2
+    slice_bottom = BREAST_HEIGHT - SEARCH_REGION_HEIGHT/2
+
+    in_band = (slice_bottom < points[:,2]) & (points[:,2] < slice_top)
+    counts = np.add.reduceat(in_band, starts, dtype=np.int64)
+
+    return points[in_band], np.concatenate([[0], np.cumsum(counts)])
+
+def estimate_batches(band, offsets, tree_ids, batches):
+    # Returns (tree index, (dbh_estimates, error)) for every tree in the batches
+    results = []
+
+    for batch in batches:
+        slices = [band[offsets[i]:offsets[i+1]] for i in batch]
+
+        # Cluster the whole batch for every k at once, then fit a circle to every cluster at once
+        points, valid, origins = utils.kmeans.pad_points(slices)
+        draws = np.array([np.random.default_rng([RANDOM_SEED, int(tree_ids[i])]).random(MAX_TRUNKS) for i in batch])
+        labels = utils.kmeans.batched_kmeans(points, valid, MAX_TRUNKS, draws)
+        circles = fit_cluster_circles(points, labels, origins)
+
+        for j, i in enumerate(batch):
+            log.debug(f'Analyzing tree {int(tree_ids[i])}')
+
+            with log.indent():
+                clusters_by_k = {k: tuple(values[j] for values in circles[k]) for k in circles}
+                results.append( (i, estimate_dbh_for_tree(len(slices[j]), clusters_by_k)) )
+
+    return results
 
-def estimate_dbh_for_tree(tree):
+def fit_cluster_circles(points, labels, origins):
+    '''
+    Fit a trunk circle to every cluster of every tree in a batch with one call. Returns a dict
+    mapping k to (point counts, centres, diameters, deviations) of that k's clusters, with
+    shapes (B, k), (B, k, 2), (B, k) and (B, k).
+    '''
+    candidates = [(k, cluster) for k in range(1, MAX_TRUNKS+1) for cluster in range(k)]
+    members = np.stack([labels[k-1] == cluster for k, cluster in candidates])
+    candidate_count, batch, length = members.shape
+
+    # Now that clustering has rejected other trees, we can operate in 2D
+    flat_points = np.broadcast_to(points[None, :, :, 0:2], (candidate_count, batch, length, 2)).reshape(-1, length, 2)
+    centres, radii, residuals = utils.circle_fit.fit_circles(flat_points, members.reshape(-1, length), CIRCLE_FIT_METHOD, CIRCLE_FIT_ROBUST_ITERATIONS)
+
+    counts = members.sum(axis=2)
+    centres = centres.reshape(candidate_count, batch, 2) + origins[None, :, 0:2]
+    diameters = 2 * radii.reshape(candidate_count, batch)
+    residuals = residuals.reshape(candidate_count, batch)
+
+    circles = {}
+    for k in range(1, MAX_TRUNKS+1):
+        first = k*(k-1)//2
+        clusters = slice(first, first + k)
+        circles[k] = (counts[clusters].T, centres[clusters].transpose(1, 0, 2), diameters[clusters].T, residuals[clusters].T)
+
+    return circles
+
+def tree_batches(offsets):
+    '''
+    Group similarly sized trees so padding to the largest in each batch wastes little. The
+    batches only depend on the data, and workers are handed whole batches, so results are
+    bit-for-bit the same however many workers there are.
+    '''
+    sizes = np.diff(offsets)
+    batches = []
+    batch = []
+    for i in np.argsort(sizes, kind='stable'):
+        size = max(sizes[i], 1)
+        if batch and (len(batch) + 1) * size > POINTS_PER_BATCH:
+            batches.append(batch)
+            batch = []
+        batch.append(int(i))
+    if batch:
+        batches.append(batch)
+    return batches
+
+# Set in each worker process by init_worker
+worker_state = {}
+
+def init_worker(memory_name, shape, dtype, offsets, tree_ids, log_level):
+    log.setLevel(log_level)
+
+    # Attach to the band points the parent put in shared memory, rather than unpickling a copy per task
+    memory = SharedMemory(name=memory_name)
+    worker_state['memory'] = memory
+    worker_state['band'] = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+    worker_state['offsets'] = offsets
+    worker_state['tree_ids'] = tree_ids
+
+def estimate_worker_batches(batches):
+    # Along with the results, this worker's usage so far, which the parent adds to the stage's metrics
+    results = estimate_batches(worker_state['band'], worker_state['offsets'], worker_state['tree_ids'], batches)
+    return results, os.getpid(), resource.getrusage(resource.RUSAGE_SELF)
+
+def estimate_batches_in_parallel(band, offsets, tree_ids, batches, workers):
+    # Hand out runs of batches with roughly equal point counts, a few per worker to balance load
+    task_count = max(workers * 4, int(np.ceil(offsets[-1] / POINTS_PER_TASK)))
+    sizes = np.diff(offsets)
+    batch_points = np.cumsum([sizes[batch].sum() for batch in batches])
+    cuts = np.searchsorted(batch_points, np.linspace(0, batch_points[-1], task_count + 1)[1:-1])
+    bounds = np.unique(np.concatenate([[0], cuts, [len(batches)]]))
+    tasks = [batches[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+    log.info(f'Spreading {len(tree_ids)} trees over {workers} workers')
+
+    memory = SharedMemory(create=True, size=max(band.nbytes, 1))
+    try:
+        np.ndarray(band.shape, dtype=band.dtype, buffer=memory.buf)[:] = band
+
+        initargs = (memory.name, band.shape, band.dtype, offsets, tree_ids, log.inner.getEffectiveLevel())
+        # Spawned rather than forked: this usually runs on one of the pipeline's threads, and a
+        # fork would copy whatever locks the other stages' threads hold at that moment
+        tic = time.perf_counter()
+        estimates = []
+        usage_by_worker = {}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                                    initializer=init_worker, initargs=initargs) as executor:
+            for results, pid, usage in executor.map(estimate_worker_batches, tasks):
+                estimates.extend(results)
+                # Usage is cumulative, so a worker's last report covers all of its tasks
+                if pid not in usage_by_worker or usage.ru_utime + usage.ru_stime > usage_by_worker[pid].ru_utime + usage_by_worker[pid].ru_stime:
+                    usage_by_worker[pid] = usage
+
+        wall = time.perf_counter() - tic
+        for pid, usage in usage_by_worker.items():
+            utils.run_report.add_child(['dbh worker', pid], wall, usage)
+        return estimates
+    finally:
+        memory.close()
+        memory.unlink()
+
+def estimate_dbh_for_tree(point_count, clusters_by_k):
     '''
     Here's the plan:
-    0. Filter for data in the vague region of chest height
+    0. Filter for data in the vague region of chest height (see breast_height_band)
     1. Assume that we have captured k = 1..4 trees trunks in the segmented data
-    2. Segment the data into k clusters
-    3. Take the biggest cluster
-    4. Validation checks
+    2. Segment the data into k clusters (see utils.kmeans)
+    3. Fit a circle to every cluster, down-weighting outliers (see utils.circle_fit)
+    Steps 2 and 3 are done for whole batches of trees up front (see estimate_batches);
+    clusters_by_k maps k to the point counts, centres, diameters and deviations of its clusters.
+    4. Take the biggest cluster
+    5. Validation checks
         - Are there enough points? Set an arbitrary threshold at 50
         - Is the standard deviation reasonable?
-    5. Reject outliers
-    6. Generate circle from cluster location + average distance
-    7. Rank guesses. Score by
+    6. Rank guesses. Score by
         - num points in cluster
-        - sandard deviation in distance from cluster
+        - sandard deviation in distance from circle
 
     '''    
 
-            # 0. Look at only the "chest high" section of the data 
-        # Convert to np array
-    
-    # convert to np array
-    tree = np.array([tree['x'], tree['y'], tree['z']])
-    
-    # Slice and filter
-    slice_top = BREAST_HEIGHT + SEARCH_REGION_HEIGHT/2
-    slice_bottom = BREAST_HEIGHT - SEARCH_REGION_HEIGHT/2
-
-    mask = np.vectorize(lambda z: slice_bottom < z and z < slice_top)(tree[2])
-    tree_slice = tree.T[mask]
-
-
     # Catch empty point cloud
-    if len(tree_slice) == 0:
+    if point_count == 0:
         return None, ('No points at chest height', 0)
     
 
@@ -160,7 +323,7 @@ def estimate_dbh_for_tree(tree):
 
         log.debug(f'Trying {k} clusters')
         with log.indent():
-            result = estimate_dbh_for_tree_with_clusters(tree_slice, k)
+            result = estimate_dbh_for_tree_with_clusters(k, *clusters_by_k[k])
         
         # function may return None if it did no work. else, unpack
         if not result:
@@ -174,9 +337,9 @@ def estimate_dbh_for_tree(tree):
             errors.append( [error_at_k, *metrics_at_k] )
 
     
-    # 8. Rank guesses by
+    # 6. Rank guesses by
     #    - num points in cluster
-    #    - sandard deviation in distance from cluster
+    #    - sandard deviation in distance from circle
 
     def score_function(num_points, sigma):
         return num_points*POINTS_WEIGHT + sigma*DEVIATION_WEIGHT
@@ -203,49 +366,29 @@ def estimate_dbh_for_tree(tree):
         log.debug(f'Returning set { np.argmax(scores) }')
         return None, errors[ np.argmax(scores) ][0]
 
-def estimate_dbh_for_tree_with_clusters(tree_slice, k):
+def estimate_dbh_for_tree_with_clusters(k, cluster_point_count, centres, diameters, deviations):
     guesses_at_k = []
     error_at_k = None
     metrics_at_k = None
 
-    # 2. Segment into k clusters - to reject other trees as best we can, we will run clustering in 3D
-    # Suppress scipy warnings (why is this so hard!!)
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        _, point_labels = kmeans2(tree_slice, k, minit='++')
-    
-    # Continue on empty cluster (no nead to repeat work done at k-1)
-    if len(np.unique(point_labels)) < k:
+    # Continue on empty cluster, which only happens with fewer than k points (no nead to repeat work done at k-1)
+    if np.any(cluster_point_count == 0):
         return None
     
-    cluster_labels, cluster_point_count = np.unique(point_labels, return_counts=True)
-    biggest_cluster_label = cluster_labels[ np.argmax(cluster_point_count) ]
+    biggest_cluster_label = np.argmax(cluster_point_count)
     
 
-    # 3. Iterate through clusters to get all trunks (even though there should only be one)
-    for cluster_label in cluster_labels:
-        points_in_cluster = tree_slice[ point_labels==cluster_label ]
+    # 4. Iterate through clusters to get all trunks (even though there should only be one)
+    for cluster_label in range(k):
+        point_count = cluster_point_count[cluster_label]
         is_biggest_cluster = cluster_label == biggest_cluster_label
 
-
-        # 4. Compute metrics
-        # Flatten - Now that we have rejected other trees, we can operate in 2D
-        points_in_cluster_2d = points_in_cluster[:,0:2]
-        
-        # Calculate center
-        centroid_2d = points_in_cluster_2d.mean(axis=0)
-        
-        # Calculate distance to center
-        point_distances_from_centroid = np.linalg.norm( points_in_cluster_2d - centroid_2d, axis=1 )
-
-        # Calculate std_dev( distance to center )
-        standard_deviation = np.std(point_distances_from_centroid)
-
-        # Calcluate radius
-        diameter = 2*np.mean(point_distances_from_centroid)
+        # RMS distance of the cluster's points from its fitted circle
+        standard_deviation = deviations[cluster_label]
+        diameter = diameters[cluster_label]
 
         if is_biggest_cluster:
-            metrics_at_k = [ len(points_in_cluster), standard_deviation ]
+            metrics_at_k = [ point_count, standard_deviation ]
 
 
         
@@ -255,17 +398,18 @@ def estimate_dbh_for_tree_with_clusters(tree_slice, k):
         #    - Is the estimated size feasible?
         # If we find the largest cluster to be invalid, halt function, else continue looking at other clusters
         
-        if len(points_in_cluster) < MIN_POINTS_FOR_ESTIMATE:
-            log.debug(f'GUESS {cluster_label} REJECTED - INSUFFICIENT POINTS: {len(points_in_cluster)}')
+        if point_count < MIN_POINTS_FOR_ESTIMATE:
+            log.debug(f'GUESS {cluster_label} REJECTED - INSUFFICIENT POINTS: {point_count}')
             
             if is_biggest_cluster:
                 log.debug(f'Failed to find estimate with {k} clusters')
-                error_at_k = ('Insufficient points', len(points_in_cluster))
+                error_at_k = ('Insufficient points', point_count)
                 break
 
             continue
         
-        if standard_deviation > MAX_ESTIMATE_STANDARD_DEVIATION:
+        # A degenerate fit (e.g. collinear points) has no finite deviation
+        if not np.isfinite(standard_deviation) or standard_deviation > MAX_ESTIMATE_STANDARD_DEVIATION:
             log.debug(f'GUESS {cluster_label} REJECTED - EXCESSIVE DEVIATION: {standard_deviation}')
             
             if is_biggest_cluster:
@@ -295,41 +439,21 @@ def estimate_dbh_for_tree_with_clusters(tree_slice, k):
             
             continue
 
-        
-        # 6. Reject outliers by two-sigma
-        points_in_cluster_2d_filtered = points_in_cluster_2d[ (point_distances_from_centroid - (diameter/2)) < 2*standard_deviation ]
-
-        # 7. Re-Generate circle from cluster location + average distance
-        final_centroid_2d = points_in_cluster_2d_filtered.mean(axis=0)
-        final_point_distances = np.linalg.norm( points_in_cluster_2d_filtered - final_centroid_2d, axis=1 )
-        final_diameter = 2*np.mean(final_point_distances)
-
-        guesses_at_k.append( (*final_centroid_2d, final_diameter) )
+        guesses_at_k.append( (*centres[cluster_label], diameter) )
 
 
     return guesses_at_k, error_at_k, metrics_at_k
 
 def get_canopy_height_at_locations(dbh_list, chm_file, dem_file):
-    
-    heights = []
-    
-    # Load CHM
-    # TODO: I should only load this once, instead of loading it into memory every tree
-    with rasterio.open(chm_file) as chm, rasterio.open(dem_file) as dem:
-        chm_data = chm.read(1)
-        dem_data = dem.read(1)
-
-        for dhm in dbh_list:
-            # Get tree height
-            # .index converts geospatial coords to pixel index
-
-            canopy_base_height = chm_data[ chm.index(dhm[0], dhm[1]) ]
-            elevation = dem_data[ dem.index(dhm[0], dhm[1]) ]
-
-            heights.append( canopy_base_height - elevation )
-
-    return heights
+    # Sample both rasters at every stem at once, reading only the blocks under stems
+    if not dbh_list:
+        return []
+    x, y = np.array([dbh[0:2] for dbh in dbh_list], dtype=float).T
+    canopy_base_height, elevation = utils.geotiff_utils.sample_rasters([chm_file, dem_file], x, y)
 
+    # Stems off either raster, or on nodata, get no height
+    heights = canopy_base_height - elevation
+    return list(heights.astype(np.result_type(heights.dtype, np.float32)).filled(np.nan))
 
 
 if __name__ == '__main__':
@@ -338,6 +462,7 @@ if __name__ == '__main__':
     parser.add_argument('-v', action='count')
     parser.add_argument('--verbosity', type=int, default=0)
     parser.add_argument('--visualize', action='store_true')
+    parser.add_argument('--workers', type=int, default=1, help='Processes to estimate trees with (default: %(default)s)')
 
     parser.add_argument('--input_path', action=utils.argument_actions.StorePathAction, default=Path('data/output/illinois_utm/illinois_utm_segmented.las'))
     parser.add_argument('--chm_path', action=utils.argument_actions.StorePathAction, default=Path('data/output/illinois_utm/illinois_utm_chm.tif'))
@@ -363,4 +488,4 @@ if __name__ == '__main__':
     # - confirm paths are correct types (load chm object)
 
 
-    generate_dbh(args.input_path, args.chm_path, args.dem_path, args.output_path)
\ No newline at end of file
+    generate_dbh(args.input_path, args.chm_path, args.dem_path, args.output_path, args.workers)
\ No newline at end of file
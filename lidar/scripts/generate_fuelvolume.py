@@ -1,14 +1,53 @@
+import utils.cog
+import utils.geotiff_utils
+import utils.gridding
+import utils.voxels
+
 import laspy
 import numpy as np
 import rasterio
+import rasterio.windows
 from rasterio.transform import from_origin
-from scipy.stats import binned_statistic_2d
+import contextlib
 import sys
+import tempfile
 from pathlib import Path
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
 from matplotlib.colors import Normalize
 
+# Points read at a time when streaming a cloud into a grid
+POINTS_PER_CHUNK = 5_000_000
+# Raster rows computed and written at a time
+ROWS_PER_WINDOW = 1024
+# Bytes per cell of a utils.gridding.GridMoments: an int64 count and float64 mean and deviations
+MOMENT_BYTES_PER_CELL = 24
+# Bytes per cell held while gridding fuel volume: the moments of each of two clouds
+GRID_BYTES_PER_CELL = 2 * MOMENT_BYTES_PER_CELL
+# Rough bytes per point of a chunk in flight (the raw record, scaled coordinates and cell indices)
+CHUNK_BYTES_PER_POINT = 100
+
+# Per-cell statistics of point heights written by compute_height_statistics
+HEIGHT_STATISTICS = ['count', 'min', 'max', 'mean', 'std', 'p50', 'p95']
+# Default memory budget for statistics that need a cell's points sorted, which bands of rows are sized to
+HEIGHT_STATISTICS_MEMORY = 2 * 1024**3
+# Rough bytes per point of a band being reduced (the spilled cell and height, the sort order and sorted copies)
+SPILLED_BYTES_PER_POINT = 64
+
+# Height of a voxel in metres; voxels are one grid cell across
+VOXEL_HEIGHT = 0.5
+# Vertical fuel strata, each running from the height above ground (m) it starts at up to the next;
+# voxels centred lower than the first stratum are ground
+FUEL_STRATA = [('surface', 0.25), ('ladder', 1.0), ('canopy', 4.0)]
+# Bands of the fuel strata raster, all in cubic metres per cell
+STRATA_BANDS = ['removed_volume'] + [f'{name}_before' for name, _ in FUEL_STRATA] + [f'{name}_change' for name, _ in FUEL_STRATA]
+# Default memory budget for the voxel engine, which it sizes its tiles to
+FUEL_STRATA_MEMORY = 2 * 1024**3
+# Rough bytes per voxel of both clouds while a tile is processed (keys, unpacked coordinates, scratch)
+VOXEL_BYTES = 96
+# Tiles are never cut smaller than this many cells a side
+MIN_STRATA_TILE = 64
+
 def load_las_or_laz(filepath):
     if not filepath.exists():
         raise FileNotFoundError(f"File not found: {filepath}")
@@ -22,36 +61,262 @@ def find_las_or_laz(base_path, stem):
             return file_path
     raise FileNotFoundError(f"Could not find {stem}.las or {stem}.laz in {base_path}")
 
+def estimate_grid_memory(filepaths, resolution=1.0):
+    # Memory compute_fuel_volume needs for the grid over these clouds and one chunk of points, for budgeting stages
+    filepaths = [filepath for filepath in filepaths if filepath is not None and filepath.exists()]
+    if not filepaths:
+        return 0
+    x_bins, y_bins = utils.gridding.grid_edges(*utils.gridding.header_bounds(filepaths), resolution)
+    return (len(x_bins) - 1) * (len(y_bins) - 1) * GRID_BYTES_PER_CELL + POINTS_PER_CHUNK * CHUNK_BYTES_PER_POINT
+
+def statistics_band_rows(filepaths, width, height, memory):
+    '''
+    Raster rows per band for stream_statistics such that a band's points, of every cloud,
+    fit in the memory budget when sorted, assuming points are spread evenly.
+    '''
+    point_count = 0
+    for filepath in filepaths:
+        with laspy.open(filepath) as lasf:
+            point_count += lasf.header.point_count
+    points_per_row = max(point_count / height, 1e-9)
+    return int(np.clip(memory / (SPILLED_BYTES_PER_POINT * points_per_row), 1, height))
+
+def stream_statistics(filepath, x_bins, y_bins, statistics, rows_per_band=ROWS_PER_WINDOW, spill_directory=None):
+    '''
+    Per-cell statistics of a cloud's point heights, read chunk by chunk. Yields (rows, grids)
+    for each band of rows_per_band raster rows, top to bottom, where rows is a slice of raster
+    rows and grids a dict of flat grids of the band's cells, like utils.gridding.grid_statistics.
+
+    count, sum, mean and std are accumulated over the whole grid in a single pass, so memory
+    depends on the grid and not on the number of points. min, max and percentiles need all of
+    a cell's values at once, so for those the pass spills (cell, z) pairs to per-band files
+    in a temporary folder in spill_directory, and each band is read back and reduced on its
+    own, holding one band's points at a time.
+    '''
+    width, height = len(x_bins) - 1, len(y_bins) - 1
+    band_cells = rows_per_band * width
+    moment_statistics = [statistic for statistic in statistics if statistic in utils.gridding.MOMENT_STATISTICS]
+    order_statistics = [statistic for statistic in statistics if statistic not in utils.gridding.MOMENT_STATISTICS]
+
+    spilling = tempfile.TemporaryDirectory(dir=spill_directory, prefix='statistics_') if order_statistics else contextlib.nullcontext()
+    with spilling as spill:
+        moments = utils.gridding.GridMoments(width * height) if moment_statistics else None
+        with laspy.open(filepath) as lasf:
+            for points in lasf.chunk_iterator(POINTS_PER_CHUNK):
+                cells = utils.gridding.cell_indices(np.asarray(points.x), np.asarray(points.y), x_bins, y_bins)
+                z = np.asarray(points.z)
+                if moments is not None:
+                    moments.add(cells, z)
+                if order_statistics:
+                    utils.gridding.spill_bands(cells, z, spill, 'points', band_cells)
+
+        for band, row in enumerate(range(0, height, rows_per_band)):
+            rows = slice(row, min(row + rows_per_band, height))
+            cells = slice(rows.start * width, rows.stop * width)
+            grids = moments.statistics(moment_statistics, cells) if moments is not None else {}
+            if order_statistics:
+                band_cell_ids, values = utils.gridding.load_band(spill, 'points', band)
+                grids.update(utils.gridding.grid_statistics(band_cell_ids - cells.start, values, cells.stop - cells.start, order_statistics))
+            yield rows, {statistic: grids[statistic] for statistic in statistics}
+
 def compute_density_grid(points, xmin, xmax, ymin, ymax, resolution, stat='count'):
-    xmin = np.floor(xmin)
-    xmax = np.ceil(xmax)
-    ymin = np.floor(ymin)
-    ymax = np.ceil(ymax)
-
-    if (xmax - xmin) / resolution > 10000 or (ymax - ymin) / resolution > 10000:
-        raise ValueError("Bounding box too large. Check input data or resolution.")
-
-    x_bins = np.arange(xmin, xmax + resolution, resolution)
-    y_bins = np.arange(ymin, ymax + resolution, resolution)
-
-    values = None
-    if stat == 'count':
-        values = None
-    elif stat in ('mean', 'sum'):
-        values = points[:, 2]  # Z values
-    else:
-        raise ValueError(f"Unsupported stat: {stat}")
-
-    grid, _, _, _ = binned_statistic_2d(
-        points[:, 1], points[:, 0],  # y, x
-        values,
-        statistic=stat,
-        bins=[y_bins, x_bins]
-    )
-    return grid, x_bins, y_bins
-
-def compute_fuel_volume(before_file, after_file, output_file, resolution=1.0):
-    resolution = 1.0
+    '''
+    Grid (N, 3) points onto cells of the given resolution. stat is one statistic of the
+    points' Z (see utils.gridding.STATISTICS, plus percentiles like 'p95'), or a list of
+    them, which are all computed in one pass and returned as a dict of grids. Grids are
+    indexed [y, x] with y ascending, like binned_statistic_2d.
+    '''
+    x_bins, y_bins = utils.gridding.grid_edges(xmin, xmax, ymin, ymax, resolution)
+    shape = (len(y_bins) - 1, len(x_bins) - 1)
+
+    statistics = [stat] if isinstance(stat, str) else list(stat)
+    cells = utils.gridding.cell_indices(points[:, 0], points[:, 1], x_bins, y_bins)
+    grids = utils.gridding.grid_statistics(cells, points[:, 2], shape[0] * shape[1], statistics)
+    grids = {name: np.flipud(grid.reshape(shape)) for name, grid in grids.items()}
+
+    return (grids[stat] if isinstance(stat, str) else grids), x_bins, y_bins
+
+def compute_height_statistics(las_file, output_file, resolution=1.0, statistics=HEIGHT_STATISTICS, memory=HEIGHT_STATISTICS_MEMORY):
+    '''
+    Write a QA raster with one band per statistic of the point heights in each cell, all
+    computed in a single streaming pass over the points (see stream_statistics) and written a
+    band of rows at a time, with bands sized to fit the memory budget.
+    '''
+    with laspy.open(las_file) as lasf:
+        crs = lasf.header.parse_crs()
+        crs_wkt = crs.to_wkt() if crs is not None else "EPSG:32610"  # Same fallback as compute_fuel_volume
+
+    x_edges, y_edges = utils.gridding.grid_edges(*utils.gridding.header_bounds([las_file]), resolution)
+    height, width = len(y_edges) - 1, len(x_edges) - 1
+    # The moments of the whole grid are held throughout; bands of spilled points get the rest
+    if any(statistic in utils.gridding.MOMENT_STATISTICS for statistic in statistics):
+        memory -= width * height * MOMENT_BYTES_PER_CELL
+    rows_per_band = statistics_band_rows([las_file], width, height, max(memory, 0))
+
+    nodata_val = -9999.0
+    with utils.cog.open_cog(
+        output_file,
+        height=height,
+        width=width,
+        count=len(statistics),
+        dtype=np.float32,
+        crs=crs_wkt,
+        transform=from_origin(x_edges[0], y_edges[-1], resolution, resolution),
+        nodata=nodata_val
+    ) as dst:
+        for band, statistic in enumerate(statistics, 1):
+            dst.set_band_description(band, statistic)
+
+        for rows, grids in stream_statistics(las_file, x_edges, y_edges, statistics, rows_per_band, Path(output_file).parent):
+            window = rasterio.windows.Window(0, rows.start, width, rows.stop - rows.start)
+            for band, statistic in enumerate(statistics, 1):
+                grid = grids[statistic].reshape(window.height, width).astype(np.float32)
+                grid[np.isnan(grid)] = nodata_val
+                dst.write(grid, band, window=window)
+
+    print(f"✅ Saved: {output_file}")
+
+def strata_tile_size(filepaths, width, height, memory):
+    '''
+    Side, in cells, of square tiles whose voxels (of every cloud) fit in the memory budget,
+    assuming points are spread evenly. Every point could be its own voxel, so this errs large.
+    '''
+    point_count = 0
+    for filepath in filepaths:
+        with laspy.open(filepath) as lasf:
+            point_count += lasf.header.point_count
+    points_per_cell = max(point_count / (width * height), 1e-9)
+    tile_size = int(np.sqrt(memory / (VOXEL_BYTES * points_per_cell)))
+    return int(np.clip(tile_size, MIN_STRATA_TILE, max(width, height, MIN_STRATA_TILE)))
+
+def spill_voxels(filepath, name, spill_directory, x_edges, y_edges, zmin, voxel_height, tile_size):
+    # One streaming pass over a cloud, spilling the voxels its points occupy to per-tile files
+    width = len(x_edges) - 1
+    tiles_across = -(-width // tile_size)
+
+    with laspy.open(filepath) as lasf:
+        for points in lasf.chunk_iterator(POINTS_PER_CHUNK):
+            cells = utils.gridding.cell_indices(np.asarray(points.x), np.asarray(points.y), x_edges, y_edges)
+            on_grid = cells >= 0
+            levels = np.floor((np.asarray(points.z)[on_grid] - zmin) / voxel_height)
+            levels = np.clip(levels, 0, utils.voxels.MAX_LEVEL).astype(np.int64)
+            keys = utils.voxels.pack_keys(cells[on_grid] % width, cells[on_grid] // width, levels)
+            utils.voxels.spill_keys(keys, spill_directory, name, tile_size, tiles_across)
+
+def strata_volumes(keys, window, ground, zmin, voxel_height, voxel_volume):
+    '''
+    Occupied volume per (cell, stratum) of a tile's voxels, as a (cells, strata) array, and
+    which of the tile's cells hold any voxel at all (ground included), i.e. were observed.
+    '''
+    cell_count = window.height * window.width
+    columns, rows, levels = utils.voxels.unpack_keys(keys)
+    cells = (rows - window.row_off) * window.width + (columns - window.col_off)
+    observed = np.bincount(cells, minlength=cell_count) > 0
+
+    heights = zmin + (levels + 0.5) * voxel_height - ground[cells]
+    strata = np.digitize(heights, [bottom for _, bottom in FUEL_STRATA])
+    # NaN heights (no ground) digitize past the top stratum
+    fuel = (strata > 0) & np.isfinite(heights)
+    volumes = np.bincount(cells[fuel] * len(FUEL_STRATA) + strata[fuel] - 1, minlength=cell_count * len(FUEL_STRATA))
+
+    return volumes.reshape(cell_count, len(FUEL_STRATA)) * voxel_volume, observed
+
+def compute_fuel_strata(before_file, after_file, dem_file, output_file, resolution=1.0, voxel_height=VOXEL_HEIGHT, memory=FUEL_STRATA_MEMORY):
+    '''
+    Voxelise both clouds into sparse occupancy (packed voxel keys, see utils.voxels) and
+    rasterise, per cell, the volume of voxels occupied before and empty after, the occupied
+    volume of each fuel stratum before, and its change from before to after (after - before).
+
+    Each cloud is read once, with its voxels spilled to per-tile files on disk; tiles are
+    then processed one at a time and written as windows, so memory is bounded by the tile
+    size, which is picked to fit the memory budget.
+    '''
+    for filepath in (before_file, after_file):
+        if not Path(filepath).exists():
+            raise FileNotFoundError(f"File not found: {filepath}")
+
+    with laspy.open(before_file) as lasf:
+        crs = lasf.header.parse_crs()
+        crs_wkt = crs.to_wkt() if crs is not None else "EPSG:32610"  # Same fallback as compute_fuel_volume
+        zmin = lasf.header.mins[2]
+    with laspy.open(after_file) as lasf:
+        zmin = min(zmin, lasf.header.mins[2])
+
+    x_edges, y_edges = utils.gridding.grid_edges(*utils.gridding.header_bounds([before_file, after_file]), resolution)
+    height, width = len(y_edges) - 1, len(x_edges) - 1
+    if width > utils.voxels.MAX_COLUMN or height > utils.voxels.MAX_ROW:
+        raise ValueError(f"Grid of {width} x {height} cells is too large for voxel keys")
+
+    tile_size = strata_tile_size([before_file, after_file], width, height, memory)
+    tiles_across, tiles_down = -(-width // tile_size), -(-height // tile_size)
+    print(f"Voxelising onto {width} x {height} columns in {tiles_across * tiles_down} tiles")
+
+    transform = from_origin(x_edges[0], y_edges[-1], resolution, resolution)
+    voxel_volume = resolution * resolution * voxel_height
+    nodata_val = -9999.0
+
+    # Spill next to the output rather than in /tmp, which may be small
+    with tempfile.TemporaryDirectory(dir=Path(output_file).parent, prefix='voxels_') as spill_directory:
+        for name, filepath in (('before', before_file), ('after', after_file)):
+            spill_voxels(filepath, name, spill_directory, x_edges, y_edges, zmin, voxel_height, tile_size)
+
+        with utils.cog.open_cog(
+            output_file,
+            height=height,
+            width=width,
+            count=len(STRATA_BANDS),
+            dtype=np.float32,
+            crs=crs_wkt,
+            transform=transform,
+            nodata=nodata_val
+        ) as dst, rasterio.open(dem_file) as dem:
+            for band, description in enumerate(STRATA_BANDS, 1):
+                dst.set_band_description(band, description)
+
+            for tile in range(tiles_across * tiles_down):
+                tile_row, tile_col = divmod(tile, tiles_across)
+                window = rasterio.windows.Window(tile_col * tile_size, tile_row * tile_size,
+                                                 min(tile_size, width - tile_col * tile_size),
+                                                 min(tile_size, height - tile_row * tile_size))
+
+                # Ground under the centre of every column of the tile
+                columns, rows = np.meshgrid(np.arange(window.width) + window.col_off, np.arange(window.height) + window.row_off)
+                x, y = transform * (columns.ravel() + 0.5, rows.ravel() + 0.5)
+                ground = utils.geotiff_utils.sample_raster(dem, x, y).astype(float).filled(np.nan)
+
+                before = utils.voxels.load_tile_keys(spill_directory, 'before', tile)
+                after = utils.voxels.load_tile_keys(spill_directory, 'after', tile)
+                removed = before[~np.isin(before, after, assume_unique=True)]
+
+                arguments = (window, ground, zmin, voxel_height, voxel_volume)
+                before_volumes, before_observed = strata_volumes(before, *arguments)
+                after_volumes, after_observed = strata_volumes(after, *arguments)
+                removed_volumes, _ = strata_volumes(removed, *arguments)
+
+                # Strata need ground; change needs both clouds
+                has_ground = np.isfinite(ground)
+                before_valid = before_observed & has_ground
+                both_valid = before_valid & after_observed
+
+                bands = np.full((len(STRATA_BANDS), window.height * window.width), nodata_val, dtype=np.float32)
+                bands[0, both_valid] = removed_volumes[both_valid].sum(axis=1)
+                bands[1:1+len(FUEL_STRATA), before_valid] = before_volumes[before_valid].T
+                bands[1+len(FUEL_STRATA):, both_valid] = (after_volumes - before_volumes)[both_valid].T
+
+                dst.write(bands.reshape(len(STRATA_BANDS), window.height, window.width), window=window)
+
+    print(f"✅ Saved: {output_file}")
+
+def compute_fuel_volume(before_file, after_file, output_file, resolution=1.0, show_plot=False):
+    '''
+    Rasterise the drop in mean height per cell from the before cloud to the after cloud.
+    Both clouds are streamed from disk through stream_statistics, so memory is bounded by
+    the size of the grid rather than the number of points.
+    '''
+    for filepath in (before_file, after_file):
+        if not Path(filepath).exists():
+            raise FileNotFoundError(f"File not found: {filepath}")
+
     with laspy.open(before_file) as lasf:
         crs = lasf.header.parse_crs()
         if crs is not None:
@@ -59,47 +324,47 @@ def compute_fuel_volume(before_file, after_file, output_file, resolution=1.0):
         else:
             crs_wkt = "EPSG:32610"  # fallback if CRS not found. Only correct for parts of Western US/Canada!
 
-    before_pts = load_las_or_laz(before_file)
-    after_pts = load_las_or_laz(after_file)
-
-    all_x = np.hstack((before_pts[:, 0], after_pts[:, 0]))
-    all_y = np.hstack((before_pts[:, 1], after_pts[:, 1]))
-    xmin, xmax = all_x.min(), all_x.max()
-    ymin, ymax = all_y.min(), all_y.max()
-
-    before_grid, x_edges, y_edges = compute_density_grid(before_pts, xmin, xmax, ymin, ymax, resolution, stat='mean')
-    after_grid, _, _ = compute_density_grid(after_pts, xmin, xmax, ymin, ymax, resolution, stat='mean')
-    diff_grid = after_grid - before_grid
-    diff_grid = np.where(np.isnan(diff_grid), 0, diff_grid)  # or use np.nanmean when binning
+    x_edges, y_edges = utils.gridding.grid_edges(*utils.gridding.header_bounds([before_file, after_file]), resolution)
+    height, width = len(y_edges) - 1, len(x_edges) - 1
+    print(f"Gridding onto {width} x {height} cells")
 
     transform = from_origin(x_edges[0], y_edges[-1], resolution, resolution)
 
     nodata_val = -9999.0
-    # Cells that are valid in both before and after
-    valid_mask = ~np.isnan(before_grid) & ~np.isnan(after_grid)
-
-    # Compute difference only where both are valid
-    diff_grid = np.full(before_grid.shape, nodata_val, dtype=np.float32)
-    diff_grid[valid_mask] = before_grid[valid_mask] - after_grid[valid_mask]
-
-    diff_grid = np.flipud(diff_grid)  # Flip the grid to match the rasterio convention
-
-    with rasterio.open(
-        output_file, "w",
-        driver="GTiff",
-        height=diff_grid.shape[0],
-        width=diff_grid.shape[1],
+    # Mean heights are only kept whole for the plot
+    before_means, after_means = [], []
+    with utils.cog.open_cog(
+        output_file,
+        height=height,
+        width=width,
         count=1,
-        dtype=diff_grid.dtype,
+        dtype=np.float32,
         crs=crs_wkt,
         transform=transform,
         nodata=nodata_val
     ) as dst:
-        dst.write(diff_grid, 1)
+        # Both clouds are gridded in full first, then the difference is written a band of rows at a time
+        for (rows, before), (_, after) in zip(stream_statistics(before_file, x_edges, y_edges, ['count', 'mean']),
+                                              stream_statistics(after_file, x_edges, y_edges, ['count', 'mean'])):
+            # Difference only where cells are valid in both before and after
+            valid_mask = (before['count'] > 0) & (after['count'] > 0)
+            diff_window = np.full(before['mean'].shape, nodata_val, dtype=np.float32)
+            diff_window[valid_mask] = before['mean'][valid_mask] - after['mean'][valid_mask]
 
+            dst.write(diff_window.reshape(rows.stop - rows.start, width), 1, window=rasterio.windows.Window(0, rows.start, width, rows.stop - rows.start))
+            if show_plot:
+                before_means.append(before['mean'].reshape(-1, width))
+                after_means.append(after['mean'].reshape(-1, width))
 
     print(f"✅ Saved: {output_file}")
 
+    if show_plot:
+        plot_fuel_volume(np.vstack(before_means), np.vstack(after_means), output_file, nodata_val)
+
+def plot_fuel_volume(before_grid, after_grid, output_file, nodata_val):
+    with rasterio.open(output_file) as src:
+        diff_grid = src.read(1)
+
     # Auto compute contrast range for difference
     valid_diff = diff_grid[diff_grid != nodata_val]
     vmin_d, vmax_d = np.percentile(valid_diff, [2, 98])
@@ -109,13 +374,13 @@ def compute_fuel_volume(before_file, after_file, output_file, resolution=1.0):
     fig, axs = plt.subplots(1, 3, figsize=(15, 6))
 
     # BEFORE
-    im0 = axs[0].imshow(np.flipud(before_grid), cmap='viridis', vmin=vmin_d, vmax=vmax_d)
+    im0 = axs[0].imshow(before_grid, cmap='viridis', vmin=vmin_d, vmax=vmax_d)
     axs[0].set_title("Before Mean Height")
     axs[0].axis('off')
     fig.colorbar(im0, ax=axs[0], fraction=0.046)
 
     # AFTER
-    im1 = axs[1].imshow(np.flipud(after_grid), cmap='viridis', vmin=vmin_d, vmax=vmax_d)
+    im1 = axs[1].imshow(after_grid, cmap='viridis', vmin=vmin_d, vmax=vmax_d)
     axs[1].set_title("After Mean Height")
     axs[1].axis('off')
     fig.colorbar(im1, ax=axs[1], fraction=0.046)
@@ -133,4 +398,4 @@ if __name__ == "__main__":
     if len(sys.argv) != 4:
         print("Usage: python fuelvolume.py before.laz after.laz output.tif")
         sys.exit(1)
-    compute_fuel_volume(sys.argv[1], sys.argv[2], sys.argv[3])
+    compute_fuel_volume(Path(sys.argv[1]), Path(sys.argv[2]), Path(sys.argv[3]), show_plot=True)
@@ -0,0 +1,331 @@
+import utils.argument_actions
+
+import laspy
+import numpy as np
+import rasterio
+from fastlog import log
+from rasterio.transform import from_origin
+
+import argparse
+import json
+import math
+from pathlib import Path
+
+
+# Config Parameters
+
+# Points generated (and held in memory) per chunk while streaming a cloud to disk
+POINTS_PER_CHUNK = 2_000_000
+# UTM zone 10N, the same fallback the fuel volume step uses
+DEFAULT_EPSG = 32610
+# Lower-left corner of the synthetic plot, somewhere plausible in UTM 10N
+ORIGIN = (500_000.0, 4_400_000.0)
+
+# Share of points given to each part of the scene
+GROUND_FRACTION = 0.35
+STEM_FRACTION = 0.15
+CROWN_FRACTION = 0.38
+UNDERSTORY_FRACTION = 0.10
+NOISE_FRACTION = 0.02
+
+# Stem points are only placed this high up the trunk, as a below-canopy flight mostly sees the lower stem
+MAX_STEM_SCAN_HEIGHT = 6.0
+# Standard deviation of range noise added to every return, in meters
+RANGE_NOISE = 0.01
+
+# LAS classifications
+GROUND = 2
+LOW_VEGETATION = 3
+HIGH_VEGETATION = 5
+LOW_NOISE = 7
+
+log_level_options = [log.WARNING, log.INFO, log.DEBUG]
+
+
+def plan_forest(points, seed=0, density=100.0, trees_per_hectare=300, removal_fraction=0.3, understory_removal=0.8):
+    '''
+    Lay out the scene: a square plot sized so that `points` returns give `density` points/m²,
+    a smooth terrain surface, and trees with known position, DBH, height and crown size. Also
+    decides which trees and how much understory a treatment removes for the "after" cloud.
+    Everything is derived from the seed, so the same arguments always give the same forest.
+    '''
+    rng = np.random.default_rng(seed)
+
+    side = math.sqrt(points / density)
+    tree_count = max(1, int(round(side*side / 10_000 * trees_per_hectare)))
+
+    # Terrain: a tilted plane plus a few long-wavelength ripples
+    terrain = {
+        'base': float(rng.uniform(200, 1500)),
+        'slope': rng.uniform(-0.15, 0.15, 2).tolist(),
+        'amplitudes': rng.uniform(1, 8, 3).tolist(),
+        'wavelengths': rng.uniform(150, 600, 3).tolist(),
+        'phases': rng.uniform(0, 2*np.pi, (3, 2)).tolist(),
+    }
+
+    dbh = np.clip(rng.lognormal(np.log(0.3), 0.45, tree_count), 0.1, 1.2)
+    height = 1.3 + 30 * (1 - np.exp(-2.5 * dbh))
+    crown_base = height * rng.uniform(0.35, 0.6, tree_count)
+    crown_radius = 0.15 * height + rng.uniform(0.5, 1.5, tree_count)
+
+    return {
+        'seed': seed,
+        'points': points,
+        'density': density,
+        'bounds': (ORIGIN[0], ORIGIN[1], ORIGIN[0] + side, ORIGIN[1] + side),
+        'terrain': terrain,
+        'trees': {
+            'x': ORIGIN[0] + rng.uniform(0, side, tree_count),
+            'y': ORIGIN[1] + rng.uniform(0, side, tree_count),
+            'dbh': dbh,
+            'height': height,
+            'crown_base': crown_base,
+            'crown_radius': crown_radius,
+            'removed': rng.uniform(size=tree_count) < removal_fraction,
+        },
+        'understory_removal': understory_removal,
+    }
+
+
+def terrain_height(forest, x, y):
+    terrain = forest['terrain']
+    x = x - forest['bounds'][0]
+    y = y - forest['bounds'][1]
+
+    z = terrain['base'] + terrain['slope'][0]*x + terrain['slope'][1]*y
+    for amplitude, wavelength, (phase_x, phase_y) in zip(terrain['amplitudes'], terrain['wavelengths'], terrain['phases']):
+        z = z + amplitude * np.sin(2*np.pi*x/wavelength + phase_x) * np.cos(2*np.pi*y/wavelength + phase_y)
+    return z
+
+
+def component_counts(count):
+    fractions = [GROUND_FRACTION, STEM_FRACTION, CROWN_FRACTION, UNDERSTORY_FRACTION, NOISE_FRACTION]
+    counts = [int(count * fraction) for fraction in fractions]
+    counts[0] += count - sum(counts)
+    return counts
+
+
+def generate_chunk(forest, count, rng):
+    '''
+    Returns x, y, z, classification and treeID arrays for `count` points, plus a mask of the
+    points a treatment would remove.
+    '''
+    xmin, ymin, xmax, ymax = forest['bounds']
+    trees = forest['trees']
+    ground_count, stem_count, crown_count, understory_count, noise_count = component_counts(count)
+
+    parts = []
+
+    # Ground
+    x = rng.uniform(xmin, xmax, ground_count)
+    y = rng.uniform(ymin, ymax, ground_count)
+    parts.append((x, y, terrain_height(forest, x, y), GROUND, 0, False))
+
+    # Stems: cylinders of the true DBH, trees picked in proportion to their scanned bark area
+    scan_height = np.minimum(trees['crown_base'], MAX_STEM_SCAN_HEIGHT)
+    weights = trees['dbh'] * scan_height
+    tree = rng.choice(len(weights), stem_count, p=weights / weights.sum())
+    angle = rng.uniform(0, 2*np.pi, stem_count)
+    radius = trees['dbh'][tree] / 2
+    x = trees['x'][tree] + radius*np.cos(angle)
+    y = trees['y'][tree] + radius*np.sin(angle)
+    z = terrain_height(forest, trees['x'][tree], trees['y'][tree]) + rng.uniform(0, 1, stem_count) * scan_height[tree]
+    parts.append((x, y, z, HIGH_VEGETATION, tree + 1, trees['removed'][tree]))
+
+    # Crowns: filled cones from crown base to tree top, trees picked in proportion to crown size
+    weights = trees['crown_radius']**2 * (trees['height'] - trees['crown_base'])
+    tree = rng.choice(len(weights), crown_count, p=weights / weights.sum())
+    depth = trees['height'][tree] - trees['crown_base'][tree]
+    # Sample heights so that point density follows the cone's cross-section
+    fraction_from_top = np.sqrt(rng.uniform(0, 1, crown_count))
+    radius = trees['crown_radius'][tree] * fraction_from_top * np.sqrt(rng.uniform(0, 1, crown_count))
+    angle = rng.uniform(0, 2*np.pi, crown_count)
+    x = trees['x'][tree] + radius*np.cos(angle)
+    y = trees['y'][tree] + radius*np.sin(angle)
+    z = terrain_height(forest, trees['x'][tree], trees['y'][tree]) + trees['height'][tree] - depth*fraction_from_top
+    parts.append((x, y, z, HIGH_VEGETATION, tree + 1, trees['removed'][tree]))
+
+    # Understory: shrubs and grass up to 1.5m
+    x = rng.uniform(xmin, xmax, understory_count)
+    y = rng.uniform(ymin, ymax, understory_count)
+    z = terrain_height(forest, x, y) + rng.uniform(0.05, 1.5, understory_count)
+    parts.append((x, y, z, LOW_VEGETATION, 0, rng.uniform(size=understory_count) < forest['understory_removal']))
+
+    # Noise: birds and multipath, well above and below the scene
+    x = rng.uniform(xmin, xmax, noise_count)
+    y = rng.uniform(ymin, ymax, noise_count)
+    z = terrain_height(forest, x, y) + rng.choice([-1, 1], noise_count) * rng.uniform(5, 80, noise_count)
+    parts.append((x, y, z, LOW_NOISE, 0, False))
+
+    x = np.concatenate([part[0] for part in parts])
+    y = np.concatenate([part[1] for part in parts])
+    z = np.concatenate([part[2] for part in parts]) + rng.normal(0, RANGE_NOISE, count)
+    classification = np.concatenate([np.full(len(part[0]), part[3], dtype=np.uint8) for part in parts])
+    tree_id = np.concatenate([np.broadcast_to(part[4], len(part[0])) for part in parts]).astype(np.int32)
+    removed = np.concatenate([np.broadcast_to(part[5], len(part[0])) for part in parts])
+
+    # Shuffle so chunks look like an interleaved scan rather than sorted by component
+    order = rng.permutation(count)
+    return x[order], y[order], z[order], classification[order], tree_id[order], removed[order]
+
+
+def write_cloud(forest, path, after=False, shift=(0.0, 0.0, 0.0), tree_ids=False, epsg=DEFAULT_EPSG):
+    '''
+    Stream the forest to a LAS/LAZ file chunk by chunk, so memory use doesn't grow with the
+    point count. With after=True, the treatment's removed trees and understory are left out.
+    shift is applied through the header offsets, displacing the whole cloud exactly.
+    With tree_ids=True only tree points are kept and a treeID dimension is added, giving a
+    perfect version of what segment_las.R produces.
+    '''
+    header = laspy.LasHeader(point_format=6, version='1.4')
+    header.scales = np.array([0.001, 0.001, 0.001])
+    header.offsets = np.array([forest['bounds'][0] + shift[0], forest['bounds'][1] + shift[1], shift[2]])
+    header.add_crs(rasterio.crs.CRS.from_epsg(epsg))
+    if tree_ids:
+        header.add_extra_dim(laspy.ExtraBytesParams(name='treeID', type=np.int32))
+
+    # Every chunk has its own seeded generator, so the output only depends on the seed
+    chunk_count = math.ceil(forest['points'] / POINTS_PER_CHUNK)
+    written = 0
+
+    with laspy.open(path, mode='w', header=header) as writer:
+        for chunk_index in range(chunk_count):
+            rng = np.random.default_rng([forest['seed'], chunk_index])
+            count = min(POINTS_PER_CHUNK, forest['points'] - chunk_index*POINTS_PER_CHUNK)
+            x, y, z, classification, tree_id, removed = generate_chunk(forest, count, rng)
+
+            keep = None
+            if after:
+                keep = ~removed
+            if tree_ids:
+                keep = tree_id > 0
+            if keep is not None:
+                x, y, z, classification, tree_id = x[keep], y[keep], z[keep], classification[keep], tree_id[keep]
+
+            points = laspy.ScaleAwarePointRecord.zeros(len(x), header=header)
+            # Work in the unshifted frame and let the offsets move the cloud
+            points.X = np.round((x - forest['bounds'][0]) / header.scales[0]).astype(np.int32)
+            points.Y = np.round((y - forest['bounds'][1]) / header.scales[1]).astype(np.int32)
+            points.Z = np.round(z / header.scales[2]).astype(np.int32)
+            points.classification = classification
+            points.intensity = rng.integers(0, 65535, len(x), dtype=np.uint16)
+            if tree_ids:
+                points.treeID = tree_id
+
+            writer.write_points(points)
+            written += len(x)
+
+            log.debug(f'Wrote chunk {chunk_index+1}/{chunk_count} to {path}')
+
+    return written
+
+
+def write_rasters(forest, dem_path, chm_path, resolution=1.0, epsg=DEFAULT_EPSG):
+    # Ground truth DEM and canopy height (above ground, as generate_dem.R writes it)
+    xmin, ymin, xmax, ymax = forest['bounds']
+    width = int(math.ceil((xmax - xmin) / resolution))
+    height = int(math.ceil((ymax - ymin) / resolution))
+    transform = from_origin(xmin, ymax, resolution, resolution)
+
+    profile = dict(driver='GTiff', width=width, height=height, count=1, dtype='float32',
+                   crs=rasterio.crs.CRS.from_epsg(epsg), transform=transform, nodata=np.nan)
+
+    with rasterio.open(dem_path, 'w', **profile) as dem, rasterio.open(chm_path, 'w', **profile) as chm:
+        # Row blocks keep memory flat for large plots
+        for row in range(0, height, 256):
+            rows = min(256, height - row)
+            cols, rs = np.meshgrid(np.arange(width), np.arange(row, row + rows))
+            x = xmin + (cols + 0.5) * resolution
+            y = ymax - (rs + 0.5) * resolution
+            window = rasterio.windows.Window(0, row, width, rows)
+            dem.write(terrain_height(forest, x, y).astype('float32'), 1, window=window)
+
+        # Stamp each tree's cone into the canopy height model
+        trees = forest['trees']
+        canopy = np.zeros((height, width), dtype='float32')
+        for x, y, tree_height, crown_base, crown_radius in zip(trees['x'], trees['y'], trees['height'], trees['crown_base'], trees['crown_radius']):
+            row_min, col_min = rasterio.transform.rowcol(transform, x - crown_radius, y + crown_radius)
+            row_max, col_max = rasterio.transform.rowcol(transform, x + crown_radius, y - crown_radius)
+            row_min, col_min = max(row_min, 0), max(col_min, 0)
+            row_max, col_max = min(row_max + 1, height), min(col_max + 1, width)
+            if row_min >= row_max or col_min >= col_max:
+                continue
+
+            cols, rs = np.meshgrid(np.arange(col_min, col_max), np.arange(row_min, row_max))
+            distance = np.hypot(xmin + (cols + 0.5)*resolution - x, ymax - (rs + 0.5)*resolution - y)
+            cone = np.where(distance < crown_radius, tree_height - (tree_height - crown_base) * distance / crown_radius, 0)
+            canopy[row_min:row_max, col_min:col_max] = np.maximum(canopy[row_min:row_max, col_min:col_max], cone)
+        chm.write(canopy, 1)
+
+
+def write_truth(forest, path, shift=(0.0, 0.0, 0.0)):
+    trees = forest['trees']
+    truth = {
+        'seed': forest['seed'],
+        'points': forest['points'],
+        'density': forest['density'],
+        'bounds': forest['bounds'],
+        'after_shift': list(shift),
+        'understory_removal': forest['understory_removal'],
+        'trees': [
+            {'id': i + 1, 'x': float(x), 'y': float(y), 'dbh': float(dbh), 'height': float(height),
+             'crown_radius': float(crown_radius), 'removed': bool(removed)}
+            for i, (x, y, dbh, height, crown_radius, removed) in enumerate(zip(
+                trees['x'], trees['y'], trees['dbh'], trees['height'], trees['crown_radius'], trees['removed']))
+        ],
+    }
+    Path(path).write_text(json.dumps(truth, indent=2))
+
+
+def generate_synthetic_forest(input_path, truth_path, points, seed=0, after=False, shift=(1.5, -0.8, 0.3), density=100.0, trees_per_hectare=300):
+    '''
+    Write a synthetic dataset. input_path is laid out like data/<dataset>/input:
+        before/before.laz       raw cloud
+        after/after.laz         treated and shifted cloud (only with after=True)
+    and truth_path holds what the pipeline should recover:
+        segmented.laz           tree points with their true treeIDs
+        dem.tif, chm.tif        true terrain and canopy height above ground
+        truth.json              every tree, the removals and the after shift
+    '''
+    input_path, truth_path = Path(input_path), Path(truth_path)
+    forest = plan_forest(points, seed, density, trees_per_hectare)
+    log.info(f'Planned a {forest["bounds"][2]-forest["bounds"][0]:.0f}m square plot with {len(forest["trees"]["x"])} trees')
+
+    (input_path / 'before').mkdir(parents=True, exist_ok=True)
+    truth_path.mkdir(parents=True, exist_ok=True)
+
+    log.info(f'Writing {points} points to {input_path / "before/before.laz"}')
+    write_cloud(forest, input_path / 'before/before.laz')
+    write_cloud(forest, truth_path / 'segmented.laz', tree_ids=True)
+    write_rasters(forest, truth_path / 'dem.tif', truth_path / 'chm.tif')
+
+    if after:
+        (input_path / 'after').mkdir(parents=True, exist_ok=True)
+        log.info(f'Writing after cloud shifted by {shift}')
+        write_cloud(forest, input_path / 'after/after.laz', after=True, shift=shift)
+
+    write_truth(forest, truth_path / 'truth.json', shift if after else (0.0, 0.0, 0.0))
+    log.success(f'Synthetic forest written to {input_path} and {truth_path}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a deterministic synthetic forest point cloud with ground truth')
+
+    parser.add_argument('-v', action='count')
+    parser.add_argument('--verbosity', type=int, default=1)
+
+    parser.add_argument('--output_path', action=utils.argument_actions.StorePathAction, default=Path('data/synthetic'), help='Dataset folder; input/ and truth/ are written inside it')
+    parser.add_argument('--points', type=int, default=1_000_000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--density', type=float, default=100.0, help='Points per square meter')
+    parser.add_argument('--trees_per_hectare', type=float, default=300)
+    parser.add_argument('--after', action='store_true', help='Also write a treated, shifted after-fire cloud')
+
+    args = parser.parse_args()
+
+    # Process verbosity args
+    verbosity = args.v if args.v else args.verbosity
+    verbosity = min(verbosity, len(log_level_options)-1)
+    log.setLevel(log_level_options[verbosity])
+
+    generate_synthetic_forest(args.output_path / 'input', args.output_path / 'truth', args.points, args.seed, args.after, density=args.density, trees_per_hectare=args.trees_per_hectare)
@@ -1,3 +1,6 @@
+import utils.cog
+import utils.geotiff_utils
+
 import rasterio
 from fastlog import log
 
@@ -8,8 +11,11 @@ import matplotlib.pyplot as plt
 
 import numpy as np
 
-import skimage
 
+# Stamps are cached per radius rounded to this many pixels, then rescaled to each tree's exact area
+RADIUS_QUANTUM = 0.01
+# Stamps are cached per sub-pixel cell, this many along each axis, so stems are placed to within 1/16 pixel
+SUBPIXEL_STEPS = 8
 
 
 def generate_trunk_density(dbh_path, dem_path, td_path):
@@ -20,10 +26,10 @@ def generate_trunk_density(dbh_path, dem_path, td_path):
         dbh_list = [row for row in reader]
 
     with rasterio.open(dem_path) as dem:
-        dem_data = dem.read(1)
+        # Only the DEM's grid is needed, not its values
+        shape = dem.shape
         transform = dem.transform
         crs = dem.crs
-        driver = dem.driver
 
         # Find image scale
         pixel_size_x = abs(transform[0])
@@ -32,123 +38,114 @@ def generate_trunk_density(dbh_path, dem_path, td_path):
         if pixel_size_x != pixel_size_y:
             log.warn('Target pixel shape is not square! This visualization may be inaccurate!')
 
-        # Make output matrix in right shape
-        tree_density_data = np.zeros( dem_data.shape )
-
-        # For each tree...
-        for dbh in dbh_list:
-
-            # Compute area, add it to relevant pixels
-            location = dem.index(dbh['X'], dbh['Y'])
-            radius = float(dbh['DBH']) / 2
-
-            # Scale radius by pixel size
-            radius = radius / pixel_size
-
-            # Create mask for this circle
-            mask = create_circle_mask(radius, location, dem_data.shape)
-
-            # Add this mask to the output image
-            tree_density_data += mask
+        # Pixel positions of every tree at once
+        x = np.array([float(dbh['X']) for dbh in dbh_list])
+        y = np.array([float(dbh['Y']) for dbh in dbh_list])
+        radii = np.array([float(dbh['DBH']) / 2 for dbh in dbh_list]) / pixel_size
+        rows, cols = utils.geotiff_utils.pixel_positions(transform, x, y)
 
+        # Stamp every tree into its own small window and add them all up in one go
+        tree_density_data = accumulate_stamps(rows, cols, radii, shape)
 
         # erase zeros
         tree_density_data[ tree_density_data==0 ] = np.nan
 
         # Display for debugging
-        # plt.imshow(dem_data)
         # plt.imshow(tree_density_data)
         # plt.show()
 
-    # Save output file
-    with rasterio.open(
-        td_path, 'w', driver=driver,
-        height=dem_data.shape[0], width=dem_data.shape[1],
-        count=1, dtype=dem_data.dtype,
+    # Save output file, as float32 a window at a time rather than converting the whole grid at once
+    with utils.cog.open_cog(
+        td_path,
+        height=shape[0], width=shape[1],
+        count=1, dtype='float32',
         crs=crs, transform=transform,
+        nodata=np.nan,
     ) as tree_density:
-        tree_density.write(tree_density_data, 1)            
-        tree_density.close()
-
-def create_circle_mask(radius, location, shape):
-    target_area = np.pi * radius**2
-
-    # create mask
-    mask = np.zeros(shape).astype(float)
-    disk_x, disk_y = skimage.draw.disk(location, radius, shape=shape)
-    mask[disk_x, disk_y] = 1
-
-    circle_rr, circle_cc, circle_val = remove_interior_anti_alias( *skimage.draw.circle_perimeter_aa(*location, int(radius), shape=shape) )
-
-
-    # Superimpose
-    mask[circle_rr, circle_cc] = circle_val
-    first_pass_area = np.sum(mask)
-    circle_area = np.sum(circle_val)
-
-    # Scale circle by area
-    # How much are we off by
-    area_delta = (target_area - first_pass_area)
-    circle_scale = (area_delta + circle_area) / circle_area
-
-    circle_val = circle_val * circle_scale
-    mask[circle_rr, circle_cc] = circle_val
-
-    log.debug(f'target area: {target_area}')
-    log.debug(f'rastered area: {np.sum(mask)}')
-
-    return np.clip(mask, 0.0, 1.0)
-
-
-def remove_interior_anti_alias(circle_rr, circle_cc, circle_val):
-
-    # remove some duplicate rows
-    circle_data = np.stack([circle_rr, circle_cc, circle_val], 1)
-    circle_data = np.unique(circle_data, axis=0)
-    # filter out zeros (why are they here?)
-    circle_data = circle_data[ circle_data[:,2] != 0 ]
-
-
-    # prepare for filter
-    r_mean = np.mean(circle_data[:,0])
-    c_mean = np.mean(circle_data[:,1])
-    skip = np.zeros(len(circle_data))
-
-    # Remove the inside of the circle
-    for r in np.unique(circle_data[:,0]):
-        
-        mask = circle_data[:,0] == r
-
-        data = circle_data[ mask ]
-        cc = data[:,1]
-        vals = data[:,2]
-        
-        peaks = cc[ vals == np.amax(vals) ]
-        
-        for c in cc:
-            # in between the peak and center of circle
-            skip[ np.logical_and(mask, circle_data[:,1] == c) ] = (np.any(peaks < c) and c <= c_mean) or (np.any(peaks > c) and c >= c_mean)
-
-
-        # ----- Half-baked numpy version of the above loop
-        # cc_thick = np.tile(cc, (len(peaks),1))
-        # peaks_thick = np.tile(peaks, (len(cc),1)).T
-
-
-        # cc_lt_peak = np.any(cc_thick < peaks_thick, axis=0)
-        # cc_gt_peak = np.any(cc_thick > peaks_thick, axis=0)
-        
-        # cc_le_mean = cc <= c_mean
-        # cc_ge_mean = cc >= c_mean
-
-        # left_skip = np.logical_and(cc_gt_peak, cc_le_mean)
-        # right_skip = np.logical_and(cc_lt_peak, cc_ge_mean)
-
-        # # This indexing is broken  vvvv
-        # skip[ np.logical_and(mask, circle_data[:,1] == cc) ] = np.logical_or( left_skip , right_skip )
-    
-
-    # Do skips
-    circle_data = circle_data[ np.logical_not(skip) ]
-    return circle_data[:,0].astype(int), circle_data[:,1].astype(int), circle_data[:,2]
-    
\ No newline at end of file
+        for window in utils.geotiff_utils.block_windows(*shape, utils.cog.BLOCK_SIZE):
+            tree_density.write(tree_density_data[window.toslices()].astype(np.float32), 1, window=window)
+
+def accumulate_stamps(rows, cols, radii, shape):
+    '''
+    Sum a disk of each radius (in pixels) centred at each fractional (row, col) position
+    (pixel (i, j) spans [i, i+1) x [j, j+1)) into a raster of the given shape, each pixel
+    getting the area of it the disk covers.
+
+    Trees are keyed by which sub-pixel cell they sit in and by their radius, quantised to
+    RADIUS_QUANTUM. Stamps for every key are computed together, rescaled per tree to its
+    exact area, and everything is scatter-added into the output with one bincount. Parts of
+    stamps that fall off the raster are dropped.
+    '''
+    if len(radii) == 0:
+        return np.zeros(shape)
+
+    base_rows, base_cols = np.floor(rows).astype(np.int64), np.floor(cols).astype(np.int64)
+    sub_rows = np.minimum(np.floor((rows - base_rows) * SUBPIXEL_STEPS).astype(np.int64), SUBPIXEL_STEPS - 1)
+    sub_cols = np.minimum(np.floor((cols - base_cols) * SUBPIXEL_STEPS).astype(np.int64), SUBPIXEL_STEPS - 1)
+    radius_steps = np.maximum(np.round(radii / RADIUS_QUANTUM).astype(np.int64), 1)
+
+    keys = np.stack([sub_rows, sub_cols, radius_steps], axis=1)
+    unique_keys, tree_keys = np.unique(keys, axis=0, return_inverse=True)
+    tree_keys = tree_keys.ravel()
+    log.debug(f'Drawing {len(unique_keys)} stamps for {len(radii)} trees')
+
+    # Stems sit at the centre of their sub-pixel cell, relative to the corner of their pixel
+    stamp_rows = (unique_keys[:, 0] + 0.5) / SUBPIXEL_STEPS
+    stamp_cols = (unique_keys[:, 1] + 0.5) / SUBPIXEL_STEPS
+    stamp_radii = unique_keys[:, 2] * RADIUS_QUANTUM
+    # The disk reaches at most ceil(radius) pixels either side of the stem's pixel
+    halves = np.ceil(stamp_radii).astype(np.int64)
+
+    indices = []
+    weights = []
+    stamp_index = np.zeros(len(unique_keys), dtype=np.int64)
+    # Stamps with the same window size are computed in one go
+    for half in np.unique(halves):
+        group = np.nonzero(halves == half)[0]
+        stamps = disk_coverage(stamp_rows[group], stamp_cols[group], stamp_radii[group], half)
+        stamp_index[group] = np.arange(len(group))
+
+        trees = np.nonzero(halves[tree_keys] == half)[0]
+        scale = (radii[trees] / stamp_radii[tree_keys[trees]])**2
+        values = scale[:, None, None] * stamps[stamp_index[tree_keys[trees]]]
+
+        # (trees, window rows, window cols) positions in the output, keeping only covered pixels on the raster
+        offsets = np.arange(-half, half + 1)
+        pixel_rows = base_rows[trees, None, None] + offsets[None, :, None]
+        pixel_cols = base_cols[trees, None, None] + offsets[None, None, :]
+        keep = (values > 0) & (pixel_rows >= 0) & (pixel_rows < shape[0]) & (pixel_cols >= 0) & (pixel_cols < shape[1])
+
+        indices.append((pixel_rows * shape[1] + pixel_cols)[keep])
+        weights.append(values[keep])
+
+    total = np.bincount(np.concatenate(indices), weights=np.concatenate(weights), minlength=shape[0]*shape[1])
+    return total.reshape(shape)
+
+def disk_coverage(centre_rows, centre_cols, radii, half):
+    '''
+    Exact area of each pixel of a (2*half + 1)-pixel square window covered by each of N disks,
+    returned as an (N, 2*half + 1, 2*half + 1) array. Centres are relative to the corner of
+    the window's middle pixel. Each stamp sums to pi * r^2 whenever the window holds the disk.
+    '''
+    # Pixel edges relative to each centre
+    edges = np.arange(-half, half + 2)
+    row_edges = edges[None, :] - centre_rows[:, None]
+    col_edges = edges[None, :] - centre_cols[:, None]
+
+    # The area in a rectangle is inclusion-exclusion over the quadrant areas at its corners
+    quadrants = quadrant_area(row_edges[:, :, None], col_edges[:, None, :], radii[:, None, None])
+    return quadrants[:, 1:, 1:] - quadrants[:, :-1, 1:] - quadrants[:, 1:, :-1] + quadrants[:, :-1, :-1]
+
+def quadrant_area(x, y, r):
+    # Signed area of the disk of radius r about the origin that lies in the rectangle from (0, 0) to (x, y)
+    sign = np.sign(x) * np.sign(y)
+    x = np.minimum(np.abs(x), r)
+    y = np.minimum(np.abs(y), r)
+
+    # Up to where the circle drops below height y, the rectangle is covered to its full height
+    corner = np.minimum(np.sqrt(r**2 - y**2), x)
+    return sign * (y*corner + circle_integral(x, r) - circle_integral(corner, r))
+
+def circle_integral(t, r):
+    # Integral of sqrt(r^2 - u^2) du from 0 to t, for 0 <= t <= r
+    return (t*np.sqrt(np.maximum(r**2 - t**2, 0)) + r**2*np.arcsin(np.minimum(t / r, 1))) / 2
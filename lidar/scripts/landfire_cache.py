@@ -0,0 +1,162 @@
+from scripts import download_landfire
+
+import utils.cog
+import utils.disk_cache
+
+import rasterio
+import rasterio.windows
+
+import asyncio
+import contextlib
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+
+# LANDFIRE products are evicted, least recently used first, once the cache grows past this many bytes
+DEFAULT_MAX_BYTES = 2 * 1024**3
+# Pixels kept around a clipped AOI, so resampling at its edges has neighbours to draw on
+CLIP_PADDING = 2
+
+
+class LandfireCache(utils.disk_cache.DiskCache):
+    '''
+    Local store of LANDFIRE products, one GeoTIFF per LFPS job, indexed by the layers, CRS
+    and AOI it was requested with. A request whose AOI lies inside a cached product's, with
+    the same layers and CRS, is clipped out of that product instead of downloaded, so
+    neighbouring flights over the same forest share one job and runs work offline once it
+    is cached. Keys, the index and LRU eviction are DiskCache's.
+    '''
+    entry_suffix = '.tif'
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        super().__init__(directory, max_bytes)
+
+    @staticmethod
+    def layer_set(layers):
+        # The merge finds bands by description, so the order layers are asked for in doesn't matter
+        return sorted(layer for layer in layers.split(';') if layer)
+
+    def covering(self, layers, crs, aoi):
+        '''
+        Key of the smallest cached product with these layers and CRS whose AOI contains aoi
+        (xmin, ymin, xmax, ymax), or None.
+        '''
+        xmin, ymin, xmax, ymax = aoi
+        with self.locked():
+            entries = self.load_index()['entries']
+
+        candidates = [
+            key for key, entry in entries.items()
+            if 'aoi' in entry
+            and entry['layers'] == self.layer_set(layers) and entry['crs'] == str(crs)
+            and entry['aoi'][0] <= xmin and entry['aoi'][1] <= ymin and entry['aoi'][2] >= xmax and entry['aoi'][3] >= ymax
+            and self.entry_path(key).exists()
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda key: (entries[key]['aoi'][2] - entries[key]['aoi'][0]) * (entries[key]['aoi'][3] - entries[key]['aoi'][1]))
+
+    def add(self, product_path, layers, crs, aoi):
+        # Move a downloaded product into the cache and return its key
+        key = self.key(self.layer_set(layers), str(crs), [float(value) for value in aoi])
+        tmp_path = self.partial_path(key)
+        shutil.move(product_path, tmp_path)
+        self.commit(key, tmp_path, layers=self.layer_set(layers), crs=str(crs), aoi=[float(value) for value in aoi])
+        return key
+
+    def clip(self, key, aoi, output_path):
+        '''
+        Write the part of a cached product that covers aoi, plus CLIP_PADDING pixels, to
+        output_path, keeping its bands, their descriptions and nodata. Returns False, writing
+        nothing, if another process evicted the product first.
+        '''
+        # Read through a hard link taken under the lock, so an eviction meanwhile can't pull the
+        # file out from under the read, without holding the lock for the whole clip
+        link_path = self.partial_path(key)
+        with self.locked():
+            if not self.touch_locked(key):
+                return False
+            try:
+                os.link(self.entry_path(key), link_path)
+            except OSError:
+                shutil.copyfile(self.entry_path(key), link_path)
+
+        try:
+            with rasterio.open(link_path) as product:
+                window = rasterio.windows.from_bounds(*aoi, transform=product.transform)
+                col_off = max(0, int(window.col_off) - CLIP_PADDING)
+                row_off = max(0, int(window.row_off) - CLIP_PADDING)
+                window = rasterio.windows.Window(
+                    col_off, row_off,
+                    min(product.width, int(window.col_off + window.width) + 1 + CLIP_PADDING) - col_off,
+                    min(product.height, int(window.row_off + window.height) + 1 + CLIP_PADDING) - row_off,
+                )
+
+                with utils.cog.open_cog(output_path, width=window.width, height=window.height, count=product.count,
+                                        dtype=product.dtypes[0], crs=product.crs,
+                                        transform=rasterio.windows.transform(window, product.transform),
+                                        nodata=product.nodata) as clipped:
+                    clipped.write(product.read(window=window))
+                    for band, description in enumerate(product.descriptions, 1):
+                        if description:
+                            clipped.set_band_description(band, description)
+        finally:
+            link_path.unlink(missing_ok=True)
+        return True
+
+def fetch_landfire(crs, aoi, output_path, cache_directory, layers=download_landfire.DEFAULT_LAYERS, max_bytes=DEFAULT_MAX_BYTES):
+    '''
+    Write the LANDFIRE layers for aoi (xmin, ymin, xmax, ymax, in crs) to the GeoTIFF
+    output_path, from the cache when a cached product covers aoi and from a new LFPS job
+    (which is then cached) otherwise.
+    '''
+    fetch_landfire_all([(crs, aoi, output_path)], cache_directory, layers, max_bytes)
+
+def fetch_landfire_all(requests, cache_directory, layers=download_landfire.DEFAULT_LAYERS, max_bytes=DEFAULT_MAX_BYTES, client=None):
+    '''
+    fetch_landfire for each (crs, aoi, output_path) in requests. Every request the cache
+    can't serve goes to one LandfireClient in one event loop, so their LFPS jobs are in
+    flight together over its shared connection pool. Products that arrive are cached even
+    if another job fails, so a rerun only submits the failures; the first failure is then
+    raised once every request that could be served has been written.
+    '''
+    cache = LandfireCache(cache_directory, max_bytes)
+    client = client or download_landfire.LandfireClient()
+    misses = []
+    for i, (crs, aoi, output_path) in enumerate(requests):
+        key = cache.covering(layers, crs, aoi)
+        # A product evicted by another process since covering() found it is a miss after all
+        if key is not None and cache.clip(key, aoi, output_path):
+            print(f'Using cached LANDFIRE product {key} for {aoi}')
+        else:
+            misses.append(i)
+
+    errors = []
+    if misses:
+        # Download next to the cache, so products are only moved into it, not copied
+        with contextlib.ExitStack() as stack:
+            download_directories = [Path(stack.enter_context(tempfile.TemporaryDirectory(dir=cache.directory, prefix='download_')))
+                                    for _ in misses]
+            jobs = [(requests[i][0], ' '.join(map(str, requests[i][1])), directory, layers)
+                    for i, directory in zip(misses, download_directories)]
+            downloads = asyncio.run(client.fetch_all(jobs, return_exceptions=True))
+
+            for i, directory, download in zip(misses, download_directories, downloads):
+                crs, aoi, _ = requests[i]
+                if isinstance(download, BaseException):
+                    errors.append(download)
+                    continue
+                shutil.unpack_archive(download, extract_dir=directory)
+                try:
+                    product_path = next(directory.glob('**/*.tif'))
+                except StopIteration:
+                    errors.append(FileNotFoundError(f'No .tif file in the LANDFIRE download for {aoi}'))
+                    continue
+                key = cache.add(product_path, layers, crs, aoi)
+                if not cache.clip(key, aoi, requests[i][2]):
+                    errors.append(FileNotFoundError(f'LANDFIRE product {key} for {aoi} was evicted before it could be clipped'))
+
+    if errors:
+        raise errors[0]
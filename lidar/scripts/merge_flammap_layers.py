@@ -1,8 +1,57 @@
+import utils.cog
+import utils.geotiff_utils
+
 import rasterio
 import rasterio.warp
+import rasterio.windows
 import numpy as np
+import os
+
+# The target grid is merged in square blocks of this many pixels a side, so memory stays flat however large the DEM
+BLOCK_SIZE = 1024
+# Working memory (MB) GDAL may use per reprojection, and the threads it warps with when run
+# on its own; the pipeline asks for this many cores and passes num_threads what it was granted
+WARP_MEMORY_LIMIT = 256
+NUM_THREADS = os.cpu_count() or 1
+# A user raster without nodata is treated as having it if one value covers this share of a
+# sample of about this many of its pixels
+NODATA_RATIO = 0.95
+NODATA_SAMPLE_PIXELS = 1_000_000
+
+def infer_nodata(dataset, band=1):
+    '''
+    Guess a nodata value for a band that doesn't declare one: its most common value, if that
+    covers more than NODATA_RATIO of it. Counted over a decimated read with np.unique rather
+    than a bincount of the whole band, so it works on floats and costs the same at any size.
+    '''
+    step = max(1, int(np.ceil(np.sqrt(dataset.height * dataset.width / NODATA_SAMPLE_PIXELS))))
+    sample = dataset.read(band, out_shape=(-(-dataset.height // step), -(-dataset.width // step)),
+                          resampling=rasterio.warp.Resampling.nearest)
+    values, counts = np.unique(sample, return_counts=True)
+    if counts.max() / sample.size > NODATA_RATIO:
+        return values[counts.argmax()]
+    return None
 
-def generate_merged_data(flammap_path, dem_path, chm_path, aspect_path, slope_path, merged_path):
+def reproject_window(source, band, destination, window_transform, target_crs, resampling, num_threads, warp_memory_limit):
+    rasterio.warp.reproject(
+        source=rasterio.band(source, band),
+        destination=destination,
+        dst_transform=window_transform,
+        dst_crs=target_crs,
+        resampling=resampling,
+        num_threads=num_threads,
+        warp_mem_limit=warp_memory_limit
+    )
+    return destination
+
+def generate_merged_data(flammap_path, dem_path, chm_path, aspect_path, slope_path, merged_path,
+                         block_size=BLOCK_SIZE, num_threads=NUM_THREADS, warp_memory_limit=WARP_MEMORY_LIMIT):
+    '''
+    Build the FlamMap landscape: every LANDFIRE band reprojected onto the DEM's grid, with the
+    elevation, canopy base height, aspect and slope bands taken from our own rasters wherever
+    they have data. Works a block_size block at a time, warping each block straight from the
+    source files with num_threads GDAL threads.
+    '''
     # Open input files
     with rasterio.open(flammap_path) as flammap_file, \
          rasterio.open(dem_path) as dem_file, \
@@ -22,64 +71,41 @@ def generate_merged_data(flammap_path, dem_path, chm_path, aspect_path, slope_pa
             'US_SLPD2020': slope_file,
         }
 
-        with rasterio.open(merged_path, 'w', driver=flammap_file.driver,
-                           height=target_shape[0], width=target_shape[1],
-                           count=len(flammap_file.indexes),
-                           dtype=target_dtype,
-                           crs=target_crs, transform=target_transform) as merged_file:
+        with utils.cog.open_cog(merged_path,
+                                height=target_shape[0], width=target_shape[1],
+                                count=len(flammap_file.indexes),
+                                dtype=target_dtype,
+                                crs=target_crs, transform=target_transform,
+                                # One file of continuous bands and fuel model codes, so no overview may average
+                                overview_resampling='NEAREST', num_threads=num_threads) as merged_file:
 
             for i, description in zip(flammap_file.indexes, flammap_file.descriptions):
+                user_src = desc_map.get(description)
+                if user_src is not None:
+                    # Use nodata from user raster, or guess one only if no nodata is defined
+                    nodata_val = user_src.nodata if user_src.nodata is not None else infer_nodata(user_src)
+                    resampling_method = rasterio.warp.Resampling.nearest
+                elif description == 'US_240FBFM40':
+                    resampling_method = rasterio.warp.Resampling.nearest
+                else:
+                    resampling_method = rasterio.warp.Resampling.bilinear
 
-                if description in desc_map:
-                    # Reproject both user and flammap data to target grid
-                    user_src = desc_map[description]
-                    user_data = np.full(target_shape, np.nan, dtype=np.dtype(target_dtype))
-                    fallback_data = np.zeros(target_shape, dtype=target_dtype)
-
-                    rasterio.warp.reproject(
-                        source=rasterio.band(user_src, 1),
-                        destination=user_data,
-                        dst_transform=target_transform,
-                        dst_crs=target_crs,
-                        resampling=rasterio.warp.Resampling.nearest
-                    )
-
-                    rasterio.warp.reproject(
-                        source=rasterio.band(flammap_file, i),
-                        destination=fallback_data,
-                        dst_transform=target_transform,
-                        dst_crs=target_crs,
-                        resampling=rasterio.warp.Resampling.nearest
-                    )
-
-                    # Fuse user data with fallback (FlamMap) data
-                    # Use nodata from user raster or assume 0 if missing
-                    nodata_val = user_src.nodata
-                    if nodata_val is not None:
-                        user_mask = (user_data == nodata_val) | np.isnan(user_data)
-                    else:
-                        # Guess a nodata value only if no nodata is defined
-                        most_common = np.bincount(user_data.flatten()).argmax()
-                        ratio = np.sum(user_data == most_common) / user_data.size
-                        user_mask = (user_data == most_common) if ratio > 0.95 else np.full(user_data.shape, False)
-
-                    fused = np.where(user_mask, fallback_data, user_data)
+                for window in utils.geotiff_utils.block_windows(*target_shape, block_size):
+                    window_shape = (window.height, window.width)
+                    window_transform = rasterio.windows.transform(window, target_transform)
 
-                    merged_file.write(fused.astype(target_dtype), i)
+                    fallback_data = reproject_window(flammap_file, i, np.zeros(window_shape, dtype=target_dtype),
+                                                     window_transform, target_crs, resampling_method, num_threads, warp_memory_limit)
 
-                else:
-                    resampling_method = (
-                        rasterio.warp.Resampling.nearest
-                        if description == 'US_240FBFM40'
-                        else rasterio.warp.Resampling.bilinear
-                    )
+                    if user_src is not None:
+                        # Fuse user data with fallback (FlamMap) data
+                        user_data = reproject_window(user_src, 1, np.full(window_shape, np.nan, dtype=np.dtype(target_dtype)),
+                                                     window_transform, target_crs, resampling_method, num_threads, warp_memory_limit)
+                        user_mask = np.isnan(user_data)
+                        if nodata_val is not None:
+                            user_mask |= user_data == nodata_val
+                        fallback_data = np.where(user_mask, fallback_data, user_data)
 
-                    rasterio.warp.reproject(
-                        source=rasterio.band(flammap_file, i),
-                        destination=rasterio.band(merged_file, i),
-                        dst_transform=target_transform,
-                        dst_crs=target_crs,
-                        resampling=resampling_method
-                    )
+                    merged_file.write(fallback_data.astype(target_dtype), i, window=window)
 
                 merged_file.set_band_description(i, description)
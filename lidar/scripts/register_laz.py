@@ -1,9 +1,75 @@
+import utils.feature_cache
+import utils.gridding
+import utils.run_report
+
 import open3d as o3d
 import laspy
 import numpy as np
+import scipy.ndimage
+import copy
+import itertools
 import os
+import time
 from pathlib import Path
 
+# Points transformed and written at a time
+POINTS_PER_CHUNK = 5_000_000
+# Largest stored coordinate a LAS file can hold
+MAX_STORED_COORDINATE = 2**31 - 1
+
+# Voxel sizes (m) that ICP refines the coarse RANSAC alignment at, coarse to fine
+ICP_VOXEL_SIZES = [1.0, 0.5, 0.25]
+# Each RANSAC round stops at this confidence or iteration count; rounds stop once one fails to
+# improve on the best so far or the time budget (s) is spent
+RANSAC_CONFIDENCE = 0.999
+RANSAC_ITERATIONS = 100_000
+RANSAC_TIME_BUDGET = 60
+# ICP pairs points up to this many voxel sizes apart, and stops iterating once fitness and
+# RMSE change by less than the relative tolerance
+ICP_DISTANCE_FACTOR = 2.0
+ICP_MAX_ITERATIONS = 30
+ICP_RELATIVE_TOLERANCE = 1e-6
+# Finer ICP levels are skipped once a level moves the cloud by less than this fraction of its voxel size
+EARLY_EXIT_FRACTION = 0.05
+
+# 'features' registers with FPFH and RANSAC; 'dem' lines up the two ground surfaces
+REGISTRATION_METHODS = ['features', 'dem']
+# Resolution (m) of the ground grids DEM registration correlates, and the LAS ground class
+# they are made from (clouds without any are gridded from their lowest returns instead)
+DEM_RESOLUTION = 1.0
+GROUND_CLASS = 2
+# The Z offset is taken over cells flatter than this (degrees), where a small leftover XY
+# error makes little Z error, and then again without differences this many robust standard
+# deviations from the first median
+STABLE_SLOPE = 15
+Z_OUTLIER_SIGMAS = 3
+# The ground grids are smoothed with a Gaussian of this many cells before they are lined up,
+# so per-cell noise doesn't swamp their gradients; cells get filled in from data nearby only
+# if it carries at least this much of the smoothing weight
+DEM_SMOOTHING = 1.0
+GAP_FILL_WEIGHT = 0.05
+# The ground surfaces are lined up to the nearest cell by cross-correlation, then to a fraction
+# of one by Gauss-Newton, for at most this many iterations or until a step is below the tolerance (cells)
+DEM_ITERATIONS = 30
+DEM_TOLERANCE = 0.01
+# DEM registration is only trusted if the gradients of the aligned ground surfaces correlate at
+# least this well, halves of the ground agree on the horizontal shift to within this many
+# metres and at least this share of the stable ground agrees in height to within Z_TOLERANCE (m)
+MIN_DEM_CORRELATION = 0.5
+MAX_DEM_SHIFT_ERROR = 0.25
+MIN_STABLE_FRACTION = 0.5
+Z_TOLERANCE = 0.5
+# Rough bytes per cell of the grids DEM registration holds at once (both ground grids, their
+# smoothed copies and transforms, and the least squares scratch), and per point of a chunk being gridded
+DEM_BYTES_PER_CELL = 256
+CHUNK_BYTES_PER_POINT = 100
+
+
+class RegistrationError(RuntimeError):
+    # The data can't support the registration asked for
+    pass
+
+
 def load_laz_as_pcd(path):
     las = laspy.read(path)
     points = np.vstack((las.x, las.y, las.z)).T
@@ -11,102 +77,483 @@ def load_laz_as_pcd(path):
     pcd.points = o3d.utility.Vector3dVector(points)
     return pcd, las
 
-def save_pcd_as_laz(pcd, crs, output_path):
-    points = np.asarray(pcd.points)
-    header = laspy.LasHeader(point_format=3, version="1.2")
-    header.add_crs(crs)
-    header.offsets = np.min(points, axis=0)
-    header.scales = np.array([0.001, 0.001, 0.001])  # or appropriate scale
+def transformed_scaling(header, transformation):
+    '''
+    Scales and offsets for the cloud described by header once transformed. The source's
+    scales are kept, so no precision is lost, unless the moved cloud would overflow the
+    stored integers at them; offsets go to whole metres below the moved bounding box.
+    '''
+    corners = np.array(list(itertools.product(*zip(header.mins, header.maxs))))
+    moved = corners @ transformation[:3, :3].T + transformation[:3, 3]
+    mins, maxs = moved.min(axis=0), moved.max(axis=0)
+
+    offsets = np.floor(mins)
+    scales = np.array(header.scales, dtype=float)
+    while np.any((maxs - offsets) / scales > MAX_STORED_COORDINATE):
+        scales = np.where((maxs - offsets) / scales > MAX_STORED_COORDINATE, scales * 10, scales)
 
-    new_las = laspy.LasData(header)
-    new_las.x, new_las.y, new_las.z = points[:, 0], points[:, 1], points[:, 2]
+    return scales, offsets
 
-    new_las.write(output_path)
+def apply_transformation(las_path, transformation, output_path, crs=None):
+    '''
+    Stream a LAS/LAZ file to output_path a chunk at a time, moving its points by a 4x4
+    transformation. Every point dimension and the header's VLRs are kept; crs is only added
+    if the file has none of its own.
+    '''
+    with laspy.open(las_path) as reader:
+        header = copy.deepcopy(reader.header)
+        if crs is not None and header.parse_crs() is None:
+            header.add_crs(crs)
+        header.scales, header.offsets = transformed_scaling(reader.header, transformation)
 
-def preprocess(pcd, voxel_size):
+        with laspy.open(output_path, mode='w', header=header) as writer:
+            for points in reader.chunk_iterator(POINTS_PER_CHUNK):
+                xyz = np.stack([points.x, points.y, points.z], axis=1) @ transformation[:3, :3].T + transformation[:3, 3]
+
+                # Re-express the chunk in the output's scales and offsets, so the writer stores it as is
+                points.X, points.Y, points.Z = (np.round((xyz - header.offsets) / header.scales).astype(np.int32)).T
+                points.scales, points.offsets = header.scales, header.offsets
+                writer.write_points(points)
+
+def preprocess(pcd, voxel_size, features=False):
+    '''
+    Downsample to voxel_size and estimate normals, plus FPFH features if asked, as arrays:
+    points as float64 (they are map coordinates), normals and features as float32.
+    '''
     pcd_down = pcd.voxel_down_sample(voxel_size)
     pcd_down.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size*2, max_nn=30))
-    fpfh = o3d.pipelines.registration.compute_fpfh_feature(
-        pcd_down,
-        o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size*5, max_nn=100)
-    )
-    return pcd_down, fpfh
-
-def global_align(src, tgt, src_fpfh, tgt_fpfh, voxel_size):
-    return o3d.pipelines.registration.registration_ransac_based_on_feature_matching(
-        src, tgt, src_fpfh, tgt_fpfh, True, voxel_size * 1.5,
-        o3d.pipelines.registration.TransformationEstimationPointToPoint(False), 4,
-        [
-            o3d.pipelines.registration.CorrespondenceCheckerBasedOnEdgeLength(0.9),
-            o3d.pipelines.registration.CorrespondenceCheckerBasedOnDistance(voxel_size * 1.5)
-        ],
-        o3d.pipelines.registration.RANSACConvergenceCriteria(4000000, 100)
-    )
+    arrays = {
+        'points': np.asarray(pcd_down.points),
+        'normals': np.asarray(pcd_down.normals).astype(np.float32),
+    }
+    if features:
+        fpfh = o3d.pipelines.registration.compute_fpfh_feature(
+            pcd_down,
+            o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size*5, max_nn=100)
+        )
+        arrays['features'] = np.asarray(fpfh.data).astype(np.float32)
+    return arrays
+
+def from_arrays(arrays):
+    # The downsampled cloud and its FPFH features (None if there are none) back from preprocess's arrays
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(arrays['points'].astype(np.float64))
+    pcd.normals = o3d.utility.Vector3dVector(arrays['normals'].astype(np.float64))
+
+    fpfh = None
+    if 'features' in arrays:
+        fpfh = o3d.pipelines.registration.Feature()
+        fpfh.data = arrays['features'].astype(np.float64)
+    return pcd, fpfh
+
+class CroppedCloud:
+    '''
+    A LAS/LAZ file cropped to a box, from which registration takes voxel-downsampled copies.
+    With a cache, copies are kept on disk keyed by the file's content, the box and the voxel
+    size, and the file is only read for the first copy the cache doesn't hold, so registering
+    against a reference cloud whose copies are all cached never loads it at all.
+    '''
+    def __init__(self, path, min_bound, max_bound, cache=None):
+        self.path = path
+        self.min_bound = np.asarray(min_bound, dtype=float)
+        self.max_bound = np.asarray(max_bound, dtype=float)
+        self.cache = cache
+        self.pcd = None
+
+    def corners(self):
+        return np.array(list(itertools.product(*zip(self.min_bound, self.max_bound))))
+
+    def cropped(self):
+        if self.pcd is None:
+            print(f"Loading {self.path}...")
+            pcd, _ = load_laz_as_pcd(self.path)
+            self.pcd = pcd.crop(o3d.geometry.AxisAlignedBoundingBox(self.min_bound, self.max_bound))
+            print(f"Cropped to intersection: {self.pcd}")
+        return self.pcd
+
+    def downsampled(self, voxel_size, features=False):
+        # Points and normals at voxel_size, and their FPFH features if asked
+        if self.cache is None:
+            return from_arrays(preprocess(self.cropped(), voxel_size, features))
+
+        key = self.cache.key(self.cache.file_digest(self.path), self.min_bound.tolist(), self.max_bound.tolist(), voxel_size, features)
+        arrays = self.cache.load(key)
+        if arrays is None:
+            arrays = preprocess(self.cropped(), voxel_size, features)
+            self.cache.store(key, arrays)
+        return from_arrays(arrays)
+
+def global_align(src, tgt, src_fpfh, tgt_fpfh, voxel_size, time_budget=RANSAC_TIME_BUDGET):
+    '''
+    Feature-matching RANSAC, run in bounded rounds that keep the best result, until a round
+    stops improving on it or the time budget runs out.
+    '''
+    started = time.perf_counter()
+    best = None
+    while True:
+        result = o3d.pipelines.registration.registration_ransac_based_on_feature_matching(
+            src, tgt, src_fpfh, tgt_fpfh, True, voxel_size * 1.5,
+            o3d.pipelines.registration.TransformationEstimationPointToPoint(False), 4,
+            [
+                o3d.pipelines.registration.CorrespondenceCheckerBasedOnEdgeLength(0.9),
+                o3d.pipelines.registration.CorrespondenceCheckerBasedOnDistance(voxel_size * 1.5)
+            ],
+            o3d.pipelines.registration.RANSACConvergenceCriteria(RANSAC_ITERATIONS, RANSAC_CONFIDENCE)
+        )
+
+        improved = best is None or (result.fitness, -result.inlier_rmse) > (best.fitness, -best.inlier_rmse)
+        if improved:
+            best = result
+        if not improved or time.perf_counter() - started > time_budget:
+            return best
 
 def refine_icp(src, tgt, init_trans, voxel_size):
+    # Point-to-plane, using the normals the target was downsampled with
     return o3d.pipelines.registration.registration_icp(
-        src, tgt, voxel_size * 0.4, init_trans,
-        o3d.pipelines.registration.TransformationEstimationPointToPlane()
+        src, tgt, voxel_size * ICP_DISTANCE_FACTOR, init_trans,
+        o3d.pipelines.registration.TransformationEstimationPointToPlane(),
+        o3d.pipelines.registration.ICPConvergenceCriteria(ICP_RELATIVE_TOLERANCE, ICP_RELATIVE_TOLERANCE, ICP_MAX_ITERATIONS)
     )
 
-def register_laz(before_path, after_path, voxel_size=2.0):
-    after_folder = Path(after_path).parent
-    adjusted_path = after_folder / "after-adjusted.laz"
+def transformation_change(corners, before, after):
+    # Furthest any of the corners of a cloud's bounding box moves between two transformations
+    corners = np.hstack([corners, np.ones((len(corners), 1))])
+    return np.linalg.norm(corners @ (after - before).T, axis=1).max()
+
+def report_level(report, level, voxel_size, fitness, inlier_rmse, started):
+    report.append({
+        'level': level,
+        'voxel_size': voxel_size,
+        'fitness': fitness,
+        'inlier_rmse': inlier_rmse,
+        'seconds': time.perf_counter() - started,
+    })
+    print(f"{level} at {voxel_size} m: fitness {fitness:.3f}, inlier RMSE {inlier_rmse:.3f} m ({report[-1]['seconds']:.1f}s)")
+
+def refine_levels(src, tgt, transformation, icp_voxel_sizes, report):
+    # Point-to-plane ICP at each of icp_voxel_sizes in turn, stopping once a level barely moves the cloud
+    print("Refining with ICP...")
+    for icp_voxel_size in icp_voxel_sizes:
+        started = time.perf_counter()
+        result = refine_icp(src.downsampled(icp_voxel_size)[0], tgt.downsampled(icp_voxel_size)[0], transformation, icp_voxel_size)
+        report_level(report, 'icp', icp_voxel_size, result.fitness, result.inlier_rmse, started)
+
+        moved = transformation_change(src.corners(), transformation, result.transformation)
+        transformation = result.transformation
+        if moved < EARLY_EXIT_FRACTION * icp_voxel_size:
+            print(f"Converged: the {icp_voxel_size} m level moved the cloud {moved:.3f} m")
+            break
+
+    return transformation
+
+def register_pyramid(src, tgt, voxel_size, icp_voxel_sizes=ICP_VOXEL_SIZES, time_budget=RANSAC_TIME_BUDGET):
+    '''
+    Align CroppedCloud src to tgt coarse to fine: FPFH features and RANSAC on clouds
+    downsampled to voxel_size, then point-to-plane ICP at each of icp_voxel_sizes in turn,
+    stopping early once a level barely moves the cloud. Returns the transformation and a report of the
+    fitness and inlier RMSE reached at each level.
+    '''
+    report = []
+
+    print("Running global alignment...")
+    started = time.perf_counter()
+    src_down, src_fpfh = src.downsampled(voxel_size, features=True)
+    tgt_down, tgt_fpfh = tgt.downsampled(voxel_size, features=True)
+    result = global_align(src_down, tgt_down, src_fpfh, tgt_fpfh, voxel_size, time_budget)
+    report_level(report, 'ransac', voxel_size, result.fitness, result.inlier_rmse, started)
+
+    transformation = refine_levels(src, tgt, result.transformation, icp_voxel_sizes, report)
+    return transformation, report
+
+def ground_grid(las_path, x_bins, y_bins):
+    '''
+    North-up grid of the lowest ground return in each cell, NaN where there is none, streamed
+    a chunk at a time. Falls back to the lowest return of any class if the file has no
+    ground points at all.
+    '''
+    cell_count = (len(x_bins) - 1) * (len(y_bins) - 1)
+    ground = np.full(cell_count, np.inf)
+    lowest = np.full(cell_count, np.inf)
 
-    print("Loading point clouds...")
-    before_pcd, before_las = load_laz_as_pcd(before_path)
-    after_pcd, after_las = load_laz_as_pcd(after_path)
-    crs = before_las.header.parse_crs()
+    with laspy.open(las_path) as reader:
+        for points in reader.chunk_iterator(POINTS_PER_CHUNK):
+            z = np.asarray(points.z)
+            cells = utils.gridding.cell_indices(np.asarray(points.x), np.asarray(points.y), x_bins, y_bins)
+            on_grid = cells >= 0
+            np.minimum.at(lowest, cells[on_grid], z[on_grid])
+            is_ground = on_grid & (np.asarray(points.classification) == GROUND_CLASS)
+            np.minimum.at(ground, cells[is_ground], z[is_ground])
 
-    print("Computing intersection bounding box...")
-    bbox_before = before_pcd.get_axis_aligned_bounding_box()
-    bbox_after = after_pcd.get_axis_aligned_bounding_box()
+    grid = ground if np.isfinite(ground).any() else lowest
+    grid[~np.isfinite(grid)] = np.nan
+    return grid.reshape(len(y_bins) - 1, len(x_bins) - 1)
 
-    # Intersect AABB
-    min_bound = np.maximum(bbox_before.get_min_bound(), bbox_after.get_min_bound())
-    max_bound = np.minimum(bbox_before.get_max_bound(), bbox_after.get_max_bound())
+def smooth_grid(grid, sigma, fill=False):
+    '''
+    Gaussian smoothing of a grid with gaps, each cell averaging only the data around it
+    (normalised convolution). Gaps stay gaps unless fill, which fills those with data nearby.
+    '''
+    valid = ~np.isnan(grid)
+    weights = scipy.ndimage.gaussian_filter(valid.astype(float), sigma)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        smoothed = scipy.ndimage.gaussian_filter(np.where(valid, grid, 0), sigma) / weights
+    return np.where((weights > GAP_FILL_WEIGHT) & (valid | fill), smoothed, np.nan)
 
-    if np.any(min_bound >= max_bound):
+def cross_correlation(reference, moving):
+    '''
+    The whole-cell (rows, columns) shift that best lines moving up with reference: moving
+    sampled at (row + rows, column + columns) matches reference at (row, column). Each grid
+    has its best-fit plane taken off and its gaps zeroed, and both are tapered with a Hann
+    window.
+
+    Unlike phase correlation, the cross-power spectrum is not whitened: almost all of a
+    ground surface's relief is in its lowest frequencies, and whitening hands the peak to
+    the per-cell noise that fills the rest. Unwhitened, the peak is broad and the taper pulls
+    it towards no shift, but it lands within the basin refine_shift converges from.
+    '''
+    window = np.outer(np.hanning(reference.shape[0]), np.hanning(reference.shape[1]))
+
+    rows, cols = np.indices(reference.shape)
+
+    def prepared(grid):
+        valid = ~np.isnan(grid)
+        design = np.stack([rows[valid], cols[valid], np.ones(valid.sum())], axis=1)
+        plane = np.linalg.lstsq(design, grid[valid], rcond=None)[0]
+        grid = grid - (plane[0]*rows + plane[1]*cols + plane[2])
+        return np.where(valid, grid, 0) * window
+
+    surface = np.real(np.fft.ifft2(np.fft.fft2(prepared(moving)) * np.conj(np.fft.fft2(prepared(reference)))))
+
+    # Peaks past halfway are negative shifts
+    peak = np.array(np.unravel_index(np.argmax(surface), surface.shape))
+    peak = np.where(peak > np.array(surface.shape) // 2, peak - surface.shape, peak)
+    return peak.astype(float)
+
+def bilinear_sample(grid, rows, cols, gradient=False):
+    '''
+    grid interpolated at fractional (row, column) positions, NaN off the grid or next to a
+    gap. With gradient, also the derivatives of the interpolation along rows and columns,
+    which need the same four cells and so are defined wherever the value is.
+    '''
+    row0, col0 = np.floor(rows).astype(np.int64), np.floor(cols).astype(np.int64)
+    fraction_row, fraction_col = rows - row0, cols - col0
+    inside = (row0 >= 0) & (row0 < grid.shape[0] - 1) & (col0 >= 0) & (col0 < grid.shape[1] - 1)
+    row0, col0 = np.where(inside, row0, 0), np.where(inside, col0, 0)
+
+    top_left, top_right = grid[row0, col0], grid[row0, col0 + 1]
+    bottom_left, bottom_right = grid[row0 + 1, col0], grid[row0 + 1, col0 + 1]
+    top = top_left + (top_right - top_left) * fraction_col
+    bottom = bottom_left + (bottom_right - bottom_left) * fraction_col
+    values = np.where(inside, top + (bottom - top) * fraction_row, np.nan)
+    if not gradient:
+        return values
+
+    d_row = np.where(inside, bottom - top, np.nan)
+    d_col = np.where(inside, (top_right - top_left) * (1 - fraction_row) + (bottom_right - bottom_left) * fraction_row, np.nan)
+    return values, d_row, d_col
+
+def refine_shift(reference, moving, shift, iterations=DEM_ITERATIONS, tolerance=DEM_TOLERANCE):
+    '''
+    Refine a (rows, columns) shift of moving onto reference by Gauss-Newton least squares on
+    their height differences: each iteration linearises moving about the current shift and
+    solves for the shift and height offset that best explain what differs, leaving out
+    differences more than Z_OUTLIER_SIGMAS robust standard deviations from their median
+    (whatever changed between the surveys). The grids should be smoothed, or per-cell noise
+    in the gradients shortens every step. Returns the shift and whether it converged.
+    '''
+    rows, cols = np.indices(reference.shape)
+    shift = np.array(shift, dtype=float)
+
+    for _ in range(iterations):
+        sampled, d_row, d_col = bilinear_sample(moving, rows + shift[0], cols + shift[1], gradient=True)
+        differences = reference - sampled
+        used = ~np.isnan(differences)
+        if used.sum() <= 3:
+            return shift, False
+
+        median = np.median(differences[used])
+        spread = 1.4826 * np.median(np.abs(differences[used] - median))
+        used &= np.abs(differences - median) <= Z_OUTLIER_SIGMAS * max(spread, np.finfo(float).eps)
+
+        design = np.stack([d_row[used], d_col[used], np.ones(used.sum())], axis=1)
+        step, _, rank, _ = np.linalg.lstsq(design, differences[used], rcond=None)
+        if rank < 3:
+            return shift, False
+
+        shift += step[:2]
+        if np.abs(step[:2]).max() < tolerance:
+            return shift, True
+
+    return shift, False
+
+def shift_spread(reference, moving, shift):
+    # Half the largest disagreement between the shifts refined on opposite halves of the grids, in cells
+    height, width = reference.shape
+    pairs = [((slice(None), slice(0, width // 2)), (slice(None), slice(width // 2, None))),
+             ((slice(0, height // 2), slice(None)), (slice(height // 2, None), slice(None)))]
+
+    spread = 0
+    for first, second in pairs:
+        (first_shift, first_converged), (second_shift, second_converged) = (
+            refine_shift(reference[half], moving[half], shift) for half in (first, second))
+        if not (first_converged and second_converged):
+            return np.inf
+        spread = max(spread, np.abs(first_shift - second_shift).max() / 2)
+    return spread
+
+def gradient_correlation(reference, moving, shift):
+    '''
+    Correlation coefficient of the two grids' gradients once moving is shifted by shift. The
+    terrain's relief is common to both surveys while their noise isn't, so this says how
+    much of what lined them up was ground: near 1 on real relief, near 0 on a plane, on
+    relief smaller than the noise, or on unrelated surfaces.
+    '''
+    rows, cols = np.indices(reference.shape)
+    _, reference_row, reference_col = bilinear_sample(reference, rows, cols, gradient=True)
+    _, moving_row, moving_col = bilinear_sample(moving, rows + shift[0], cols + shift[1], gradient=True)
+    used = ~(np.isnan(reference_row) | np.isnan(moving_row))
+    if not used.any():
+        return 0.0
+
+    reference_gradients = np.concatenate([reference_row[used] - reference_row[used].mean(), reference_col[used] - reference_col[used].mean()])
+    moving_gradients = np.concatenate([moving_row[used] - moving_row[used].mean(), moving_col[used] - moving_col[used].mean()])
+    scale = np.sqrt((reference_gradients @ reference_gradients) * (moving_gradients @ moving_gradients))
+    return float(reference_gradients @ moving_gradients / max(scale, np.finfo(float).tiny))
+
+def median_z_offset(reference, moving, shift, resolution):
+    '''
+    Robust vertical offset from moving to reference once moving is shifted by shift (rows,
+    columns): the median difference over stable ground, taken twice so the second pass can
+    leave out what changed between the surveys. Returns the offset, the fraction of the
+    overlapping stable cells within Z_TOLERANCE of it and the robust spread of the differences
+    it was taken over.
+    '''
+    rows, cols = np.indices(reference.shape)
+    differences = reference - bilinear_sample(moving, rows + shift[0], cols + shift[1])
+
+    slope = np.degrees(np.arctan(np.hypot(*np.gradient(reference, resolution))))
+    stable = ~np.isnan(differences) & (slope < STABLE_SLOPE)
+    if not stable.any():
+        raise ValueError("No stable ground common to both point clouds.")
+
+    offset = np.median(differences[stable])
+    spread = 1.4826 * np.median(np.abs(differences[stable] - offset))
+    kept = stable & (np.abs(differences - offset) <= Z_OUTLIER_SIGMAS * max(spread, np.finfo(float).eps))
+    offset = np.median(differences[kept])
+    spread = 1.4826 * np.median(np.abs(differences[kept] - offset))
+    agreeing = stable & (np.abs(differences - offset) <= Z_TOLERANCE)
+    return offset, agreeing.sum() / stable.sum(), spread
+
+def estimate_dem_memory(filepaths, resolution=DEM_RESOLUTION):
+    # Memory register_dem needs for the grids over these clouds and one chunk of points, for budgeting stages
+    filepaths = [filepath for filepath in filepaths if filepath is not None and Path(filepath).exists()]
+    if not filepaths:
+        return 0
+    x_bins, y_bins = utils.gridding.grid_edges(*utils.gridding.header_bounds(filepaths), resolution)
+    return (len(x_bins) - 1) * (len(y_bins) - 1) * DEM_BYTES_PER_CELL + POINTS_PER_CHUNK * CHUNK_BYTES_PER_POINT
+
+def register_dem(before_path, after_path, resolution=DEM_RESOLUTION):
+    '''
+    Translation taking the after cloud onto the before one, found from their ground surfaces
+    alone: the horizontal part by cross-correlating the two ground grids and refining that by
+    least squares, the vertical part as the median height difference over stable ground once
+    they line up. Cheap, and good for the pure shifts GPS and boresight errors between flights
+    mostly are; ICP can take the rest from there. Returns the 4x4 transformation and a report
+    like register_pyramid's.
+
+    Ground with too little relief, or too little in common, can't fix the shift, so rather
+    than apply a guess this raises RegistrationError when the gradients don't correlate, the
+    halves of the grids disagree on the shift by more than MAX_DEM_SHIFT_ERROR or too little
+    stable ground agrees in height.
+    '''
+    print("Correlating ground surfaces...")
+    started = time.perf_counter()
+    x_bins, y_bins = utils.gridding.grid_edges(*utils.gridding.header_bounds([before_path, after_path]), resolution)
+    before = ground_grid(before_path, x_bins, y_bins)
+    after = ground_grid(after_path, x_bins, y_bins)
+    if not (np.isfinite(before) & np.isfinite(after)).any():
         raise ValueError("No overlapping region between point clouds.")
 
-    intersection_bbox = o3d.geometry.AxisAlignedBoundingBox(min_bound, max_bound)
-    before_pcd = before_pcd.crop(intersection_bbox)
-    after_pcd = after_pcd.crop(intersection_bbox)
+    coarse_shift = cross_correlation(smooth_grid(before, DEM_SMOOTHING, fill=True), smooth_grid(after, DEM_SMOOTHING, fill=True))
+    smooth_before, smooth_after = smooth_grid(before, DEM_SMOOTHING), smooth_grid(after, DEM_SMOOTHING)
+    shift, converged = refine_shift(smooth_before, smooth_after, coarse_shift)
+    shift_error = shift_spread(smooth_before, smooth_after, shift) * resolution if converged else np.inf
+    correlation = gradient_correlation(smooth_before, smooth_after, shift)
+    z_offset, fitness, spread = median_z_offset(before, after, shift, resolution)
 
-    print(f"Cropped to intersection: {before_pcd} and {after_pcd}")
+    report = []
+    report_level(report, 'dem', resolution, fitness, spread, started)
+    report[-1].update(gradient_correlation=correlation, shift_error=shift_error)
+    print(f"Gradient correlation {correlation:.2f}, shift error {shift_error:.3f} m")
 
-    print("Preprocessing...")
-    before_down, before_fpfh = preprocess(before_pcd, voxel_size)
-    after_down, after_fpfh = preprocess(after_pcd, voxel_size)
+    problems = []
+    if correlation < MIN_DEM_CORRELATION:
+        problems.append(f"the ground gradients only correlate at {correlation:.2f}")
+    if not converged:
+        problems.append("the shift did not converge")
+    elif shift_error > MAX_DEM_SHIFT_ERROR:
+        problems.append(f"halves of the ground disagree on the shift by {shift_error:.2f} m")
+    if fitness < MIN_STABLE_FRACTION:
+        problems.append(f"only {fitness:.0%} of the stable ground agrees once aligned")
+    if problems:
+        utils.run_report.record(registration=report)
+        raise RegistrationError(f"DEM registration is unreliable: {', '.join(problems)}. Try feature registration instead.")
 
-    print("Running global alignment...")
-    ransac_result = global_align(after_down, before_down, after_fpfh, before_fpfh, voxel_size)
+    # Rows run north to south, so a shift down the grid is a shift south
+    transformation = np.eye(4)
+    transformation[:3, 3] = [-shift[1] * resolution, shift[0] * resolution, z_offset]
 
-    # print("Refining with ICP...")
-    # before_pcd.estimate_normals(
-    #     o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 2, max_nn=30)
-    # )
-    # after_pcd.estimate_normals(
-    #     o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 2, max_nn=30)
-    # )
+    print(f"Ground offset: {transformation[0, 3]:.3f}, {transformation[1, 3]:.3f}, {transformation[2, 3]:.3f} m")
+    return transformation, report
 
-    # icp_result = refine_icp(after_pcd, before_pcd, ransac_result.transformation, 0.5)
+def register_laz(before_path, after_path, voxel_size=2.0, adjusted_path=None, method='features', icp=True,
+                 icp_voxel_sizes=ICP_VOXEL_SIZES, ransac_time_budget=RANSAC_TIME_BUDGET, cache_directory=None):
+    '''
+    Align the after cloud to the before one and write it to adjusted_path. method picks the
+    coarse alignment, 'features' (FPFH and RANSAC) or 'dem' (ground surface correlation); icp
+    refines it at icp_voxel_sizes, and can be turned off for 'dem' when a translation is
+    enough, which then never loads the clouds whole. With a cache_directory, the downsampled
+    clouds and features are kept there between runs (see CroppedCloud).
+    '''
+    if method not in REGISTRATION_METHODS:
+        raise ValueError(f"Unknown registration method: {method}")
+    if adjusted_path is None:
+        adjusted_path = Path(after_path).parent / "after-adjusted.laz"
 
+    with laspy.open(before_path) as before_lasf, laspy.open(after_path) as after_lasf:
+        crs = before_lasf.header.parse_crs()
+        # Intersect the bounding boxes the headers record
+        min_bound = np.maximum(before_lasf.header.mins, after_lasf.header.mins)
+        max_bound = np.minimum(before_lasf.header.maxs, after_lasf.header.maxs)
 
-    print("Applying transformation and saving...")
-    # Transform full original point cloud (not cropped)
-    full_after_pcd, _ = load_laz_as_pcd(after_path)
-    full_after_pcd.transform(ransac_result.transformation)
+    if method == 'dem':
+        transformation, report = register_dem(before_path, after_path)
+
+    if method == 'features' or icp:
+        if np.any(min_bound >= max_bound):
+            raise ValueError("No overlapping region between point clouds.")
+
+        cache = utils.feature_cache.FeatureCache(cache_directory) if cache_directory is not None else None
+        before_cloud = CroppedCloud(before_path, min_bound, max_bound, cache)
+        after_cloud = CroppedCloud(after_path, min_bound, max_bound, cache)
 
-    # Apply transformation to original LAS data
-    save_pcd_as_laz(full_after_pcd, crs, adjusted_path)
+        if method == 'features':
+            transformation, report = register_pyramid(after_cloud, before_cloud, voxel_size, icp_voxel_sizes if icp else [], ransac_time_budget)
+        else:
+            transformation = refine_levels(after_cloud, before_cloud, transformation, icp_voxel_sizes, report)
+
+    utils.run_report.record(registration=report)
+
+    print("Applying transformation and saving...")
+    # Stream the full original point cloud (not cropped) through the transformation
+    apply_transformation(after_path, transformation, adjusted_path, crs)
 
     print(f"Saved adjusted point cloud to: {adjusted_path}")
 
 
 if __name__ == "__main__":
     import sys
-    if len(sys.argv) != 3:
-        print("Usage: python register_laz.py before.laz after.laz")
+    if len(sys.argv) not in (3, 4) or sys.argv[3:] and sys.argv[3] not in REGISTRATION_METHODS:
+        print("Usage: python register_laz.py before.laz after.laz [features|dem]")
     else:
-        register_laz(sys.argv[1], sys.argv[2])
+        register_laz(sys.argv[1], sys.argv[2], method=(sys.argv[3:] or ['features'])[0])
@@ -0,0 +1,240 @@
+import utils.cog
+
+import laspy
+import numpy as np
+import rasterio
+import rasterio.windows
+from fastlog import log
+from rasterio.transform import from_origin
+
+import contextlib
+import csv
+import json
+import math
+from pathlib import Path
+
+
+# How many points to hold in memory at once while streaming a cloud into tiles
+POINTS_PER_CHUNK = 5_000_000
+
+TILE_INDEX_NAME = 'tiles.json'
+
+
+def plan_tiles(bounds, tile_size, buffer):
+    '''
+    Cover bounds = (xmin, ymin, xmax, ymax) with a grid of tile_size squares. The grid is snapped to
+    multiples of tile_size so that tiles from repeat flights line up. Each tile has a "core" it is
+    responsible for in the final mosaic and a "buffered" extent that is actually processed, so that
+    edge effects (DEM interpolation, tree segmentation, slope kernels) stay outside the core.
+    '''
+    if buffer >= tile_size / 2:
+        raise ValueError(f'Tile buffer ({buffer}) must be less than half the tile size ({tile_size})')
+
+    xmin, ymin, xmax, ymax = bounds
+    x0 = math.floor(xmin / tile_size) * tile_size
+    y0 = math.floor(ymin / tile_size) * tile_size
+    columns = max(1, math.ceil((xmax - x0) / tile_size))
+    rows = max(1, math.ceil((ymax - y0) / tile_size))
+
+    tiles = []
+    for row in range(rows):
+        for column in range(columns):
+            core = (x0 + column*tile_size, y0 + row*tile_size, x0 + (column+1)*tile_size, y0 + (row+1)*tile_size)
+            tiles.append({
+                'name': f'tile_{row:03d}_{column:03d}',
+                'row': row,
+                'column': column,
+                'core_bounds': core,
+                'buffered_bounds': (core[0] - buffer, core[1] - buffer, core[2] + buffer, core[3] + buffer),
+            })
+
+    grid = {'origin': (x0, y0), 'tile_size': tile_size, 'buffer': buffer, 'rows': rows, 'columns': columns}
+    return tiles, grid
+
+
+def tile_candidates(coordinates, origin, tile_size, buffer, count):
+    # Since buffer < tile_size/2, a buffered coordinate can fall in at most two neighbouring tiles per axis
+    low = np.floor((coordinates - origin - buffer) / tile_size).astype(np.int64)
+    high = np.floor((coordinates - origin + buffer) / tile_size).astype(np.int64)
+    return np.clip(low, 0, count - 1), np.clip(high, 0, count - 1)
+
+
+def split_las(las_path, tiles, grid, tile_dir, file_name):
+    '''
+    Stream las_path once and write each point into every tile whose buffered extent contains it.
+    Returns the set of tile names that received points.
+    '''
+    x0, y0 = grid['origin']
+    tile_size, buffer = grid['tile_size'], grid['buffer']
+    rows, columns = grid['rows'], grid['columns']
+
+    written = set()
+
+    with laspy.open(las_path) as reader, contextlib.ExitStack() as stack:
+        writers = {}
+
+        for chunk in reader.chunk_iterator(POINTS_PER_CHUNK):
+            x = np.asarray(chunk.x)
+            y = np.asarray(chunk.y)
+
+            column_low, column_high = tile_candidates(x, x0, tile_size, buffer, columns)
+            row_low, row_high = tile_candidates(y, y0, tile_size, buffer, rows)
+
+            # Gather (tile, point) pairs for all four corner combinations, skipping duplicates
+            tile_indices = []
+            point_indices = []
+            for row_index, use_row in ((row_low, None), (row_high, row_high != row_low)):
+                for column_index, use_column in ((column_low, None), (column_high, column_high != column_low)):
+                    keep = np.ones(len(x), dtype=bool)
+                    if use_row is not None:
+                        keep &= use_row
+                    if use_column is not None:
+                        keep &= use_column
+
+                    points = np.flatnonzero(keep)
+                    tile_indices.append(row_index[points]*columns + column_index[points])
+                    point_indices.append(points)
+
+            tile_indices = np.concatenate(tile_indices)
+            point_indices = np.concatenate(point_indices)
+
+            # The clipped candidates over-approximate at the grid edges, so test buffered bounds exactly
+            order = np.argsort(tile_indices, kind='stable')
+            tile_indices = tile_indices[order]
+            point_indices = point_indices[order]
+            boundaries = np.flatnonzero(np.diff(tile_indices)) + 1
+            starts = np.concatenate(([0], boundaries))
+
+            for start, tile_points in zip(starts, np.split(point_indices, boundaries)):
+                if len(tile_points) == 0:
+                    continue
+
+                tile = tiles[int(tile_indices[start])]
+                bxmin, bymin, bxmax, bymax = tile['buffered_bounds']
+                inside = (x[tile_points] >= bxmin) & (x[tile_points] < bxmax) & (y[tile_points] >= bymin) & (y[tile_points] < bymax)
+                tile_points = tile_points[inside]
+                if len(tile_points) == 0:
+                    continue
+
+                if tile['name'] not in writers:
+                    path = Path(tile_dir) / tile['name'] / file_name
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    writers[tile['name']] = stack.enter_context(laspy.open(path, mode='w', header=reader.header))
+
+                writers[tile['name']].write_points(chunk[tile_points])
+                written.add(tile['name'])
+
+    return written
+
+
+def split_inputs(las_path, tile_dir, tile_size, buffer, after_las_path=None):
+    '''
+    Cut las_path (and optionally the matching after-fire cloud, using the same grid) into buffered
+    tiles under tile_dir/<tile name>/. Writes an index describing each non-empty tile and returns it.
+    '''
+    with laspy.open(las_path) as reader:
+        header = reader.header
+        bounds = (header.mins[0], header.mins[1], header.maxs[0], header.maxs[1])
+
+    tiles, grid = plan_tiles(bounds, tile_size, buffer)
+    Path(tile_dir).mkdir(parents=True, exist_ok=True)
+    log.info(f'Splitting {las_path} into up to {len(tiles)} tiles of {tile_size}m with a {buffer}m buffer')
+
+    before_tiles = split_las(las_path, tiles, grid, tile_dir, 'before.laz')
+
+    after_tiles = set()
+    if after_las_path is not None:
+        log.info(f'Splitting {after_las_path} onto the same grid')
+        after_tiles = split_las(after_las_path, tiles, grid, tile_dir, 'after.laz')
+
+    index = {'grid': grid, 'tiles': []}
+    for tile in tiles:
+        tile_path = Path(tile_dir) / tile['name']
+        if tile['name'] not in before_tiles:
+            # The after cloud may reach past the before cloud; there is nothing to compare it to there
+            if tile_path.exists():
+                for path in tile_path.iterdir():
+                    path.unlink()
+                tile_path.rmdir()
+            continue
+
+        tile['before'] = 'before.laz'
+        tile['after'] = 'after.laz' if tile['name'] in after_tiles else None
+        index['tiles'].append(tile)
+
+    (Path(tile_dir) / TILE_INDEX_NAME).write_text(json.dumps(index, indent=2))
+    log.success(f'Wrote {len(index["tiles"])} non-empty tiles to {tile_dir}')
+
+    return index
+
+
+def load_tile_index(tile_dir):
+    return json.loads((Path(tile_dir) / TILE_INDEX_NAME).read_text())
+
+
+def mosaic_rasters(tile_rasters, output_path):
+    '''
+    Stitch per-tile rasters into one, taking from each tile only the pixels inside its core bounds.
+    tile_rasters is a list of (raster path, core bounds). Tiles are copied one window at a time, so
+    memory use is bounded by the tile size rather than the mosaic size.
+    '''
+    with rasterio.open(tile_rasters[0][0]) as first:
+        profile = first.profile.copy()
+        resolution_x, resolution_y = first.res
+        nodata = first.nodata
+        descriptions = first.descriptions
+
+    if nodata is None:
+        nodata = np.nan if np.issubdtype(np.dtype(profile['dtype']), np.floating) else 0
+
+    xmin = min(bounds[0] for _, bounds in tile_rasters)
+    ymin = min(bounds[1] for _, bounds in tile_rasters)
+    xmax = max(bounds[2] for _, bounds in tile_rasters)
+    ymax = max(bounds[3] for _, bounds in tile_rasters)
+
+    width = int(round((xmax - xmin) / resolution_x))
+    height = int(round((ymax - ymin) / resolution_y))
+    transform = from_origin(xmin, ymax, resolution_x, resolution_y)
+
+    with utils.cog.open_cog(output_path, width=width, height=height, count=profile['count'], dtype=profile['dtype'],
+                            crs=profile['crs'], transform=transform, nodata=nodata) as mosaic:
+        for band, description in enumerate(descriptions, 1):
+            if description:
+                mosaic.set_band_description(band, description)
+
+        for tile_path, core_bounds in tile_rasters:
+            window = rasterio.windows.from_bounds(*core_bounds, transform=transform).round_offsets().round_lengths()
+            window = window.intersection(rasterio.windows.Window(0, 0, width, height))
+
+            with rasterio.open(tile_path) as tile:
+                # Boundless read: the tile raster may not cover its whole core (e.g. no points in a corner)
+                source_window = rasterio.windows.from_bounds(*rasterio.windows.bounds(window, transform), transform=tile.transform)
+                data = tile.read(
+                    window=source_window.round_offsets().round_lengths(),
+                    out_shape=(tile.count, int(window.height), int(window.width)),
+                    boundless=True,
+                    fill_value=tile.nodata if tile.nodata is not None else nodata,
+                )
+
+                if tile.nodata is not None and tile.nodata != nodata:
+                    data[data == tile.nodata] = nodata
+
+            mosaic.write(data, window=window)
+
+
+def merge_tile_csvs(tile_csvs, output_path):
+    # Keep each tree only in the tile whose core contains its stem, so buffer overlaps aren't counted twice
+    fieldnames = None
+    rows = []
+    for csv_path, (xmin, ymin, xmax, ymax) in tile_csvs:
+        with Path(csv_path).open() as file:
+            reader = csv.DictReader(file)
+            fieldnames = fieldnames or reader.fieldnames
+            for row in reader:
+                if xmin <= float(row['X']) < xmax and ymin <= float(row['Y']) < ymax:
+                    rows.append(row)
+
+    with Path(output_path).open('w') as file:
+        writer = csv.DictWriter(file, fieldnames=fieldnames or ['X', 'Y', 'DBH', 'Height'])
+        writer.writeheader()
+        writer.writerows(rows)
@@ -0,0 +1,129 @@
+import numpy as np
+
+
+# Newton steps for the Taubin characteristic polynomial; it converges in a few
+NEWTON_ITERATIONS = 20
+# Tukey bisquare cutoff for robust reweighting, in units of the residuals' robust spread
+BISQUARE_CONSTANT = 4.685
+
+
+def fit_circles(points, valid, method='taubin', robust_iterations=3):
+    '''
+    Fit a circle to every row of a padded (B, N, 2) array of points at once, using only the
+    entries where the (B, N) valid mask is set.
+
+    method is 'kasa' (plain algebraic least squares, fast but biased small on partial arcs)
+    or 'taubin' (much less biased when a scan only sees one side of a trunk).
+    robust_iterations refits that many times with Tukey bisquare weights, so stray branch
+    or understory points pull less on the circle and far ones not at all.
+
+    Returns centres (B, 2), radii (B,) and residuals (B,), the RMS distance of the points
+    from the fitted circle. Rows with fewer than three points come back as NaN.
+    '''
+    if method not in ('kasa', 'taubin'):
+        raise ValueError(f'Unknown circle fit method: {method}')
+    weights = valid.astype(float)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Weights are settled with Kasa, which degrades gracefully when outliers are large
+        # compared to the trunk; Taubin only fits once they are down-weighted
+        for _ in range(robust_iterations):
+            centres, radii = kasa_fit(points, weights)
+            errors = np.abs(np.linalg.norm(points - centres[:, None, :], axis=2) - radii[:, None])
+            # 1.4826 * MAD estimates the standard deviation of normally distributed errors; padding sorts last
+            ordered = np.sort(np.where(valid, errors, np.inf), axis=1)
+            middle = np.maximum(valid.sum(axis=1) - 1, 0) // 2
+            scale = 1.4826 * np.take_along_axis(ordered, middle[:, None], axis=1)[:, 0]
+            cutoff = BISQUARE_CONSTANT * np.maximum(scale, 1e-6)[:, None]
+            weights = np.where(valid, np.clip(1 - (errors / cutoff)**2, 0, 1)**2, 0)
+
+        centres, radii = kasa_fit(points, weights)
+        if method == 'taubin':
+            # Taubin can still run off towards a huge circle through leftover outliers, so keep
+            # whichever fit is geometrically closer to the (weighted) points
+            taubin_centres, taubin_radii = taubin_fit(points, weights)
+            better = weighted_error(points, weights, taubin_centres, taubin_radii) < weighted_error(points, weights, centres, radii)
+            centres = np.where(better[:, None], taubin_centres, centres)
+            radii = np.where(better, taubin_radii, radii)
+
+        errors = np.linalg.norm(points - centres[:, None, :], axis=2) - radii[:, None]
+        residuals = np.sqrt((np.where(valid, errors, 0)**2).sum(axis=1) / valid.sum(axis=1))
+
+    too_few = valid.sum(axis=1) < 3
+    centres[too_few] = np.nan
+    radii[too_few] = np.nan
+    residuals[too_few] = np.nan
+
+    return centres, radii, residuals
+
+def weighted_error(points, weights, centres, radii):
+    errors = np.linalg.norm(points - centres[:, None, :], axis=2) - radii[:, None]
+    return np.nan_to_num((weights * errors**2).sum(axis=1), nan=np.inf)
+
+def weighted_moments(points, weights):
+    # Centre each row on its weighted mean so the moments stay well conditioned
+    total = weights.sum(axis=1)
+    mean = (points * weights[:, :, None]).sum(axis=1) / total[:, None]
+    x = points[:, :, 0] - mean[:, 0, None]
+    y = points[:, :, 1] - mean[:, 1, None]
+    z = x*x + y*y
+
+    def moment(values):
+        return (values * weights).sum(axis=1) / total
+
+    return mean, {
+        'xx': moment(x*x), 'yy': moment(y*y), 'xy': moment(x*y),
+        'xz': moment(x*z), 'yz': moment(y*z), 'zz': moment(z*z),
+    }
+
+def kasa_fit(points, weights):
+    '''
+    Minimise the algebraic distance sum((x² + y² + Dx + Ey + F)²), a linear least squares
+    problem. With centred coordinates its normal equations reduce to a 2x2 system per row.
+    '''
+    mean, m = weighted_moments(points, weights)
+
+    determinant = m['xx']*m['yy'] - m['xy']**2
+    centre_x = (m['xz']*m['yy'] - m['yz']*m['xy']) / determinant / 2
+    centre_y = (m['yz']*m['xx'] - m['xz']*m['xy']) / determinant / 2
+    radii = np.sqrt(centre_x**2 + centre_y**2 + m['xx'] + m['yy'])
+
+    return np.stack([centre_x, centre_y], axis=1) + mean, radii
+
+def taubin_fit(points, weights):
+    '''
+    Taubin's fit: the algebraic distance normalised by its gradient, which removes most of
+    Kasa's bias. Solved as the smallest root of its characteristic cubic with Newton's
+    method from zero (Chernov's formulation), vectorised over rows.
+    '''
+    mean, m = weighted_moments(points, weights)
+
+    mz = m['xx'] + m['yy']
+    covariance_xy = m['xx']*m['yy'] - m['xy']**2
+    variance_z = m['zz'] - mz**2
+
+    a3 = 4*mz
+    a2 = -3*mz**2 - m['zz']
+    a1 = variance_z*mz + 4*covariance_xy*mz - m['xz']**2 - m['yz']**2
+    a0 = m['xz']*(m['xz']*m['yy'] - m['yz']*m['xy']) + m['yz']*(m['yz']*m['xx'] - m['xz']*m['xy']) - variance_z*covariance_xy
+
+    root = np.zeros_like(mz)
+    value = a0.copy()
+    for _ in range(NEWTON_ITERATIONS):
+        derivative = a1 + root*(2*a2 + 3*a3*root)
+        step = np.where(derivative != 0, value / derivative, 0)
+        candidate = root - step
+        candidate_value = a0 + candidate*(a1 + candidate*(a2 + candidate*a3))
+        # Stop each row as soon as a step stops improving it
+        improved = np.isfinite(candidate) & (np.abs(candidate_value) < np.abs(value))
+        if not improved.any():
+            break
+        root = np.where(improved, candidate, root)
+        value = np.where(improved, candidate_value, value)
+
+    determinant = root**2 - root*mz + covariance_xy
+    centre_x = (m['xz']*(m['yy'] - root) - m['yz']*m['xy']) / determinant / 2
+    centre_y = (m['yz']*(m['xx'] - root) - m['xz']*m['xy']) / determinant / 2
+    radii = np.sqrt(centre_x**2 + centre_y**2 + mz)
+
+    return np.stack([centre_x, centre_y], axis=1) + mean, radii
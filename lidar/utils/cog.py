@@ -0,0 +1,81 @@
+import numpy as np
+import rasterio
+import rasterio.shutil
+
+import contextlib
+from pathlib import Path
+
+
+# Every raster product is a Cloud-Optimized GeoTIFF: tiled, compressed and with internal
+# overviews, so viewers and range reads only fetch the tiles and zoom level they need.
+# Internal tile size (pixels) and compression; ZSTD is smaller and faster than DEFLATE but
+# needs GDAL 2.3+ (or a recent geotiff.js) to read, so DEFLATE is the default
+BLOCK_SIZE = 512
+COMPRESSION = 'DEFLATE'
+
+
+def is_float(dtype):
+    return np.issubdtype(np.dtype(dtype), np.floating)
+
+def creation_options(dtype, compression=COMPRESSION, overview_resampling=None, num_threads=1):
+    '''
+    COG driver creation options for a raster of dtype: floating point prediction for floats
+    and horizontal differencing for integers. Overviews are averaged for continuous values
+    but nearest-neighbour for integers, which are counts or class codes, unless
+    overview_resampling says otherwise; a file mixing the two (e.g. the FlamMap landscape,
+    with its fuel model codes) should ask for NEAREST. Compression uses num_threads threads,
+    which callers size to the cores they were granted rather than every core on the machine.
+    '''
+    return {
+        'compress': compression,
+        'predictor': 'FLOATING_POINT' if is_float(dtype) else 'STANDARD',
+        'blocksize': BLOCK_SIZE,
+        'overviews': 'AUTO',
+        'overview_resampling': overview_resampling or ('AVERAGE' if is_float(dtype) else 'NEAREST'),
+        'bigtiff': 'IF_SAFER',
+        'num_threads': num_threads,
+    }
+
+def gdal_arguments(dtype, compression=COMPRESSION, overview_resampling=None, num_threads=1):
+    # The same options as command line arguments, for GDAL tools such as gdaldem
+    arguments = ['-of', 'COG']
+    for name, value in creation_options(dtype, compression, overview_resampling, num_threads).items():
+        arguments += ['-co', f'{name.upper()}={value}']
+    return arguments
+
+@contextlib.contextmanager
+def open_cog(path, width, height, count, dtype, crs, transform, nodata=None, compression=COMPRESSION,
+             overview_resampling=None, num_threads=1):
+    '''
+    Open a raster product for writing, yielding a dataset to write to window by window.
+
+    COGs can only be made by copying a finished raster, so the windows go to a tiled,
+    compressed GeoTIFF next to path, which is copied into a COG with overviews once the
+    block exits and then removed. If the block raises, nothing is written to path. See
+    creation_options for overview_resampling and num_threads.
+    '''
+    path = Path(path)
+    tiles_path = path.with_name(f'{path.stem}.tiles{path.suffix}')
+    profile = {
+        'driver': 'GTiff',
+        'width': width,
+        'height': height,
+        'count': count,
+        'dtype': dtype,
+        'crs': crs,
+        'transform': transform,
+        'nodata': nodata,
+        'tiled': True,
+        'blockxsize': BLOCK_SIZE,
+        'blockysize': BLOCK_SIZE,
+        'compress': compression,
+        'predictor': 3 if is_float(dtype) else 2,
+        'bigtiff': 'IF_SAFER',
+    }
+
+    try:
+        with rasterio.open(tiles_path, 'w', **profile) as dataset:
+            yield dataset
+        rasterio.shutil.copy(tiles_path, path, driver='COG', **creation_options(dtype, compression, overview_resampling, num_threads))
+    finally:
+        tiles_path.unlink(missing_ok=True)
@@ -0,0 +1,114 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+
+# Bump this to invalidate every entry written by an older layout
+CACHE_VERSION = 1
+
+
+class DiskCache:
+    '''
+    Size-capped directory of cache entries, one file each, named by a key hashed from whatever
+    identifies it. Subclasses decide what an entry holds (entry_suffix and how it is read and
+    written); this keeps the index, its locking and LRU eviction.
+
+    index.json keeps each entry's size and when it was last used, plus whatever else a subclass
+    stores with it. Entries and the index are written to a temporary file and moved into place,
+    so a reader never sees half of either, and every read-modify-write of the index holds an
+    flock on index.lock, so processes sharing a cache (e.g. --jobs workers) don't lose each
+    other's updates. Eviction also counts entries on disk that the index doesn't know of (say
+    from a run killed between writing an entry and indexing it), so the size cap holds regardless.
+    '''
+    entry_suffix = ''
+
+    def __init__(self, directory, max_bytes):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.index_path = self.directory / 'index.json'
+        self.lock_path = self.directory / 'index.lock'
+        self.lock = threading.Lock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @contextlib.contextmanager
+    def locked(self):
+        # Hold the index against other threads (self.lock) and other processes (the flock)
+        with self.lock, open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def load_index(self):
+        empty = {'version': CACHE_VERSION, 'entries': {}}
+        try:
+            index = json.loads(self.index_path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return empty
+        return index if index.get('version') == CACHE_VERSION else empty
+
+    def save_index(self, index):
+        tmp_path = self.index_path.with_name(f'index.{os.getpid()}.{threading.get_ident()}.json')
+        tmp_path.write_text(json.dumps(index, indent=2, sort_keys=True))
+        os.replace(tmp_path, self.index_path)
+
+    def entry_path(self, key):
+        return self.directory / f'{key}{self.entry_suffix}'
+
+    def partial_path(self, key):
+        # Where an entry is written before it is moved into place
+        return self.directory / f'{key}.{os.getpid()}.{threading.get_ident()}.partial{self.entry_suffix}'
+
+    @staticmethod
+    def key(*parts):
+        # Entry key of anything JSON can write, e.g. (file digest, crop box, voxel size)
+        text = json.dumps([CACHE_VERSION, *parts], default=str)
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+    def commit(self, key, tmp_path, **fields):
+        '''
+        Move an entry written to tmp_path into place and index it, with any extra fields.
+        Moved under the lock, so no other process can take it for an unindexed leftover.
+        '''
+        path = self.entry_path(key)
+        with self.locked():
+            os.replace(tmp_path, path)
+            index = self.load_index()
+            index['entries'][key] = {'bytes': path.stat().st_size, 'last_used': time.time(), **fields}
+            self.evict(index)
+            self.save_index(index)
+
+    def touch(self, key):
+        # Mark an entry used, unless another process evicted it meanwhile; returns whether it is still there
+        with self.locked():
+            return self.touch_locked(key)
+
+    def touch_locked(self, key):
+        # touch, for a caller already holding locked()
+        if not self.entry_path(key).exists():
+            return False
+        index = self.load_index()
+        entry = index['entries'].setdefault(key, {'bytes': self.entry_path(key).stat().st_size})
+        entry['last_used'] = time.time()
+        self.save_index(index)
+        return True
+
+    def evict(self, index):
+        # Drop least recently used entries until the rest fit in max_bytes; the newest always stays
+        entries = index['entries']
+        for path in self.directory.glob(self.entry_path('*').name):
+            # Entries are named by their key alone; temporary files have more dots
+            key = path.name[:-len(self.entry_suffix)] if self.entry_suffix else path.name
+            if '.' not in key and key not in entries:
+                stat = path.stat()
+                entries[key] = {'bytes': stat.st_size, 'last_used': stat.st_mtime}
+
+        total = sum(entry['bytes'] for entry in entries.values())
+        for key in sorted(entries, key=lambda key: entries[key]['last_used'])[:-1]:
+            if total <= self.max_bytes:
+                break
+            total -= entries.pop(key)['bytes']
+            self.entry_path(key).unlink(missing_ok=True)
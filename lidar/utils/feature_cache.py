@@ -0,0 +1,67 @@
+import numpy as np
+
+import hashlib
+import zipfile
+from pathlib import Path
+
+import utils.disk_cache
+
+
+# Files are hashed in chunks so multi-GB point clouds never need to fit in memory
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Entries are evicted, least recently used first, once the cache grows past this many bytes
+DEFAULT_MAX_BYTES = 4 * 1024**3
+
+
+class FeatureCache(utils.disk_cache.DiskCache):
+    '''
+    Size-capped on-disk store of named numpy arrays, e.g. the downsampled points, normals and
+    FPFH features registration derives from a cloud, so repeat runs against the same reference
+    cloud can skip deriving them.
+
+    Each entry is one uncompressed .npz file; the index, its locking and eviction are
+    DiskCache's. The index also keeps the content digest of each file hashed so far, so a
+    large file is only rehashed once its size or mtime changes.
+    '''
+    entry_suffix = '.npz'
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        super().__init__(directory, max_bytes)
+
+    def file_digest(self, path):
+        path = Path(path)
+        stat = path.stat()
+        name = str(path.resolve())
+
+        with self.locked():
+            known = self.load_index().get('files', {}).get(name)
+        if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known['digest']
+
+        digest = hashlib.blake2b(digest_size=16)
+        with path.open('rb') as file:
+            for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+
+        with self.locked():
+            index = self.load_index()
+            index.setdefault('files', {})[name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': digest.hexdigest()}
+            self.save_index(index)
+        return digest.hexdigest()
+
+    def load(self, key):
+        # The arrays stored under key, or None if there is no such entry
+        try:
+            with np.load(self.entry_path(key)) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            return None
+
+        self.touch(key)
+        return arrays
+
+    def store(self, key, arrays):
+        tmp_path = self.partial_path(key)
+        np.savez(tmp_path, **arrays)
+        self.commit(key, tmp_path)
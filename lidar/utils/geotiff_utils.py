@@ -1,5 +1,6 @@
 
-import rasterio ,rasterio.warp
+import rasterio ,rasterio.warp ,rasterio.windows
+import numpy as np
 
 
 def get_lat_long_bounds(geotiff_path, crs=4326):
@@ -19,4 +20,71 @@ def reproject(geotiff, dst_crs):
         rasterio.warp.reproject(rasterio.band(geotiff, i), rasterio.band(destination, i), geotiff.transform, geotiff.crs, dst_transform, dst_crs, resampling=rasterio.warp.Resampling.average)
 
     return destination
-    
+
+
+def pixel_positions(transform, xs, ys):
+    '''
+    Convert arrays of map coordinates to fractional (rows, cols) with one vectorised inverse
+    affine transform; pixel (i, j) spans [i, i+1) x [j, j+1).
+    '''
+    cols, rows = ~transform * (np.asarray(xs, dtype=float), np.asarray(ys, dtype=float))
+    return rows, cols
+
+def pixel_indices(transform, xs, ys):
+    # (rows, cols) of the pixels containing the coordinates, floored like rasterio's dataset.index
+    rows, cols = pixel_positions(transform, xs, ys)
+    return np.floor(rows).astype(np.int64), np.floor(cols).astype(np.int64)
+
+def sample_raster(geotiff, xs, ys, band=1):
+    '''
+    Sample an open raster at N map coordinates, reading only the blocks that contain points.
+    Returns a masked array of the band's dtype, masked where a point falls outside the raster
+    or on nodata.
+    '''
+    rows, cols = pixel_indices(geotiff.transform, xs, ys)
+    values = np.ma.masked_all(rows.shape, dtype=geotiff.dtypes[band-1])
+
+    inside = (rows >= 0) & (rows < geotiff.height) & (cols >= 0) & (cols < geotiff.width)
+    points = np.nonzero(inside)[0]
+    if len(points) == 0:
+        return values
+
+    # Bucket points by the block they fall in, then read each touched block once
+    block_height, block_width = geotiff.block_shapes[band-1]
+    block_rows, block_cols = rows[points] // block_height, cols[points] // block_width
+    blocks_across = -(-geotiff.width // block_width)
+    block_keys = block_rows * blocks_across + block_cols
+    order = np.argsort(block_keys, kind='stable')
+    keys, starts = np.unique(block_keys[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+
+    for key, start, end in zip(keys, starts, ends):
+        row_offset, col_offset = (key // blocks_across) * block_height, (key % blocks_across) * block_width
+        window = rasterio.windows.Window(col_offset, row_offset, block_width, block_height).intersection(
+            rasterio.windows.Window(0, 0, geotiff.width, geotiff.height))
+        block = geotiff.read(band, window=window)
+
+        in_block = points[order[start:end]]
+        values[in_block] = block[rows[in_block] - row_offset, cols[in_block] - col_offset]
+
+    # Nodata, and NaN in float rasters, are as good as missing
+    if geotiff.nodata is not None:
+        values[values.data == geotiff.nodata] = np.ma.masked
+    if np.issubdtype(values.dtype, np.floating):
+        values[np.isnan(values.data)] = np.ma.masked
+
+    return values
+
+def sample_rasters(geotiff_paths, xs, ys, band=1):
+    # Sample several rasters (which may be on different grids) at the same map coordinates
+    samples = []
+    for geotiff_path in geotiff_paths:
+        with rasterio.open(geotiff_path) as geotiff:
+            samples.append(sample_raster(geotiff, xs, ys, band))
+    return samples
+
+def block_windows(height, width, block_size):
+    # Square windows of at most block_size pixels a side that tile a height x width grid, in raster order
+    for row in range(0, height, block_size):
+        for col in range(0, width, block_size):
+            yield rasterio.windows.Window(col, row, min(block_size, width - col), min(block_size, height - row))
@@ -0,0 +1,203 @@
+import laspy
+import numpy as np
+
+from pathlib import Path
+
+
+# Statistics grid_statistics can compute; 'p<N>' is any percentile, e.g. 'p50' or 'p95'
+STATISTICS = ['count', 'sum', 'mean', 'std', 'min', 'max']
+# ...and those GridMoments accumulates chunk by chunk; the rest need all of a cell's values at once
+MOMENT_STATISTICS = ['count', 'sum', 'mean', 'std']
+
+# (cell, value) pairs as spilled to disk by spill_bands
+SPILL_DTYPE = np.dtype([('cell', np.int64), ('value', np.float64)])
+
+
+def header_bounds(filepaths):
+    # Union of the bounding boxes in the LAS headers, without reading any points
+    mins, maxs = [], []
+    for filepath in filepaths:
+        with laspy.open(filepath) as lasf:
+            mins.append(lasf.header.mins)
+            maxs.append(lasf.header.maxs)
+    xmin, ymin = np.min(mins, axis=0)[0:2]
+    xmax, ymax = np.max(maxs, axis=0)[0:2]
+    return xmin, xmax, ymin, ymax
+
+def grid_edges(xmin, xmax, ymin, ymax, resolution):
+    # Cell edges snapped out to whole metres
+    x_bins = np.arange(np.floor(xmin), np.ceil(xmax) + resolution, resolution)
+    y_bins = np.arange(np.floor(ymin), np.ceil(ymax) + resolution, resolution)
+    return x_bins, y_bins
+
+def cell_indices(x, y, x_bins, y_bins):
+    '''
+    Flat raster-order (north-up) cell index of each point, -1 for points off the grid. Like
+    binned_statistic_2d, points on the last edge fall in the last cell.
+    '''
+    width, height = len(x_bins) - 1, len(y_bins) - 1
+    resolution = x_bins[1] - x_bins[0]
+    cols = np.floor((x - x_bins[0]) / resolution).astype(np.int64)
+    rows = np.floor((y - y_bins[0]) / resolution).astype(np.int64)
+    cols[x == x_bins[-1]] = width - 1
+    rows[y == y_bins[-1]] = height - 1
+
+    on_grid = (cols >= 0) & (cols < width) & (rows >= 0) & (rows < height)
+    return np.where(on_grid, (height - 1 - rows) * width + cols, -1)
+
+def percentile_of(statistic):
+    # The percentile a 'p<N>' statistic asks for, or None if it isn't one
+    if statistic.startswith('p'):
+        try:
+            percentile = float(statistic[1:])
+        except ValueError:
+            return None
+        if 0 <= percentile <= 100:
+            return percentile
+    return None
+
+def grid_statistics(cells, values, cell_count, statistics):
+    '''
+    Compute several per-cell statistics of values in one sweep, given each value's flat cell
+    index (negative for none). Returns a dict of flat grids of cell_count cells: counts as
+    int64, everything else as float64, with empty cells 0 for count and sum and NaN otherwise
+    (as binned_statistic_2d has them).
+
+    Values are sorted once by (cell, value), so each cell is a contiguous sorted segment:
+    sums are segment reductions, min/max are the segment ends and percentiles (interpolated
+    linearly, like np.percentile) are read straight out of it. Without min, max or
+    percentiles the sort is skipped and everything is a bincount.
+    '''
+    for statistic in statistics:
+        if statistic not in STATISTICS and percentile_of(statistic) is None:
+            raise ValueError(f'Unsupported statistic: {statistic}')
+
+    on_grid = cells >= 0
+    cells, values = cells[on_grid], values[on_grid].astype(float)
+    counts = np.bincount(cells, minlength=cell_count)
+    occupied = counts > 0
+    results = {}
+
+    def empty():
+        return np.full(cell_count, np.nan)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sums = np.bincount(cells, weights=values, minlength=cell_count)
+        means = np.where(occupied, sums / counts, np.nan)
+
+        for statistic in statistics:
+            if statistic == 'count':
+                results[statistic] = counts
+            elif statistic == 'sum':
+                results[statistic] = sums
+            elif statistic == 'mean':
+                results[statistic] = means
+            elif statistic == 'std':
+                # Population standard deviation, from deviations about the mean rather than sums of squares
+                deviations = np.bincount(cells, weights=(values - means[cells])**2, minlength=cell_count)
+                results[statistic] = np.sqrt(deviations / np.where(occupied, counts, np.nan))
+
+        ordered = [statistic for statistic in statistics if statistic not in results]
+        if ordered:
+            order = np.lexsort((values, cells))
+            values = values[order]
+            starts = np.concatenate([[0], np.cumsum(counts)])[:-1][occupied]
+            lengths = counts[occupied]
+
+            for statistic in ordered:
+                results[statistic] = empty()
+                if statistic == 'min':
+                    results[statistic][occupied] = values[starts]
+                elif statistic == 'max':
+                    results[statistic][occupied] = values[starts + lengths - 1]
+                else:
+                    position = (lengths - 1) * percentile_of(statistic) / 100
+                    below = np.floor(position).astype(np.int64)
+                    above = np.minimum(below + 1, lengths - 1)
+                    fraction = position - below
+                    results[statistic][occupied] = values[starts + below] * (1 - fraction) + values[starts + above] * fraction
+
+    return results
+
+
+class GridMoments:
+    '''
+    Per-cell count, mean and sum of squared deviations of values fed in chunk by chunk, so
+    count, sum, mean and std of a cloud of any size cost memory for the grid only. Each chunk
+    is reduced with bincounts over the span of cells it touches and merged in with the
+    pairwise update of Chan et al., which keeps std as stable as grid_statistics' two-pass one.
+    '''
+    def __init__(self, cell_count):
+        self.counts = np.zeros(cell_count, dtype=np.int64)
+        self.means = np.zeros(cell_count)
+        self.deviations = np.zeros(cell_count)
+
+    def add(self, cells, values):
+        on_grid = cells >= 0
+        if not on_grid.any():
+            return
+        cells, values = cells[on_grid], values[on_grid].astype(float)
+        first = cells.min()
+        span = slice(first, cells.max() + 1)
+        cells = cells - first
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            counts = np.bincount(cells)
+            touched = counts > 0
+            means = np.bincount(cells, weights=values) / counts
+            deviations = np.bincount(cells, weights=(values - means[cells])**2)
+
+            previous = self.counts[span]
+            total = previous + counts
+            delta = np.where(touched, means - self.means[span], 0)
+            self.means[span] += np.where(touched, delta * counts / total, 0)
+            self.deviations[span] += np.where(touched, deviations + delta**2 * previous * counts / total, 0)
+            self.counts[span] = total
+
+    def statistics(self, statistics, cells=slice(None)):
+        # The statistics (of MOMENT_STATISTICS) of some cells, in the form grid_statistics returns them
+        counts = self.counts[cells]
+        occupied = counts > 0
+        results = {}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for statistic in statistics:
+                if statistic == 'count':
+                    results[statistic] = counts
+                elif statistic == 'sum':
+                    results[statistic] = self.means[cells] * counts
+                elif statistic == 'mean':
+                    results[statistic] = np.where(occupied, self.means[cells], np.nan)
+                elif statistic == 'std':
+                    results[statistic] = np.sqrt(self.deviations[cells] / np.where(occupied, counts, np.nan))
+                else:
+                    raise ValueError(f'{statistic} can\'t be accumulated chunk by chunk')
+        return results
+
+def band_spill_path(spill_directory, name, band):
+    return Path(spill_directory) / f'{name}_band_{band}.bin'
+
+def spill_bands(cells, values, spill_directory, name, band_cells):
+    '''
+    Append one chunk's on-grid (cell, value) pairs to per-band files, a band being band_cells
+    consecutive cells, so statistics that need every value of a cell can be computed a band
+    at a time after one streaming pass.
+    '''
+    on_grid = cells >= 0
+    pairs = np.empty(np.count_nonzero(on_grid), dtype=SPILL_DTYPE)
+    pairs['cell'] = cells[on_grid]
+    pairs['value'] = values[on_grid]
+
+    bands = pairs['cell'] // band_cells
+    order = np.argsort(bands, kind='stable')
+    band_ids, starts = np.unique(bands[order], return_index=True)
+    for band, band_pairs in zip(band_ids, np.split(pairs[order], starts[1:])):
+        with band_spill_path(spill_directory, name, band).open('ab') as file:
+            band_pairs.tofile(file)
+
+def load_band(spill_directory, name, band):
+    # The (cells, values) spilled for one band (empty if the cloud never reached it)
+    path = band_spill_path(spill_directory, name, band)
+    if not path.exists():
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    pairs = np.fromfile(path, dtype=SPILL_DTYPE)
+    return pairs['cell'], pairs['value']
@@ -0,0 +1,113 @@
+import numpy as np
+
+
+# Lloyd iterations allowed per k, the same as scipy's kmeans2
+MAX_ITERATIONS = 10
+
+
+def pad_points(slices):
+    '''
+    Stack variable-length (n, d) point arrays into a zero-padded (B, N, d) array and a (B, N)
+    mask of which entries are real points. Each slice is centred on its own mean first, so
+    clustering works on small numbers rather than full UTM coordinates; the (B, d) means are
+    returned too, to map results back.
+    '''
+    dimensions = slices[0].shape[1] if slices else 3
+    length = max([len(points) for points in slices] + [1])
+
+    padded = np.zeros((len(slices), length, dimensions))
+    valid = np.zeros((len(slices), length), dtype=bool)
+    origins = np.zeros((len(slices), dimensions))
+    for i, points in enumerate(slices):
+        if len(points):
+            origins[i] = points.mean(axis=0)
+            padded[i, :len(points)] = points - origins[i]
+            valid[i, :len(points)] = True
+
+    return padded, valid, origins
+
+def squared_distances(points, centres):
+    # (B, N, d) points against (B, k, d) centres -> (B, N, k), as |p|² - 2p·c + |c|² so it is one matmul
+    return (points**2).sum(axis=2)[:, :, None] - 2*np.matmul(points, centres.transpose(0, 2, 1)) + (centres**2).sum(axis=2)[:, None, :]
+
+def batched_kmeans(points, valid, max_k, draws, iterations=MAX_ITERATIONS):
+    '''
+    Cluster every row of a padded batch for k = 1..max_k in one vectorised pass.
+
+    Rather than starting each k from scratch, k starts from the k-1 solution plus one new
+    centre, picked k-means++ style with probability proportional to squared distance from the
+    existing centres. draws is a (B, max_k) array of uniforms in [0, 1) that makes those
+    picks; seeding it per row keeps each row's result independent of what it is batched with.
+    Clusters that empty out are reseeded at the point furthest from its centre rather than
+    given up on.
+
+    Returns labels of shape (max_k, B, N), with -1 on padding.
+    '''
+    batch, length, dimensions = points.shape
+    rows = np.arange(batch)
+    point_count = valid.sum(axis=1)
+
+    labels = np.full((max_k, batch, length), -1, dtype=np.int8)
+    centres = np.zeros((batch, max_k, dimensions))
+
+    for k in range(1, max_k + 1):
+        if k > 1:
+            # k-means++ pick of the new centre, from the squared distance to the nearest existing one
+            nearest = squared_distances(points, centres[:, :k-1]).min(axis=2)
+            cumulative = np.cumsum(np.where(valid, np.maximum(nearest, 0), 0), axis=1)
+            target = draws[:, k-1] * cumulative[:, -1]
+            pick = (cumulative <= target[:, None]).sum(axis=1)
+            # Rows whose points all coincide with a centre have nothing to pick from
+            pick = np.where(cumulative[:, -1] > 0, np.minimum(pick, point_count - 1), 0)
+            centres[:, k-1] = points[rows, pick]
+
+        labels[k-1] = lloyd(points, valid, centres[:, :k], iterations)
+
+    return labels
+
+def lloyd(points, valid, centres, iterations):
+    '''
+    Refines centres in place and returns the final labels. A row whose labels stop changing
+    has converged and is dropped from later iterations, so a batch costs about as much as
+    its rows need rather than as much as its slowest row.
+    '''
+    batch, length, dimensions = points.shape
+    k = centres.shape[1]
+    label = np.full((batch, length), -1)
+    active = np.arange(batch)
+
+    for _ in range(iterations):
+        row_points, row_valid = points[active], valid[active]
+        row_centres = centres[active]
+
+        # |p|² is the same for every centre, so it can be left out when only picking the nearest
+        scores = (row_centres**2).sum(axis=2)[:, None, :] - 2*np.matmul(row_points, row_centres.transpose(0, 2, 1))
+        new_label = np.where(row_valid, scores.argmin(axis=2), -1)
+        changed = (new_label != label[active]).any(axis=1)
+        label[active] = new_label
+
+        # Sum each cluster's points with one bincount per dimension over (row, cluster) bins
+        bins = (np.arange(len(active))[:, None]*k + new_label)[row_valid]
+        sizes = np.bincount(bins, minlength=len(active)*k).reshape(-1, k)
+        sums = np.stack([np.bincount(bins, weights=row_points[:, :, d][row_valid], minlength=len(active)*k) for d in range(dimensions)], axis=1)
+        sums = sums.reshape(-1, k, dimensions)
+        row_centres = np.where(sizes[:, :, None] > 0, sums / np.maximum(sizes, 1)[:, :, None], row_centres)
+
+        # Reseed empty clusters at the point furthest from its own centre (impossible with fewer than k points)
+        empty = (sizes == 0) & (row_valid.sum(axis=1) >= k)[:, None]
+        for row in np.nonzero(empty.any(axis=1))[0]:
+            own = ((row_points[row] - row_centres[row, np.maximum(new_label[row], 0)])**2).sum(axis=1)
+            own = np.where(row_valid[row], own, -1)
+            for cluster in np.nonzero(empty[row])[0]:
+                furthest = own.argmax()
+                row_centres[row, cluster] = row_points[row, furthest]
+                # Don't hand the same point to two empty clusters
+                own[furthest] = -1
+            changed[row] = True
+
+        centres[active] = row_centres
+        active = active[changed]
+        if len(active) == 0:
+            break
+
+    return label
@@ -0,0 +1,349 @@
+import utils.run_report
+
+from fastlog import log
+
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+
+# Files are hashed in chunks so multi-GB point clouds never need to fit in memory
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Bump this to invalidate every manifest written by an older pipeline layout
+MANIFEST_VERSION = 1
+
+# Share of physical memory the scheduler hands out when no budget is given
+DEFAULT_MEMORY_FRACTION = 0.8
+
+
+class StageError(RuntimeError):
+    pass
+
+
+class Stage:
+    '''
+    One node of the processing graph.
+
+    The action is called as action(*inputs, *outputs, **params), except that each output is
+    replaced with a temporary path next to it. Outputs are only moved into place once the
+    action returns and every temporary output exists, so a crashed run never leaves behind
+    something that looks finished.
+
+    cpus and memory (in bytes) are what the stage is expected to use while running; the
+    scheduler only starts it once that much of the budget is free. Network-bound stages can
+    declare cpus=0 so they overlap with everything else.
+
+    Stages that size a thread or process pool can name a keyword argument in cpus_param,
+    which is passed the cpus the scheduler actually granted (never more than the budget).
+    It is left out of the signature: it changes how fast a stage runs, not what it writes.
+    '''
+    def __init__(self, name, action, inputs=(), outputs=(), params=None, code=(), cpus=1, memory=0, cpus_param=None):
+        self.name = name
+        self.action = action
+        self.inputs = [Path(path) for path in inputs]
+        self.outputs = [Path(path) for path in outputs]
+        self.params = dict(params or {})
+        self.code = [Path(path) for path in code]
+        self.cpus = cpus
+        self.memory = memory
+        self.cpus_param = cpus_param
+
+    def code_version(self):
+        digest = hashlib.blake2b(digest_size=16)
+
+        try:
+            digest.update(inspect.getsource(self.action).encode('utf-8'))
+        except (OSError, TypeError):
+            digest.update(repr(self.action).encode('utf-8'))
+
+        for path in self.code:
+            digest.update(path.read_bytes())
+
+        return digest.hexdigest()
+
+
+def physical_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        # Not available on this platform; don't let memory limit anything
+        return float('inf')
+
+def default_memory_budget():
+    return physical_memory() * DEFAULT_MEMORY_FRACTION
+
+
+def partial_path(path):
+    # Keep the suffix so tools that pick a driver from the extension (GDAL, PDAL, R) still work
+    return path.with_name(f'{path.stem}.partial{path.suffix}')
+
+
+class Pipeline:
+    def __init__(self, manifest_path):
+        self.manifest_path = Path(manifest_path)
+        self.stages = {}
+        self.manifest = self.load_manifest()
+        # Stages run on worker threads; guards the manifest while they record file hashes
+        self.lock = threading.Lock()
+        # Performance of each stage executed by the last run, see utils.run_report
+        self.metrics = {}
+
+    def load_manifest(self):
+        empty = {'version': MANIFEST_VERSION, 'files': {}, 'stages': {}}
+
+        if not self.manifest_path.exists():
+            return empty
+
+        try:
+            manifest = json.loads(self.manifest_path.read_text())
+        except json.JSONDecodeError:
+            log.warning(f'Ignoring unreadable manifest at {self.manifest_path}')
+            return empty
+
+        if manifest.get('version') != MANIFEST_VERSION:
+            return empty
+
+        return manifest
+
+    def save_manifest(self):
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = partial_path(self.manifest_path)
+        with self.lock:
+            text = json.dumps(self.manifest, indent=2, sort_keys=True)
+        tmp_path.write_text(text)
+        os.replace(tmp_path, self.manifest_path)
+
+    def add(self, stage):
+        if stage.name in self.stages:
+            raise ValueError(f'Duplicate stage name: {stage.name}')
+
+        for other in self.stages.values():
+            clashes = set(stage.outputs) & set(other.outputs)
+            if clashes:
+                raise ValueError(f'Stages {other.name} and {stage.name} both produce {clashes.pop()}')
+
+        self.stages[stage.name] = stage
+        return stage
+
+    def producer_of(self, path):
+        for stage in self.stages.values():
+            if path in stage.outputs:
+                return stage
+        return None
+
+    def dependencies(self, stage):
+        producers = [self.producer_of(path) for path in stage.inputs]
+        return [producer for producer in producers if producer is not None]
+
+    def ordered_stages(self):
+        # Kahn's algorithm, breaking ties by declaration order so logs read like the old script
+        remaining = list(self.stages.values())
+        ordered = []
+        done = set()
+
+        while remaining:
+            for stage in remaining:
+                if all(dependency.name in done for dependency in self.dependencies(stage)):
+                    break
+            else:
+                raise ValueError(f'Cycle in stage graph between: {", ".join(stage.name for stage in remaining)}')
+
+            remaining.remove(stage)
+            ordered.append(stage)
+            done.add(stage.name)
+
+        return ordered
+
+
+    # --- HASHING ---
+
+    def hash_file(self, path):
+        stat = path.stat()
+        key = str(path.resolve())
+
+        # Reuse the stored digest while size and mtime are unchanged; rehashing GBs of LAZ is slow
+        with self.lock:
+            cached = self.manifest['files'].get(key)
+        if cached and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+            return cached['digest']
+
+        digest = hashlib.blake2b(digest_size=16)
+        with path.open('rb') as file:
+            for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+
+        with self.lock:
+            self.manifest['files'][key] = {
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'digest': digest.hexdigest(),
+            }
+        return digest.hexdigest()
+
+    def hash_path(self, path):
+        if not path.is_dir():
+            return self.hash_file(path)
+
+        digest = hashlib.blake2b(digest_size=16)
+        for child in sorted(path.rglob('*')):
+            if child.is_file():
+                digest.update(str(child.relative_to(path)).encode('utf-8'))
+                digest.update(self.hash_file(child).encode('utf-8'))
+        return digest.hexdigest()
+
+    def signature(self, stage):
+        return {
+            'inputs': {str(path): self.hash_path(path) for path in stage.inputs},
+            'params': json.loads(json.dumps(stage.params, default=str)),
+            'code': stage.code_version(),
+        }
+
+
+    # --- EXECUTION ---
+
+    def is_up_to_date(self, stage, signature):
+        record = self.manifest['stages'].get(stage.name)
+        if record is None or record['signature'] != signature:
+            return False
+
+        for path in stage.outputs:
+            if not path.exists() or record['outputs'].get(str(path)) != self.hash_path(path):
+                return False
+
+        return True
+
+    def execute(self, stage, cpus):
+        tmp_outputs = [partial_path(path) for path in stage.outputs]
+
+        # Clear leftovers from a crashed run
+        for tmp_path in tmp_outputs:
+            remove_path(tmp_path)
+            tmp_path.parent.mkdir(parents=True, exist_ok=True)
+
+        try:
+            try:
+                with utils.run_report.measure(stage.name, stage.inputs, tmp_outputs) as metrics:
+                    granted = {stage.cpus_param: max(1, cpus)} if stage.cpus_param else {}
+                    stage.action(*stage.inputs, *tmp_outputs, **stage.params, **granted)
+            finally:
+                with self.lock:
+                    self.metrics[stage.name] = metrics.as_dict()
+
+            missing = [path for path in tmp_outputs if not path.exists()]
+            if missing:
+                raise StageError(f'{stage.name} did not produce {", ".join(map(str, missing))}')
+
+            for tmp_path, path in zip(tmp_outputs, stage.outputs):
+                remove_path(path)
+                os.replace(tmp_path, path)
+
+        finally:
+            for tmp_path in tmp_outputs:
+                remove_path(tmp_path)
+
+    def process(self, stage, cpus):
+        # Runs on a worker thread: hashing and execution both happen off the scheduler
+        signature = self.signature(stage)
+
+        if self.is_up_to_date(stage, signature):
+            log.info(f'Skipping - {stage.name}: up to date at {", ".join(map(str, stage.outputs))}')
+            return 'up to date', None
+
+        log.info(f'Running {stage.name} -> {", ".join(map(str, stage.outputs))}')
+        self.execute(stage, cpus)
+
+        return 'done', {
+            'signature': signature,
+            'outputs': {str(path): self.hash_path(path) for path in stage.outputs},
+        }
+
+    def run(self, cpus=None, memory=None):
+        '''
+        Run every stage whose inputs, parameters or code changed since it last succeeded,
+        along with everything downstream of it. Each stage starts as soon as the stages it
+        depends on have finished and its cpus/memory fit in what is left of the budget.
+        Returns a dict of stage name -> status.
+        '''
+        cpus = cpus or os.cpu_count() or 1
+        memory = memory or default_memory_budget()
+
+        statuses = {}
+        self.metrics = {}
+        pending = self.ordered_stages()
+        running = {}
+        used_cpus = 0
+        used_memory = 0
+
+        with ThreadPoolExecutor(max_workers=max(1, len(pending))) as executor:
+            while pending or running:
+
+                # Start (or give up on) every stage whose dependencies have all finished
+                for stage in list(pending):
+                    dependencies = self.dependencies(stage)
+                    if any(dependency.name not in statuses for dependency in dependencies):
+                        continue
+
+                    blocked = [dependency.name for dependency in dependencies if statuses[dependency.name] in ('failed', 'skipped')]
+                    if blocked:
+                        log.warning(f'❌ Skipping - {stage.name}: depends on unfinished stage {", ".join(blocked)}')
+                        statuses[stage.name] = 'skipped'
+                        pending.remove(stage)
+                        continue
+
+                    missing = [path for path in stage.inputs if not path.exists()]
+                    if missing:
+                        log.warning(f'❌ Skipping - {stage.name}: missing input {", ".join(map(str, missing))}')
+                        statuses[stage.name] = 'skipped'
+                        pending.remove(stage)
+                        continue
+
+                    # A stage bigger than the whole budget still runs, just on its own
+                    stage_cpus = min(stage.cpus, cpus)
+                    stage_memory = min(stage.memory, memory)
+                    if running and (used_cpus + stage_cpus > cpus or used_memory + stage_memory > memory):
+                        continue
+
+                    pending.remove(stage)
+                    running[executor.submit(self.process, stage, stage_cpus)] = (stage, stage_cpus, stage_memory)
+                    used_cpus += stage_cpus
+                    used_memory += stage_memory
+
+                if not running:
+                    continue
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage, stage_cpus, stage_memory = running.pop(future)
+                    used_cpus -= stage_cpus
+                    used_memory -= stage_memory
+
+                    try:
+                        statuses[stage.name], record = future.result()
+                    except Exception as e:
+                        log.warning(f'❌ {stage.name} failed: {e}')
+                        with self.lock:
+                            self.manifest['stages'].pop(stage.name, None)
+                        self.save_manifest()
+                        statuses[stage.name] = 'failed'
+                        continue
+
+                    if record is not None:
+                        with self.lock:
+                            self.manifest['stages'][stage.name] = record
+                        self.save_manifest()
+
+        # Report in declaration order regardless of completion order
+        return {name: statuses[name] for name in self.stages}
+
+
+def remove_path(path):
+    if path.is_dir():
+        shutil.rmtree(path)
+    elif path.exists():
+        path.unlink()
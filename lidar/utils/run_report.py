@@ -0,0 +1,270 @@
+import laspy
+import rasterio
+from fastlog import log
+
+import contextlib
+import contextvars
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+
+# How often the resident memory of this process is sampled while a stage runs
+RSS_SAMPLE_INTERVAL = 0.25
+
+# ru_maxrss is in KiB on Linux but bytes on macOS
+MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+# The metrics of the stage running on the current thread, so run_command can attach child usage to it
+current_metrics = contextvars.ContextVar('current_metrics', default=None)
+
+# Stages being measured right now in this process, so each knows which others shared it
+running_metrics = set()
+running_lock = threading.Lock()
+
+
+def current_rss():
+    # /proc is cheap to read; elsewhere fall back to the high-water mark, which only ever grows
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSS_UNIT
+
+
+def path_size(path):
+    path = Path(path)
+    if path.is_dir():
+        return sum(child.stat().st_size for child in path.rglob('*') if child.is_file())
+    return path.stat().st_size if path.exists() else 0
+
+
+def count_elements(path):
+    # Points in a point cloud or pixels in a raster, read from the header only
+    path = Path(path)
+    try:
+        if path.suffix.lower() in ('.las', '.laz'):
+            with laspy.open(path) as reader:
+                return 'points', reader.header.point_count
+        if path.suffix.lower() in ('.tif', '.tiff'):
+            with rasterio.open(path) as raster:
+                return 'pixels', raster.width * raster.height
+    except Exception as e:
+        log.debug(f'Could not count elements in {path}: {e}')
+    return None, 0
+
+
+class StageMetrics:
+    def __init__(self, name, inputs=(), outputs=()):
+        self.name = name
+        self.inputs = [Path(path) for path in inputs]
+        self.outputs = [Path(path) for path in outputs]
+        self.children = []
+        self.details = {}
+        self.peak_rss = 0
+        self.overlapping = set()
+        self._stop = threading.Event()
+
+    def add_child(self, command, wall, usage):
+        # usage is a resource.struct_rusage, e.g. from wait4 or sent back by a pool worker
+        self.children.append({
+            'command': ' '.join(map(str, command))[:200],
+            'wall_s': wall,
+            'user_cpu_s': usage.ru_utime,
+            'system_cpu_s': usage.ru_stime,
+            'peak_rss_bytes': usage.ru_maxrss * MAXRSS_UNIT,
+        })
+
+    def _sample_rss(self):
+        while not self._stop.wait(RSS_SAMPLE_INTERVAL):
+            self.peak_rss = max(self.peak_rss, current_rss())
+
+    def start(self):
+        self.bytes_read = sum(path_size(path) for path in self.inputs)
+        self.input_counts = {}
+        for path in self.inputs:
+            kind, count = count_elements(path)
+            if kind:
+                self.input_counts[kind] = self.input_counts.get(kind, 0) + count
+
+        self.peak_rss = current_rss()
+        self._sampler = threading.Thread(target=self._sample_rss, daemon=True)
+        self._sampler.start()
+
+        with running_lock:
+            for other in running_metrics:
+                other.overlapping.add(self.name)
+                self.overlapping.add(other.name)
+            running_metrics.add(self)
+
+        self._wall = time.perf_counter()
+        self._thread_cpu = time.thread_time()
+        self._self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        self._child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    def stop(self):
+        self.wall = time.perf_counter() - self._wall
+        self.thread_cpu = time.thread_time() - self._thread_cpu
+
+        # Process-wide deltas, so native threads (lazrs, GDAL, Open3D, BLAS) and every child
+        # reaped meanwhile (run_command, pool workers) count; other stages running at the same
+        # time are counted too, which is what overlapping records
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.process_cpu = (self_usage.ru_utime - self._self_usage.ru_utime) + (self_usage.ru_stime - self._self_usage.ru_stime)
+        self.child_cpu = (child_usage.ru_utime - self._child_usage.ru_utime) + (child_usage.ru_stime - self._child_usage.ru_stime)
+        # ru_maxrss of children is a high-water mark over every child ever reaped, so it only says
+        # something about this stage if it rose
+        self.reaped_peak_rss = child_usage.ru_maxrss * MAXRSS_UNIT if child_usage.ru_maxrss > self._child_usage.ru_maxrss else 0
+
+        with running_lock:
+            running_metrics.discard(self)
+
+        self._stop.set()
+        self._sampler.join()
+        self.peak_rss = max(self.peak_rss, current_rss())
+
+        self.bytes_written = sum(path_size(path) for path in self.outputs)
+
+    def as_dict(self):
+        child_rss = max([child['peak_rss_bytes'] for child in self.children] + [self.reaped_peak_rss])
+
+        return {
+            'wall_s': self.wall,
+            # Everything this process and its reaped children used while the stage ran: exact when
+            # the stage ran alone, an upper bound shared with the stages in overlapping otherwise
+            'cpu_s': self.process_cpu + self.child_cpu,
+            'cpu_s_is_upper_bound': bool(self.overlapping),
+            'overlapping': sorted(self.overlapping),
+            'process_cpu_s': self.process_cpu,
+            'child_cpu_s': self.child_cpu,
+            # Python on the stage's own thread alone, a lower bound that no other stage inflates
+            'stage_thread_cpu_s': self.thread_cpu,
+            # This process is shared by concurrently running stages, so its peak is an upper bound
+            'process_peak_rss_bytes': self.peak_rss,
+            # The largest child: exact for children listed in children, else the reaped high-water mark
+            'child_peak_rss_bytes': child_rss,
+            'input_counts': self.input_counts,
+            'throughput_per_s': {kind: count / self.wall for kind, count in self.input_counts.items()} if self.wall > 0 else {},
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'children': self.children,
+            # Anything the stage itself reported with record()
+            **({'details': self.details} if self.details else {}),
+        }
+
+
+@contextlib.contextmanager
+def measure(name, inputs=(), outputs=()):
+    '''
+    Measure a stage. Subprocesses started with run_command inside the block are attributed
+    to it, including their exact peak memory. Yields the StageMetrics, which is filled in
+    when the block exits (even if it raises).
+    '''
+    metrics = StageMetrics(name, inputs, outputs)
+    token = current_metrics.set(metrics)
+    metrics.start()
+    try:
+        yield metrics
+    finally:
+        metrics.stop()
+        current_metrics.reset(token)
+
+
+def add_child(command, wall, usage):
+    # Attach the usage of a child run_command didn't start (e.g. a pool worker reporting its own) to this context's stage
+    metrics = current_metrics.get()
+    if metrics is not None:
+        metrics.add_child(command, wall, usage)
+
+def record(**details):
+    # Add details (e.g. registration quality) to the report of the stage running in this context, if any
+    metrics = current_metrics.get()
+    if metrics is not None:
+        metrics.details.update(details)
+
+def run_command(command, input=None, capture_output=False, check=True, **kwargs):
+    '''
+    Like subprocess.run, but reaps the child with wait4 so its own cpu time and peak memory
+    can be added to the stage that started it. Captured output goes through temporary files
+    rather than pipes, since draining pipes would reap the child before wait4 could.
+    '''
+    command = [str(arg) for arg in command]
+    tic = time.perf_counter()
+
+    with contextlib.ExitStack() as stack:
+        stdin = stdout = stderr = None
+        if input is not None:
+            stdin = stack.enter_context(tempfile.TemporaryFile())
+            stdin.write(input)
+            stdin.seek(0)
+        if capture_output:
+            stdout = stack.enter_context(tempfile.TemporaryFile())
+            stderr = stack.enter_context(tempfile.TemporaryFile())
+
+        process = subprocess.Popen(command, stdin=stdin, stdout=stdout, stderr=stderr, **kwargs)
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+        result = subprocess.CompletedProcess(command, process.returncode)
+        if capture_output:
+            stdout.seek(0)
+            stderr.seek(0)
+            result.stdout = stdout.read()
+            result.stderr = stderr.read()
+
+    metrics = current_metrics.get()
+    if metrics is not None:
+        metrics.add_child(command, time.perf_counter() - tic, usage)
+
+    if check:
+        result.check_returncode()
+    return result
+
+
+def code_version():
+    try:
+        result = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=Path(__file__).parent, capture_output=True, text=True)
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def write_run_report(report_path, pipelines, started, **extra):
+    '''
+    Write a JSON report for a whole run. pipelines maps a label (an input file, a tile, ...) to
+    a dict with its stage statuses, wall time and per-stage metrics.
+    '''
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    report = {
+        'started': datetime.fromtimestamp(started, timezone.utc).isoformat(),
+        'wall_s': time.time() - started,
+        'code_version': code_version(),
+        'host': {'node': platform.node(), 'cpus': os.cpu_count(), 'python': platform.python_version()},
+        # Totals for the coordinating process; worker processes report their own stages
+        'process': {
+            'cpu_s': self_usage.ru_utime + self_usage.ru_stime,
+            'child_cpu_s': child_usage.ru_utime + child_usage.ru_stime,
+            'peak_rss_bytes': self_usage.ru_maxrss * MAXRSS_UNIT,
+            'child_peak_rss_bytes': child_usage.ru_maxrss * MAXRSS_UNIT,
+        },
+        **extra,
+        'pipelines': pipelines,
+    }
+
+    report_path = Path(report_path)
+    tmp_path = report_path.with_name(f'{report_path.stem}.partial{report_path.suffix}')
+    tmp_path.write_text(json.dumps(report, indent=2, default=str))
+    os.replace(tmp_path, report_path)
+
+    log.info(f'Run report saved to {report_path}')
@@ -0,0 +1,51 @@
+import numpy as np
+
+from pathlib import Path
+
+
+# Voxel keys pack (column, row, level) into one int64, so a set of voxels is a sorted key array
+LEVEL_BITS = 16
+ROW_BITS = 24
+COLUMN_BITS = 24
+MAX_LEVEL = 2**LEVEL_BITS - 1
+MAX_ROW = 2**ROW_BITS - 1
+MAX_COLUMN = 2**COLUMN_BITS - 1
+
+
+def pack_keys(columns, rows, levels):
+    return (columns.astype(np.int64) << (ROW_BITS + LEVEL_BITS)) | (rows.astype(np.int64) << LEVEL_BITS) | levels.astype(np.int64)
+
+def unpack_keys(keys):
+    columns = keys >> (ROW_BITS + LEVEL_BITS)
+    rows = (keys >> LEVEL_BITS) & MAX_ROW
+    levels = keys & MAX_LEVEL
+    return columns, rows, levels
+
+def tile_of(columns, rows, tile_size, tiles_across):
+    # Index of the square tile (of tile_size columns a side) that holds each column
+    return (rows // tile_size) * tiles_across + columns // tile_size
+
+def spill_path(spill_directory, name, tile):
+    return Path(spill_directory) / f'{name}_{tile}.bin'
+
+def spill_keys(keys, spill_directory, name, tile_size, tiles_across):
+    '''
+    Append the distinct voxel keys of one chunk of points to per-tile files, so a cloud of any
+    size can be turned into occupancy in one streaming pass and then read back a tile at a time.
+    '''
+    keys = np.unique(keys)
+    columns, rows, _ = unpack_keys(keys)
+    tiles = tile_of(columns, rows, tile_size, tiles_across)
+
+    order = np.argsort(tiles, kind='stable')
+    tile_ids, starts = np.unique(tiles[order], return_index=True)
+    for tile, tile_keys in zip(tile_ids, np.split(keys[order], starts[1:])):
+        with spill_path(spill_directory, name, tile).open('ab') as file:
+            tile_keys.tofile(file)
+
+def load_tile_keys(spill_directory, name, tile):
+    # The distinct, sorted voxel keys spilled for one tile (empty if the cloud never reached it)
+    path = spill_path(spill_directory, name, tile)
+    if not path.exists():
+        return np.zeros(0, dtype=np.int64)
+    return np.unique(np.fromfile(path, dtype=np.int64))
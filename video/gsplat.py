@@ -1,5 +1,4 @@
 import argparse
-import subprocess
 from pathlib import Path
 import time
 
@@ -8,6 +7,8 @@ import docker.types
 
 from fastlog import log
 
+import run_report
+
 log_level_options = [log.WARNING, log.INFO, log.DEBUG]
 
 
@@ -23,6 +24,7 @@ def run_in_docker(command, image, mounts):
     container = client.containers.run(image, command, auto_remove=True, runtime='nvidia', detach=True, device_requests=[gpu_device], mounts=mounts, environment={'PYTORCH_CUDA_ALLOC_CONF':'expandable_segments:True'})
     log_stream = container.attach(stream=True, logs=True, stderr=True, stdout=True)
     container.start()
+    monitor = run_report.ContainerMonitor(container, command, image)
 
     # TODO: make a fastlog pipe so I don't have to do these shenanigans
 
@@ -52,12 +54,13 @@ def run_in_docker(command, image, mounts):
             log.debug(fragment)
 
     log.debug(remnant)
+    monitor.stop()
 
 
 def generate_images(video_path, images_path, sample_rate, image_name_pattern):
     images_path.mkdir(parents=True, exist_ok=True)
     # TODO: catch stdout in fastlog.debug
-    return subprocess.call(['ffmpeg', '-i', video_path, '-vf', f'fps={sample_rate}', images_path / image_name_pattern])
+    return run_report.call(['ffmpeg', '-i', video_path, '-vf', f'fps={sample_rate}', images_path / image_name_pattern])
 
 
 def generate_sfm_colmap(images_path, database_path, sparse_path):
@@ -120,12 +123,12 @@ def generate_sfm_mvg(images_path, openmvg_path, geo_method='non-rigid', geo_matc
         image_list_command = [openmvg_binary_path / 'openMVG_main_SfMInit_ImageListing', '-d', camera_database_path, '-i', images_path, '-o', matches_path, '-f', '2400', '-c', '1' ]
         if geo_method or geo_matching:
             image_list_command.extend(['-P', '--gps_to_xyz_method', '1'])
-        subprocess.call(image_list_command)
+        run_report.call(image_list_command)
         
         log.info('Compute Features...')
         # openMVG_main_ComputeFeatures -i matches/sfm_data.json -o matches
         # Artifact: match files in the specifies output directory
-        subprocess.call([openmvg_binary_path / 'openMVG_main_ComputeFeatures', '-i', json_path, '-o', matches_path ])
+        run_report.call([openmvg_binary_path / 'openMVG_main_ComputeFeatures', '-i', json_path, '-o', matches_path ])
         
         log.info(f'List Pairs from {"GPS Exif" if geo_matching else "Video Adjacency"} Data...')
         # openMVG_main_ListMatchingPairs -G -n 5 -i Dataset/matching/sfm_data.bin -o Dataset/matching/pair_list.txt
@@ -133,25 +136,25 @@ def generate_sfm_mvg(images_path, openmvg_path, geo_method='non-rigid', geo_matc
         if geo_matching:
             pair_list_command = [openmvg_binary_path / 'openMVG_main_ListMatchingPairs', '-i', json_path, '-o', parilist_path]
             pair_list_command.extend(['-G', '-n', str(matching_neighbors)])            
-            subprocess.call(pair_list_command)
+            run_report.call(pair_list_command)
         else:
             pair_list_command = [openmvg_binary_path / 'openMVG_main_PairGenerator', '-i', json_path, '-o', parilist_path]
             # pair_list_command.extend(['-m', 'CONTIGUOUS', '-c', '15'])            
-            subprocess.call(pair_list_command)
+            run_report.call(pair_list_command)
         # pair_list_command = [openmvg_binary_path / 'openMVG_main_ListMatchingPairs', '-i', json_path, '-o', parilist_path]
         # if geo_matching:
         #     pair_list_command.extend(['-G', '-n', str(matching_neighbors)])            
         # else:
         #     pair_list_command.extend(['-V', '-n', str(matching_neighbors)])
-        # subprocess.call(pair_list_command)
+        # run_report.call(pair_list_command)
         
 
         log.info('Compute Matches...')
         # openMVG_main_ComputeMatches -i matches/sfm_data.json -o matches
-        subprocess.call([openmvg_binary_path / 'openMVG_main_ComputeMatches', '-i', json_path, '-o', matches_path / 'matches.putative.bin', '-p', parilist_path])
+        run_report.call([openmvg_binary_path / 'openMVG_main_ComputeMatches', '-i', json_path, '-o', matches_path / 'matches.putative.bin', '-p', parilist_path])
 
         log.info('Filter Matches...')
-        subprocess.call([openmvg_binary_path / 'openMVG_main_GeometricFilter', '-i', json_path, '-m', matches_path / 'matches.putative.bin' , '-g' , 'f' , '-o' , matches_path / 'matches.f.bin' ] )
+        run_report.call([openmvg_binary_path / 'openMVG_main_GeometricFilter', '-i', json_path, '-m', matches_path / 'matches.putative.bin' , '-g' , 'f' , '-o' , matches_path / 'matches.f.bin' ] )
 
 
         log.info('Run SFM...')
@@ -159,20 +162,20 @@ def generate_sfm_mvg(images_path, openmvg_path, geo_method='non-rigid', geo_matc
         sfm_command = [openmvg_binary_path / 'openMVG_main_SfM', '-i', json_path, '-m', matches_path, '-o', reconstruction_path, '-s', 'INCREMENTAL']
         if geo_method == 'non-rigid':
             sfm_command.extend(['-P'])
-        subprocess.call(sfm_command)
+        run_report.call(sfm_command)
 
 
         if geo_method == 'rigid':
 
             log.info('Do GPS Transformation...')
             # openMVG_main_geodesy_registration_to_gps_position -i Dataset/out_Reconstruction/sfm_data.bin -o Dataset/out_Reconstruction/sfm_data_adjusted.bin
-            subprocess.call([openmvg_binary_path / 'openMVG_main_geodesy_registration_to_gps_position', '-i', reconstruction_path / 'sfm_data.bin', '-o', adjusted_json_path])
+            run_report.call([openmvg_binary_path / 'openMVG_main_geodesy_registration_to_gps_position', '-i', reconstruction_path / 'sfm_data.bin', '-o', adjusted_json_path])
             # json_path = openmvg_path / 'sfm_data_adjusted.json'
 
         else:
             log.info('Recover SFM JSON...')
             # openMVG_main_geodesy_registration_to_gps_position -i Dataset/out_Reconstruction/sfm_data.bin -o Dataset/out_Reconstruction/sfm_data_adjusted.bin
-            subprocess.call([openmvg_binary_path / 'openMVG_main_ConvertSfM_DataFormat', '-i', reconstruction_path / 'sfm_data.bin', '-o', adjusted_json_path])
+            run_report.call([openmvg_binary_path / 'openMVG_main_ConvertSfM_DataFormat', '-i', reconstruction_path / 'sfm_data.bin', '-o', adjusted_json_path])
             # json_path = openmvg_path / 'sfm_data_adjusted.json'
 
 
@@ -180,7 +183,7 @@ def generate_sfm_mvg(images_path, openmvg_path, geo_method='non-rigid', geo_matc
         log.info('Colorize...')
         # openMVG_main_ComputeSfM_DataColor -i reconstruction/incremental/sfm_data.bin -o reconstruction/colorized.ply
         # THIS MUST TAKE THE .BIN
-        subprocess.call([openmvg_binary_path / 'openMVG_main_ComputeSfM_DataColor', '-i', reconstruction_path / 'sfm_data.bin', '-o', openmvg_path / 'colorized.ply'])
+        run_report.call([openmvg_binary_path / 'openMVG_main_ComputeSfM_DataColor', '-i', reconstruction_path / 'sfm_data.bin', '-o', openmvg_path / 'colorized.ply'])
 
     
 
@@ -231,6 +234,7 @@ if __name__ == '__main__':
     parser.add_argument('--verbosity', type=int, default=1)
 
     args = parser.parse_args()
+    started = time.time()
 
     # Process verbosity args
     verbosity = args.v if args.v else args.verbosity
@@ -257,70 +261,76 @@ if __name__ == '__main__':
     # FFMPEG
     # TODO: this step will need to do EXIF data tagging as well. TBD how we will transmit that info. Likely it will be encoded as subtitles
     # TODO: ODM may be able to handle EXIF tagging
-    tic = time.time()
-    if images_path.exists():
-        log.info(f'Skipping - Image Sampling: already exists at {images_path}')
-    else:
-        log.info(f'Running Image Sampling at {images_path}')
-        generate_images(video_path, images_path, 5, "out%d.png")
-    generate_images_time = time.time() - tic
+    with run_report.measure('images', [video_path], [images_path]) as images_metrics:
+        if images_path.exists():
+            log.info(f'Skipping - Image Sampling: already exists at {images_path}')
+        else:
+            log.info(f'Running Image Sampling at {images_path}')
+            generate_images(video_path, images_path, 5, "out%d.png")
 
     # SFM
-    tic = time.time()
-    if args.sfm == 'colmap':
-        if sparse_path.exists():
-            log.info(f'Skipping - SFM: already exists at {sparse_path}')
-        else:
-            log.info(f'Running {args.sfm} at {sparse_path}')
-            generate_sfm_colmap(images_path, database_path, sparse_path)
+    sfm_output_path = {'colmap': sparse_path, 'odm': odm_path, 'mvg': mvg_path}.get(args.sfm)
+    with run_report.measure('sfm', [images_path], [sfm_output_path] if sfm_output_path else []) as sparse_metrics:
+        if args.sfm == 'colmap':
+            if sparse_path.exists():
+                log.info(f'Skipping - SFM: already exists at {sparse_path}')
+            else:
+                log.info(f'Running {args.sfm} at {sparse_path}')
+                generate_sfm_colmap(images_path, database_path, sparse_path)
 
-    elif args.sfm == 'odm':
-        if odm_path.exists():
-            log.info(f'Skipping - SFM: already exists at {odm_path}')
-        else:
-            log.info(f'Running {args.sfm} at {odm_path}')
-            generate_sfm_odm(images_path, odm_path)
+        elif args.sfm == 'odm':
+            if odm_path.exists():
+                log.info(f'Skipping - SFM: already exists at {odm_path}')
+            else:
+                log.info(f'Running {args.sfm} at {odm_path}')
+                generate_sfm_odm(images_path, odm_path)
     
-    elif args.sfm == 'mvg':
-        if mvg_path.exists():
-            log.info(f'Skipping - SFM: already exists at {mvg_path}')
-        else:
-            log.info(f'Running {args.sfm} at {mvg_path}')
-            generate_sfm_mvg(images_path, mvg_path, geo_method=args.mvg_geo_method, geo_matching=args.mvg_geo_match)
-    generate_sparse_time = time.time() - tic
+        elif args.sfm == 'mvg':
+            if mvg_path.exists():
+                log.info(f'Skipping - SFM: already exists at {mvg_path}')
+            else:
+                log.info(f'Running {args.sfm} at {mvg_path}')
+                generate_sfm_mvg(images_path, mvg_path, geo_method=args.mvg_geo_method, geo_matching=args.mvg_geo_match)
 
 
     # PLY
-    tic = time.time()
-    if ply_path.exists():
-        log.info(f'Skipping - OpenSplat: already exists at {ply_path}')
-    else:
-        log.info(f'Running OpenSplat at {ply_path}')
-
-        mounts = [
-            docker.types.Mount('/data/images', str(images_path.absolute()), type='bind'),
-            docker.types.Mount('/data/output.splat', str(ply_path.absolute()), type='bind'),
-            docker.types.Mount('/data/cameras.json', str(ply_path.with_name('cameras.json').absolute()), type='bind')
-        ]
+    with run_report.measure('ply', [images_path], [ply_path]) as ply_metrics:
+        if ply_path.exists():
+            log.info(f'Skipping - OpenSplat: already exists at {ply_path}')
+        else:
+            log.info(f'Running OpenSplat at {ply_path}')
 
-        if args.sfm == 'colmap':
-            mounts.append(docker.types.Mount('/data/sparse', str(sparse_path.absolute()), type='bind'))
+            mounts = [
+                docker.types.Mount('/data/images', str(images_path.absolute()), type='bind'),
+                docker.types.Mount('/data/output.splat', str(ply_path.absolute()), type='bind'),
+                docker.types.Mount('/data/cameras.json', str(ply_path.with_name('cameras.json').absolute()), type='bind')
+            ]
 
-        elif args.sfm == 'odm':
-            mounts.append(docker.types.Mount('/data/opensfm', str(odm_path.absolute()), type='bind'))
+            if args.sfm == 'colmap':
+                mounts.append(docker.types.Mount('/data/sparse', str(sparse_path.absolute()), type='bind'))
 
-        elif args.sfm == 'mvg':
-           mounts.append(docker.types.Mount(f'/data/{images_path}', str(images_path.absolute()), type='bind'))
-           mounts.append(docker.types.Mount('/data/sfm_data.json', str((mvg_path / 'sfm_data.json').absolute()), type='bind'))
-           mounts.append(docker.types.Mount('/data/colorized.ply', str((mvg_path / 'colorized.ply').absolute()), type='bind'))
+            elif args.sfm == 'odm':
+                mounts.append(docker.types.Mount('/data/opensfm', str(odm_path.absolute()), type='bind'))
+
+            elif args.sfm == 'mvg':
+               mounts.append(docker.types.Mount(f'/data/{images_path}', str(images_path.absolute()), type='bind'))
+               mounts.append(docker.types.Mount('/data/sfm_data.json', str((mvg_path / 'sfm_data.json').absolute()), type='bind'))
+               mounts.append(docker.types.Mount('/data/colorized.ply', str((mvg_path / 'colorized.ply').absolute()), type='bind'))
 
-        generate_ply(mounts, 100_000)
-    generate_ply_time = time.time() - tic
+            generate_ply(mounts, 100_000)
 
 
     # REPORTING
-    log.info(f'generate_images_time: {generate_images_time:.2f}')
-    log.info(f'generate_sparse_time: {generate_sparse_time:.2f}')
-    log.info(f'generate_ply_time:    {generate_ply_time:.2f}')
-    log.info(f'total time elapsed:   {(generate_images_time + generate_sparse_time + generate_ply_time):.2f}')
-    log.info(f'ply is at:            {ply_path}')
\ No newline at end of file
+    log.info(f'generate_images_time: {images_metrics.wall:.2f}')
+    log.info(f'generate_sparse_time: {sparse_metrics.wall:.2f}')
+    log.info(f'generate_ply_time:    {ply_metrics.wall:.2f}')
+    log.info(f'total time elapsed:   {(images_metrics.wall + sparse_metrics.wall + ply_metrics.wall):.2f}')
+    log.info(f'ply is at:            {ply_path}')
+
+    run_report.write_run_report(
+        output_path / 'run_report.json',
+        {metrics.name: metrics.as_dict() for metrics in (images_metrics, sparse_metrics, ply_metrics)},
+        started,
+        dataset=args.dataset,
+        arguments=vars(args),
+    )
\ No newline at end of file
@@ -0,0 +1,165 @@
+from fastlog import log
+
+import contextlib
+import contextvars
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+
+# ru_maxrss is in KiB on Linux but bytes on macOS
+MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+# The metrics of the stage currently running, so commands and containers can attach their usage to it
+current_metrics = contextvars.ContextVar('current_metrics', default=None)
+
+
+def path_size(path):
+    path = Path(path)
+    if path.is_dir():
+        return sum(child.stat().st_size for child in path.rglob('*') if child.is_file())
+    return path.stat().st_size if path.exists() else 0
+
+
+def count_frames(path):
+    path = Path(path)
+    if not path.is_dir():
+        return 0
+    return sum(1 for child in path.iterdir() if child.suffix.lower() in ('.png', '.jpg', '.jpeg'))
+
+
+class StageMetrics:
+    def __init__(self, name, inputs=(), outputs=()):
+        self.name = name
+        self.inputs = [Path(path) for path in inputs]
+        self.outputs = [Path(path) for path in outputs]
+        self.children = []
+
+    def add_child(self, command, wall, cpu, peak_rss):
+        self.children.append({
+            'command': ' '.join(map(str, command))[:200],
+            'wall_s': wall,
+            'cpu_s': cpu,
+            'peak_rss_bytes': peak_rss,
+        })
+
+    def start(self):
+        self.bytes_read = sum(path_size(path) for path in self.inputs)
+        self.frames = sum(count_frames(path) for path in self.inputs)
+
+        self._wall = time.perf_counter()
+        self._self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        self._child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    def stop(self):
+        self.wall = time.perf_counter() - self._wall
+
+        # Stages run one after another, so process-wide deltas belong to this stage
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.python_cpu = (self_usage.ru_utime - self._self_usage.ru_utime) + (self_usage.ru_stime - self._self_usage.ru_stime)
+        self.child_cpu = (child_usage.ru_utime - self._child_usage.ru_utime) + (child_usage.ru_stime - self._child_usage.ru_stime)
+
+        self.bytes_written = sum(path_size(path) for path in self.outputs)
+
+    def as_dict(self):
+        # Containers run under the docker daemon, not as our children, so their cpu is counted separately
+        container_cpu = sum(child['cpu_s'] for child in self.children if child['command'].startswith('docker '))
+
+        return {
+            'wall_s': self.wall,
+            'cpu_s': self.python_cpu + self.child_cpu + container_cpu,
+            'python_cpu_s': self.python_cpu,
+            'child_cpu_s': self.child_cpu + container_cpu,
+            'peak_rss_bytes': max([child['peak_rss_bytes'] for child in self.children] + [resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSS_UNIT]),
+            'input_frames': self.frames,
+            'frames_per_s': self.frames / self.wall if self.wall > 0 else 0,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'children': self.children,
+        }
+
+
+@contextlib.contextmanager
+def measure(name, inputs=(), outputs=()):
+    metrics = StageMetrics(name, inputs, outputs)
+    token = current_metrics.set(metrics)
+    metrics.start()
+    try:
+        yield metrics
+    finally:
+        metrics.stop()
+        current_metrics.reset(token)
+
+
+def call(command, **kwargs):
+    '''
+    Drop-in for subprocess.call that reaps the child with wait4, so its own cpu time and
+    peak memory are attributed to the running stage.
+    '''
+    tic = time.perf_counter()
+
+    process = subprocess.Popen(command, **kwargs)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    metrics = current_metrics.get()
+    if metrics is not None:
+        metrics.add_child(command, time.perf_counter() - tic, usage.ru_utime + usage.ru_stime, usage.ru_maxrss * MAXRSS_UNIT)
+
+    return process.returncode
+
+
+class ContainerMonitor:
+    '''
+    Follows docker's stats stream for a container in the background and records its peak
+    memory and total cpu time against the running stage when stopped.
+    '''
+    def __init__(self, container, command, image):
+        self.container = container
+        self.command = ['docker', image, command]
+        self.metrics = current_metrics.get()
+        self.peak_memory = 0
+        self.cpu_ns = 0
+        self._tic = time.perf_counter()
+        self._thread = threading.Thread(target=self._follow, daemon=True)
+        self._thread.start()
+
+    def _follow(self):
+        try:
+            for stats in self.container.stats(stream=True, decode=True):
+                memory = stats.get('memory_stats', {})
+                # max_usage only exists on cgroup v1; on v2 the sampled usage is the best we get
+                self.peak_memory = max(self.peak_memory, memory.get('max_usage', 0), memory.get('usage', 0))
+                self.cpu_ns = max(self.cpu_ns, stats.get('cpu_stats', {}).get('cpu_usage', {}).get('total_usage', 0))
+        except Exception as e:
+            # The stream ends with an error once an auto-removed container is gone
+            log.debug(f'Container stats stream ended: {e}')
+
+    def stop(self):
+        self._thread.join(timeout=5)
+        if self.metrics is not None:
+            self.metrics.add_child(self.command, time.perf_counter() - self._tic, self.cpu_ns / 1e9, self.peak_memory)
+
+
+def write_run_report(report_path, stages, started, **extra):
+    report = {
+        'started': datetime.fromtimestamp(started, timezone.utc).isoformat(),
+        'wall_s': time.time() - started,
+        'host': {'node': platform.node(), 'cpus': os.cpu_count(), 'python': platform.python_version()},
+        **extra,
+        'stages': stages,
+    }
+
+    report_path = Path(report_path)
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    report_path.write_text(json.dumps(report, indent=2, default=str))
+
+    log.info(f'Run report saved to {report_path}')